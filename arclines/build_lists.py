@@ -3,6 +3,7 @@
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
 import numpy as np
+import glob
 import os
 import pdb
 
@@ -11,6 +12,7 @@ from collections import OrderedDict
 from astropy.table import Table, vstack
 
 from arclines import io as arcl_io
+from arclines import match as arcl_match
 from arclines import utils as arcl_utils
 from arclines import load_source
 from arclines import defs
@@ -19,6 +21,7 @@ import arclines # For path
 llist_path = arclines.__path__[0]+'/data/lists/'
 src_path = arclines.__path__[0]+'/data/sources/'
 unk_file = llist_path+'UNKNWNs.dat'
+build_cache_path = src_path+'build_cache/'
 
 
 def by_hand(llist_dict, write=False):
@@ -39,7 +42,8 @@ def by_hand(llist_dict, write=False):
         idx = handIDs['ion'] == ion
         sub_tbl = handIDs[idx]
         # Update only
-        llist_dict[ion], updated = update_line_list(llist_dict[ion], sub_tbl, None, None)
+        llist_dict[ion], updated, report = update_line_list(llist_dict[ion], sub_tbl, None, None)
+        print_report(report, ion)
         if write and updated:
             ion_file = llist_path+'{:s}_lines.dat'.format(ion)
             arcl_io.write_line_list(llist_dict[ion], ion_file)
@@ -165,19 +169,17 @@ def purge_unknowns(line_list, write=False, tol_llist=2., verbose=True):
     unknwns = arcl_io.load_unknown_list([], all=True)
     mask = np.array([True]*len(unknwns))
     updated = False
-    # Loop
-    for ss,row in enumerate(unknwns):
-        dwv = np.abs(line_list['wave']-row['wave'])
-        imin = np.argmin(np.abs(dwv))
-        # Match?
-        if dwv[imin] < tol_llist:
-            line_flag = line_dict[line_list['ion'][imin]]
-            if row['line_flag'] % (2*line_flag) >= line_flag:
-                mask[ss] = False
-                updated = True
-                if verbose:
-                    print("Will purge UNKNOWN line \n {}".format(row))
-                    print("Matched to \n {}".format(line_list[imin]))
+    # Loop on the matches
+    imins, dwv = arcl_match.nearest(line_list['wave'], unknwns['wave'])
+    for ss in np.where(dwv < tol_llist)[0]:
+        row, imin = unknwns[ss], imins[ss]
+        line_flag = line_dict[line_list['ion'][imin]]
+        if row['line_flag'] % (2*line_flag) >= line_flag:
+            mask[ss] = False
+            updated = True
+            if verbose:
+                print("Will purge UNKNOWN line \n {}".format(row))
+                print("Matched to \n {}".format(line_list[imin]))
     # Write?
     if write and updated:
         arcl_io.write_line_list(unknwns[mask], unk_file)
@@ -225,7 +227,9 @@ def source_to_line_lists(source, write=False, llist_dict=None):
         else:
             if ion not in llist_dict.keys():
                 raise KeyError("You are trying to build from scratch but didn't remove {:s}".format(ion_file))
-            llist_dict[ion], updated = update_line_list(llist_dict[ion], sub_tbl, source['File'], source['Instr'])
+            llist_dict[ion], updated, report = update_line_list(llist_dict[ion], sub_tbl,
+                                                                source['File'], source['Instr'])
+            print_report(report, ion)
             # Write
             if write and updated:
                 arcl_io.write_line_list(llist_dict[ion], ion_file)
@@ -274,13 +278,121 @@ def source_to_unknowns(source, write=False, verbose=True, min_ampl=0.):
                              unknown=True, ions=uions)
             arcl_io.write_line_list(unknwn_list, unk_file)
     else: # Update
-        unknwn_list, updated = update_uline_list(U_lines[mask>0], source['File'], source['Instr'], uions)
+        unknwn_list, updated, report = update_uline_list(U_lines[mask>0], source['File'],
+                                                         source['Instr'], uions)
+        print_report(report, unk_file)
         if write and updated:
             arcl_io.write_line_list(unknwn_list, unk_file)
     # Return
     return unknwn_list
 
 
+def merge_lines(line_list, new_lines, tol_wave, NIST_tol=None):
+    """ Merge new lines into a line list in one batch
+
+    Each new line (taken in order) is compared to the lines in the
+    list, including new lines added before it:
+      no line within tol_wave -- it is added
+      one line -- the Instr flag of the new line is OR'd into that line
+      more than one line -- nothing is done
+    With NIST_tol, a single match farther than NIST_tol is a conflict
+    and new lines that are not NIST lines are conflicts too
+
+    Parameters
+    ----------
+    line_list : Table
+    new_lines : Table
+      Must include Instr
+    tol_wave : float
+    NIST_tol : float, optional
+
+    Returns
+    -------
+    line_list : Table
+      Sorted on wave
+    updated : bool
+    report : dict
+      added -- Table of the lines added
+      updated -- Table of the updated lines (after the update)
+      conflicts -- Table of the new lines in conflict, with the reason
+    """
+    nnew = len(new_lines)
+    nline = len(line_list)
+    new_wave = np.array(new_lines['wave'])
+    new_instr = np.array(new_lines['Instr'])
+    # Matches to the list and to the other new lines
+    offsets, mtch_idx = arcl_match.within(line_list['wave'], new_wave, tol_wave)
+    noffsets, nmtch_idx = arcl_match.within(new_wave, new_wave, tol_wave)
+    # Conflicts
+    reason = np.array(['']*nnew, dtype='U30')
+    if NIST_tol is not None:
+        reason[np.array(new_lines['NIST']) != 1] = 'Not a NIST line'
+    # Decide, in order
+    added = np.zeros(nnew, dtype=bool)
+    match = -1*np.ones(nnew, dtype=int)  # Index in line_list, or nline+new line
+    for kk in range(nnew):
+        if reason[kk] != '':
+            continue
+        mtch = mtch_idx[offsets[kk]:offsets[kk+1]].tolist()
+        nmtch = nmtch_idx[noffsets[kk]:noffsets[kk+1]]
+        mtch += (nline + nmtch[(nmtch < kk) & added[nmtch]]).tolist()
+        if len(mtch) == 0:
+            added[kk] = True
+        elif len(mtch) == 1:
+            match[kk] = mtch[0]
+    # NIST tolerance
+    if NIST_tol is not None:
+        all_wave = np.concatenate([np.array(line_list['wave']), new_wave])
+        imatch = np.where(match >= 0)[0]
+        bad = np.abs(all_wave[match[imatch]]-new_wave[imatch]) > NIST_tol
+        reason[imatch[bad]] = 'Bad match for a NIST line'
+        match[imatch[bad]] = -1
+    # Instrument flags (matches to lines added here share the same Instr)
+    imatch = np.where((match >= 0) & (match < nline))[0]
+    old_instr = np.array(line_list['Instr'])
+    new_flags = old_instr.copy()
+    np.bitwise_or.at(new_flags, match[imatch], new_instr[imatch])
+    iupd = np.where(new_flags != old_instr)[0]
+    line_list['Instr'] = new_flags
+    # Add
+    iadd = np.where(added)[0]
+    if len(iadd) > 0:
+        line_list = vstack([line_list, new_lines[iadd]])  # Insures columns are matched
+    # Report
+    updated = (len(iadd) > 0) or (len(iupd) > 0)
+    report = dict(added=new_lines[iadd], updated=line_list[iupd])
+    iconf = np.where(reason != '')[0]
+    report['conflicts'] = new_lines[iconf]
+    report['conflicts']['conflict'] = reason[iconf]
+    # Sort
+    line_list.sort('wave')
+    # Return
+    return line_list, updated, report
+
+
+def print_report(report, name):
+    """ Summarize the report of merge_lines()
+
+    Parameters
+    ----------
+    report : dict
+    name : str
+      Name of the line list
+    """
+    start = "\x1B["
+    end = "\x1B[" + "0m"
+    if len(report['added']) > 0:
+        print(start+"1:34m"+"ADDING "+end+"{:d} lines to {:s}".format(len(report['added']), name))
+        print(report['added'])
+    if len(report['updated']) > 0:
+        print("Updating INSTRUMENT in {:d} lines of {:s}".format(len(report['updated']), name))
+        print(report['updated'])
+    if len(report['conflicts']) > 0:
+        print(start+"1:31m"+"CONFLICTS "+end+"for {:d} lines of {:s}".format(
+            len(report['conflicts']), name))
+        print(report['conflicts'])
+
+
 def update_line_list(line_list, new_lines, source_file, instr, tol_wave=0.1, NIST_tol=0.0001):
     """ Update/add to lines in line list as applicable
     Not for use on UNKNWN lines
@@ -295,52 +407,25 @@ def update_line_list(line_list, new_lines, source_file, instr, tol_wave=0.1, NIS
     tol_wave : float, optional
       Matching tolerance in wavelength
       Anything closer than this, even if real, is trouble
+    NIST_tol : float, optional
+      A match farther than this is a conflict
 
+    Returns
+    -------
+    line_list : Table
+    updated : bool
+    report : dict
+      See merge_lines()
     """
-    start = "\x1B["
-    end = "\x1B[" + "0m"
-
     # Add columns (in place)
     if 'Instr' not in new_lines.keys():
         add_instr_source(new_lines, instr, source_file)
-
-    # Loop to my loop
-    updated = False
-    for line in new_lines:
-        # NIST
-        if line['NIST'] != 1:
-            print("Not ready for this")
-            pdb.set_trace()
-        # Search for wavelength match within tolerance
-        mtch_wave = np.where(np.abs(line_list['wave']-line['wave']) < tol_wave)[0]
-        if len(mtch_wave) == 0:
-            print(start+"1:34m"+"ADDING "+end+"the following line to {:s} line list".format(line['ion']))
-            print(line)
-            line_list = vstack([line_list, line]) # Insures columns are matched
-            updated = True
-        elif len(mtch_wave) == 1:
-            idx = mtch_wave[0]
-            if np.abs(line_list['wave'][idx]-line['wave']) > NIST_tol:
-                print("Bad match for a NIST line")
-                print(line)
-                print(line_list[idx])
-                pdb.set_trace()
-            else:  # Check instrument
-                if (line_list['Instr'][idx] % (2*line['Instr'])) >= line['Instr']:
-                    pass
-                else:
-                    line_list['Instr'][idx] += line['Instr']
-                    print("Updating INSTRUMENT in this line:")
-                    print(line_list[idx])
-                    updated = True
-    # Sort
-    line_list.sort('wave')
-    # Return
-    return line_list, updated
+    # Merge
+    return merge_lines(line_list, new_lines, tol_wave, NIST_tol=NIST_tol)
 
 
 def update_uline_list(new_lines, source_file, instr,
-                      ions, tol_wave=1.5):
+                      ions, tol_wave=1.5, line_list=None):
     """ Update/add to UNKNWN line list as applicable
 
     Parameters
@@ -354,40 +439,328 @@ def update_uline_list(new_lines, source_file, instr,
     tol_wave : float, optional
       Matching tolerance in wavelength
       Anything closer than this, even if real, is trouble
+    line_list : Table, optional
+      Current UNKNWN list;  loaded if not provided
 
+    Returns
+    -------
+    line_list : Table
+    updated : bool
+    report : dict
+      See merge_lines()
     """
     # Load
-    line_list = arcl_io.load_line_list(unk_file)
+    if line_list is None:
+        line_list = arcl_io.load_line_list(unk_file)
     # Add columns (in place)
     add_instr_source(new_lines, instr, source_file)
 
     line_flag = get_line_flag(ions)
     new_lines['line_flag'] = line_flag
 
-    # Loop to my loop
-    updated = False
-    for line in new_lines:
-        # Search for wavelength match within tolerance
-        mtch_wave = np.where(np.abs(line_list['wave']-line['wave']) < tol_wave)[0]
-        if len(mtch_wave) == 0:
-            print("Added the following line to {:s}".format(unk_file))
-            print(line)
-            line_list = vstack([line_list, line]) # Insures columns are matched
-            updated = True
-        elif len(mtch_wave) == 1:
-            idx = mtch_wave[0]
-            # Check instrument
-            if (line_list['Instr'][idx] % (2*line['Instr'])) >= line['Instr']:
-                pass
+    # Merge
+    return merge_lines(line_list, new_lines, tol_wave)
+
+
+def compile_line_db(outfile=None):
+    """ Compile the ASCII line lists (and UNKNWNs) into a single
+    structured array that can be memory-mapped with np.load(mmap_mode='r')
+
+    The rows are ordered by ion_code (the ion names sorted), keeping the
+    row order of each line list.  The per-ion offsets and the column
+    names and formats of each list are written to a JSON file alongside
+    so that io.line_list_from_db() returns the same Table as load_line_list()
+
+    Parameters
+    ----------
+    outfile : str, optional
+      Defaults to io.line_db_file
+    """
+    import glob
+    import json
+    if outfile is None:
+        outfile = arcl_io.line_db_file
+    # Load
+    names, tables = [], []
+    for line_file in sorted(glob.glob(llist_path+'*_lines.dat')):
+        names.append(line_file[len(llist_path):-len('_lines.dat')])
+        tables.append(arcl_io.load_line_list(line_file, use_cache=False))
+    names.append('UNKNWNs')
+    tables.append(arcl_io.load_line_list(unk_file, use_cache=False))
+    # Record format
+    ion_len = max([tbl['ion'].dtype.itemsize//4 for tbl in tables])
+    src_len = max([tbl['Source'].dtype.itemsize//4 for tbl in tables])
+    dtype = [(str('ion_code'), np.int16), (str('ion'), 'U{:d}'.format(ion_len)),
+             (str('wave'), float), (str('NIST'), np.int64), (str('Instr'), np.int64),
+             (str('amplitude'), float), (str('Source'), 'U{:d}'.format(src_len)),
+             (str('line_flag'), np.int64)]
+    db = np.zeros(sum([len(tbl) for tbl in tables]), dtype=dtype)
+    # Fill
+    meta = dict(ions=names, offsets={}, columns={}, dtypes={})
+    i0 = 0
+    for kk, name, tbl in zip(range(len(names)), names, tables):
+        i1 = i0 + len(tbl)
+        db['ion_code'][i0:i1] = kk
+        for key in tbl.keys():
+            db[key][i0:i1] = tbl[key].data
+        meta['offsets'][name] = [i0, i1]
+        meta['columns'][name] = tbl.keys()
+        meta['dtypes'][name] = [tbl[key].dtype.str for key in tbl.keys()]
+        i0 = i1
+    # Write
+    np.save(outfile, db)
+    with open(arcl_io.line_db_meta_file(outfile), 'w') as f:
+        json.dump(meta, f, indent=1)
+    print("Wrote {:d} lines to {:s}".format(db.size, outfile))
+
+
+def source_hash(source):
+    """ Hash of a source file and its entry in the source table
+
+    Parameters
+    ----------
+    source : dict or Row
+
+    Returns
+    -------
+    hash : str
+    """
+    import hashlib
+    sha = hashlib.sha1()
+    for key in ['File', 'Instr', 'Lines', 'wvmin', 'wvmax', 'Format']:
+        sha.update(str(source[key]).encode('utf-8'))
+    with open(src_path+source['File'], 'rb') as f:
+        sha.update(f.read())
+    return sha.hexdigest()
+
+
+def build_key(source, unknowns=True):
+    """ Key of a source contribution in the build cache
+
+    A contribution depends on more than the source:  LowRedux sources are
+    vetted against the line lists on disk (and give nothing without them),
+    so the content of those files is part of the key, as is the unknowns
+    flag of the build
+
+    Parameters
+    ----------
+    source : dict or Row
+    unknowns : bool, optional
+
+    Returns
+    -------
+    key : str
+    """
+    import hashlib
+    sha = hashlib.sha1()
+    sha.update(source_hash(source).encode('utf-8'))
+    sha.update('unknowns={}'.format(bool(unknowns)).encode('utf-8'))
+    for dep_file in load_source._src_files(source['File'], source['Format'],
+                                           source['Lines'].split(','))[1:]:
+        sha.update(os.path.basename(dep_file).encode('utf-8'))
+        with open(dep_file, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def source_contribution(source, tol_NIST=0.2):
+    """ Everything the build takes from a single source
+    Independent of the other sources, so these can be run in parallel
+
+    Parameters
+    ----------
+    source : dict
+      Row of the source table
+    tol_NIST : float, optional
+
+    Returns
+    -------
+    contrib : dict
+      File, Instr, uions, ID_lines (dict of Tables per ion),
+      U_lines (Table or None) with NIST vetting (nist_mask)
+    """
+    src_dict = load_source.load(source)
+    uions = [str(ion) for ion in arcl_utils.unique_ions(source, src_dict=src_dict)]
+    contrib = dict(File=source['File'], Instr=source['Instr'], uions=uions,
+                   ID_lines=OrderedDict(), U_lines=None)
+    # IDs
+    if src_dict['ID_lines'] is not None:
+        for ion in uions:
+            idx = src_dict['ID_lines']['ion'] == ion
+            contrib['ID_lines'][ion] = src_dict['ID_lines'][idx]
+    # Unknowns
+    U_lines = src_dict['U_lines']
+    if U_lines is not None:
+        U_lines = U_lines[U_lines['amplitude'] > 0.]
+        iion, _ = arcl_utils.nist_matches(U_lines['wave'], uions, tol_NIST=tol_NIST)
+        U_lines['nist_mask'] = np.where(iion >= 0, 2, 1)
+        contrib['U_lines'] = U_lines
+    return contrib
+
+
+def _source_contribution(args):
+    """ source_contribution() with the build cache;  for the process pool
+    """
+    import pickle
+    source, shash, cache_path = args
+    cache_file = None
+    if cache_path is not None:
+        cache_file = os.path.join(cache_path, '{:s}.pkl'.format(shash))
+        if os.path.isfile(cache_file):
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+    contrib = source_contribution(source)
+    if cache_file is not None:
+        with open(cache_file, 'wb') as f:
+            pickle.dump(contrib, f)
+    return contrib
+
+
+def build_all(sources=None, jobs=1, write=False, line_lists=True, unknowns=True,
+              cache_path=None, tol_llist=2.):
+    """ Build the line lists and UNKNWNs from all of the sources
+
+    The sources are read in parallel (one process per source, up to jobs)
+    and their contributions are then merged in the order of the source
+    table, so the result does not depend on jobs.  Contributions are kept
+    in cache_path with a manifest of their keys (see build_key()), so that
+    a rebuild only re-reads the sources that changed.  Contributions not
+    in the new manifest are removed.
+
+    Parameters
+    ----------
+    sources : Table, optional
+      Defaults to the source table
+    jobs : int, optional
+      Number of processes
+    write : bool, optional
+      Write the line lists, UNKNWNs and the compiled line database
+    line_lists : bool, optional
+      Build the ion line lists;  otherwise those on disk are used
+    unknowns : bool, optional
+      Build the UNKNWN list
+    cache_path : str, optional
+      Defaults to build_cache_path;  use '' to not cache
+    tol_llist : float, optional
+      UNKNWNs closer than this to a line list entry are not added
+
+    Returns
+    -------
+    llist_dict : dict
+      Line list Table per ion
+    unknwn_list : Table or None
+    manifest : dict
+      Cache key of each source that was used
+    """
+    import json
+    import multiprocessing
+    # Sources
+    if sources is None:
+        sources = arcl_io.load_source_table()
+    src_rows = []
+    for row in sources:
+        src_rows.append(dict([(key, row[key].item() if hasattr(row[key], 'item') else row[key])
+                              for key in sources.keys()]))
+    # Cache
+    if cache_path is None:
+        cache_path = build_cache_path
+    if cache_path == '':
+        cache_path = None
+    else:
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        manifest_file = os.path.join(cache_path, 'manifest.json')
+        old_manifest = {}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                old_manifest = json.load(f)
+    manifest = OrderedDict()
+    args = []
+    for source in src_rows:
+        if not os.path.isfile(src_path+source['File']):
+            print("Source file {:s} is missing;  skipping it".format(source['File']))
+            continue
+        manifest[source['File']] = build_key(source, unknowns=unknowns)
+        if (cache_path is not None) and (old_manifest.get(source['File']) != manifest[source['File']]):
+            print("Will re-read source {:s}".format(source['File']))
+        args.append((source, manifest[source['File']], cache_path))
+
+    # Map
+    if jobs > 1:
+        # spawn, as forking once the numba thread pool is running can hang;
+        # Python 2 can only fork
+        if hasattr(multiprocessing, 'get_context'):
+            pool = multiprocessing.get_context('spawn').Pool(processes=jobs)
+        else:
+            pool = multiprocessing.Pool(processes=jobs)
+        try:
+            contribs = pool.map(_source_contribution, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        contribs = [_source_contribution(arg) for arg in args]
+    if cache_path is not None:
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        # Prune contributions that are no longer in the manifest
+        keep = set(manifest.values())
+        for cache_file in glob.glob(os.path.join(cache_path, '*.pkl')):
+            if os.path.basename(cache_file)[:-4] not in keep:
+                os.remove(cache_file)
+
+    # Reduce -- Line lists, in source order
+    llist_dict = OrderedDict()
+    if line_lists:
+        for contrib in contribs:
+            for ion, sub_tbl in contrib['ID_lines'].items():
+                if ion not in llist_dict.keys():
+                    llist_dict[ion] = create_line_list(sub_tbl, contrib['File'], contrib['Instr'])
+                else:
+                    llist_dict[ion], _, report = update_line_list(
+                        llist_dict[ion], sub_tbl, contrib['File'], contrib['Instr'])
+                    print_report(report, ion)
+        by_hand(llist_dict)
+
+    # Reduce -- Unknowns, in source order
+    unknwn_list = None
+    if unknowns:
+        for contrib in contribs:
+            U_lines = contrib['U_lines']
+            if (U_lines is None) or (len(U_lines) == 0):
+                continue
+            # Vet against our line lists
+            mask = np.array(U_lines['nist_mask'])
+            if line_lists:
+                lists = [llist_dict[ion] for ion in contrib['uions'] if ion in llist_dict.keys()]
+                llist = vstack(lists) if len(lists) > 0 else None
             else:
-                line_list['Instr'][idx] += line['Instr']
-                print("Updated instrument in this line:")
-                print(line_list[idx])
-                updated = True
-    # Sort
-    line_list.sort('wave')
+                llist = arcl_io.load_line_lists(contrib['uions'], skip=True)
+            if llist is not None:
+                _, dwv = arcl_match.nearest(llist['wave'], U_lines['wave'])
+                mask[dwv < tol_llist] = 0
+            if np.sum(mask) == 0:
+                continue
+            new_lines = U_lines[mask > 0]
+            new_lines.remove_column('nist_mask')
+            if unknwn_list is None:
+                unknwn_list = create_line_list(new_lines, contrib['File'], contrib['Instr'],
+                                               unknown=True, ions=contrib['uions'])
+            else:
+                unknwn_list, _, report = update_uline_list(new_lines, contrib['File'],
+                                                           contrib['Instr'], contrib['uions'],
+                                                           line_list=unknwn_list)
+                print_report(report, unk_file)
+
+    # Write
+    if write:
+        for ion, llist in llist_dict.items():
+            arcl_io.write_line_list(llist, llist_path+'{:s}_lines.dat'.format(ion))
+        if unknwn_list is not None:
+            arcl_io.write_line_list(unknwn_list, unk_file)
+        compile_line_db()
     # Return
-    return line_list, updated
+    return llist_dict, unknwn_list, manifest
 
 
 def master_build(write=False, nsources=None, plots=True, verbose=True):
@@ -6,7 +6,10 @@ from __future__ import (print_function, absolute_import, division, unicode_liter
 import numpy as np
 import pdb
 
-from arclines.utils import calc_fit_rms, func_val, robust_polyfit
+from collections import OrderedDict
+
+from arclines.utils import calc_fit_rms, func_val, func_val_batch, robust_polyfit
+from arclines import match as arcl_match
 from arclines.holy.qa import arc_fit_qa
 
 
@@ -26,10 +29,15 @@ def iterative_fitting(spec, tcent, ifit, IDs, llist, disp, plot_fil=None,
     npix = spec.size
 
     # Setup for fitting
-    sv_ifit = list(ifit) # Keep the originals
+    sv_ifit = np.array(ifit, dtype=int) # Keep the originals
     all_ids = -999.*np.ones(len(tcent))
     all_idsion = np.array(['UNKNWN']*len(tcent))
     all_ids[ifit] = IDs
+    in_fit = np.zeros(len(tcent), dtype=bool)  # Lines in the fit;  reset each iteration
+    # Line list as plain arrays, sorted once
+    llist_wave = np.array(llist['wave'])
+    llist_ion = np.array(llist['ion'])
+    llist_isort = arcl_match.sort_lines(llist_wave)
 
     # Fit
     n_order = aparm['n_first']
@@ -47,21 +55,19 @@ def iterative_fitting(spec, tcent, ifit, IDs, llist, disp, plot_fil=None,
             print("RMS = {:g}".format(rms_pix))
         # DEBUG
         # Reject but keep originals (until final fit)
-        ifit = list(ifit[mask == 0]) + sv_ifit
+        in_fit[:] = False
+        in_fit[ifit[mask == 0]] = True
+        in_fit[sv_ifit] = True
         # Find new points (should we allow removal of the originals?)
         twave = func_val(fit, tcent, aparm['func'], minv=fmin, maxv=fmax)
-        for ss,iwave in enumerate(twave):
-            mn = np.min(np.abs(iwave-llist['wave']))
-            if mn/aparm['disp'] < aparm['match_toler']:
-                imn = np.argmin(np.abs(iwave-llist['wave']))
-                #if verbose:
-                #    print('Adding {:g} at {:g}'.format(llist['wave'][imn],tcent[ss]))
-                # Update and append
-                all_ids[ss] = llist['wave'][imn]
-                all_idsion[ss] = llist['ion'][imn]
-                ifit.append(ss)
-        # Keep unique ones
-        ifit = np.unique(np.array(ifit,dtype=int))
+        imn, mn = arcl_match.nearest(llist_wave, twave, isort=llist_isort)
+        gdmn = np.where(mn/aparm['disp'] < aparm['match_toler'])[0]
+        # Update and append
+        all_ids[gdmn] = llist_wave[imn[gdmn]]
+        all_idsion[gdmn] = llist_ion[imn[gdmn]]
+        in_fit[gdmn] = True
+        # Unique and sorted
+        ifit = np.where(in_fit)[0]
         # Increment order
         if n_order < (aparm['n_final']+2):
             n_order += 1
@@ -125,3 +131,191 @@ def iterative_fitting(spec, tcent, ifit, IDs, llist, disp, plot_fil=None,
 
 
 
+
+
+def wave_table(fits, nspec):
+    """ Wavelengths of every spectral pixel for many solutions
+    Solutions of the same function and order are evaluated together
+
+    Parameters
+    ----------
+    fits : list of dict
+      final_fit dicts (fitc, function, fmin, fmax, xnorm)
+    nspec : int
+      Number of spectral pixels
+
+    Returns
+    -------
+    waves : ndarray (nfit, nspec)
+    """
+    pix = np.arange(nspec, dtype=float)
+    waves = np.zeros((len(fits), nspec))
+    groups = {}
+    for kk, fit in enumerate(fits):
+        groups.setdefault((fit['function'], len(fit['fitc'])), []).append(kk)
+    for (function, _), idx in groups.items():
+        coeffs = np.array([fits[kk]['fitc'] for kk in idx], dtype=float)
+        x = pix[None,:] / (np.array([fits[kk]['xnorm'] for kk in idx])[:,None] - 1.)
+        waves[idx] = func_val_batch(coeffs, x, function,
+                                    minv=np.array([fits[kk]['fmin'] for kk in idx]),
+                                    maxv=np.array([fits[kk]['fmax'] for kk in idx]))
+    return waves
+
+
+def slitmask_from_traces(traces, shape):
+    """ Slit of every pixel from the slit edges
+
+    Parameters
+    ----------
+    traces : list of tuple
+      (left, right) column of each slit edge, arrays with one entry per row;
+      slits may not overlap
+    shape : tuple
+      (nspec, ncol) of the frame
+
+    Returns
+    -------
+    slitmask : ndarray (int)
+      Index of the slit in traces;  -1 off the slits
+    """
+    nspec, ncol = shape
+    rows = np.arange(nspec)
+    # +slit at the first column and -slit past the last;  the running sum fills in between
+    edges = np.zeros((nspec, ncol+1), dtype=np.int32)
+    for kk, (left, right) in enumerate(traces):
+        lo = np.clip(np.ceil(np.asarray(left)), 0, ncol).astype(int)
+        hi = np.clip(np.floor(np.asarray(right))+1, 0, ncol).astype(int)
+        ok = hi > lo
+        np.add.at(edges, (rows[ok], lo[ok]), kk+1)
+        np.add.at(edges, (rows[ok], hi[ok]), -(kk+1))
+    return np.cumsum(edges[:,:ncol], axis=1) - 1
+
+
+def wavelength_image(fits, shape, slitmask=None, traces=None, outfile=None,
+                     fill=np.nan, nrow=256):
+    """ Wavelength of every pixel of a frame from the slit solutions
+
+    The spectral direction is along the rows (axis 0), and the solution
+    of a slit applies to all of its columns.
+
+    Parameters
+    ----------
+    fits : list of dict
+      final_fit dicts (fitc, function, fmin, fmax, xnorm), one per slit
+    shape : tuple
+      (nspec, ncol) of the frame
+    slitmask : ndarray (int), optional
+      Index into fits of every pixel;  -1 (or any negative) off the slits
+    traces : list of tuple, optional
+      Slit edges instead of slitmask;  see slitmask_from_traces()
+    outfile : str, optional
+      Write to this .npy file, memory-mapped, instead of holding the image
+    fill : float, optional
+      Value off the slits
+    nrow : int, optional
+      Rows filled at a time
+
+    Returns
+    -------
+    waveimg : ndarray or memmap (float32)
+    """
+    nspec, ncol = shape
+    if slitmask is None:
+        if traces is None:
+            raise IOError("Need slitmask or traces")
+        slitmask = slitmask_from_traces(traces, shape)
+    if slitmask.shape != tuple(shape):
+        raise IOError("slitmask has shape {} not {}".format(slitmask.shape, tuple(shape)))
+    # All slits at once
+    waves = wave_table(fits, nspec).astype(np.float32).ravel()
+    # Output
+    if outfile is not None:
+        waveimg = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.float32, shape=tuple(shape))
+    else:
+        waveimg = np.empty(shape, dtype=np.float32)
+    # Fill in blocks of rows
+    for r0 in range(0, nspec, nrow):
+        r1 = min(r0+nrow, nspec)
+        smask = slitmask[r0:r1]
+        on = smask >= 0
+        idx = np.where(on, smask, 0)*nspec + np.arange(r0, r1)[:,None]
+        waveimg[r0:r1] = np.where(on, waves[idx], fill)
+    if outfile is not None:
+        waveimg.flush()
+    return waveimg
+
+
+# Inverse tables of the last few solutions;  see pixel_table()
+# Each is 16*oversample*npix bytes, e.g. 650 kB for 4096 pixels
+_pixel_tables = OrderedDict()
+max_pixel_tables = 16
+
+
+def pixel_table(fit, oversample=10, use_cache=True):
+    """ Wavelength to pixel table of a solution, cached
+
+    Parameters
+    ----------
+    fit : dict
+      final_fit (fitc, function, fmin, fmax, xnorm)
+    oversample : int, optional
+      Table points per pixel
+    use_cache : bool, optional
+      Keep the table (read-only) for the next call;  the last
+      max_pixel_tables are kept
+
+    Returns
+    -------
+    twave : ndarray
+      Increasing wavelengths
+    tpix : ndarray
+      Pixel of each
+    """
+    key = (tuple(np.asarray(fit['fitc'], dtype=float).tolist()), fit['function'],
+           float(fit['fmin']), float(fit['fmax']), float(fit['xnorm']), oversample)
+    if not use_cache:
+        return _pixel_table(*key)
+    if key in _pixel_tables:
+        tables = _pixel_tables.pop(key)
+    else:
+        tables = _pixel_table(*key)
+        for tbl in tables:  # Shared by the callers
+            tbl.flags.writeable = False
+        while len(_pixel_tables) >= max_pixel_tables:
+            _pixel_tables.popitem(last=False)
+    # Most recent last
+    _pixel_tables[key] = tables
+    return tables
+
+
+def _pixel_table(fitc, function, fmin, fmax, xnorm, oversample):
+    """ pixel_table() of a solution given by its key
+    """
+    npix = int(xnorm)
+    tpix = np.arange((npix-1)*oversample+1) / oversample
+    twave = func_val(np.array(fitc), tpix/(xnorm-1.), function, minv=fmin, maxv=fmax)
+    dwave = np.diff(twave)
+    if np.all(dwave < 0.):
+        twave, tpix = twave[::-1], tpix[::-1]
+    elif not np.all(dwave > 0.):
+        raise ValueError("Wavelength solution is not monotonic;  no inverse")
+    return twave, tpix
+
+
+def wave_to_pixel(wave, fit, oversample=10):
+    """ Pixel of wavelengths, by interpolating in pixel_table()
+
+    Parameters
+    ----------
+    wave : float or ndarray
+    fit : dict
+      final_fit
+    oversample : int, optional
+
+    Returns
+    -------
+    pix : ndarray
+      NaN off the detector
+    """
+    twave, tpix = pixel_table(fit, oversample=oversample)
+    return np.interp(wave, twave, tpix, left=np.nan, right=np.nan)
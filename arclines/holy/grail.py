@@ -4,9 +4,12 @@ from __future__ import (print_function, absolute_import, division, unicode_liter
 
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
+import time
 import pdb
 
 from arclines import io as arcl_io
+from arclines import match as arcl_match
+from arclines.utils import calc_fit_rms, robust_polyfit
 from arclines.holy import patterns as arch_patt
 from arclines.holy import fitting as arch_fit
 from arclines.holy import utils as arch_utils
@@ -14,7 +17,7 @@ from arclines.holy import utils as arch_utils
 
 def basic(spec, lines, wv_cen, disp, siglev=20., min_ampl=300.,
           swv_uncertainty=350., pix_tol=2, plot_fil=None, min_match=5,
-          **kwargs):
+          index=None, **kwargs):
     """ Basic holy grail algorithm
 
     Parameters
@@ -31,6 +34,8 @@ def basic(spec, lines, wv_cen, disp, siglev=20., min_ampl=300.,
     swv_uncertainty
     pix_tol
     plot_fil
+    index : LinePatternIndex, optional
+      Prebuilt index for these lines
 
     Returns
     -------
@@ -43,17 +48,24 @@ def basic(spec, lines, wv_cen, disp, siglev=20., min_ampl=300.,
     wave = wv_cen + (np.arange(npix) - npix/2.)*disp
 
     line_lists = arcl_io.load_line_lists(lines, unknown=True)
-    wvdata = line_lists['wave'].data  # NIST + Extra
-    isrt = np.argsort(wvdata)
-    wvdata = wvdata[isrt]
+    if index is None:
+        wvdata = line_lists['wave'].data  # NIST + Extra
+        isrt = np.argsort(wvdata)
+        wvdata = wvdata[isrt]
+    else:
+        index.check_lines(lines)
+        wvdata = index.wvdata[True]
 
     # Find peaks
     all_tcent, cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=min_ampl)
 
     # Matching
-    match_idx, scores = arch_patt.run_quad_match(cut_tcent, wave, wvdata,
-                                                 disp, swv_uncertainty=swv_uncertainty,
-                                                 pix_tol=pix_tol)
+    didx, lidx = arch_patt.quad_match_table(cut_tcent, wave, wvdata,
+                                            disp, swv_uncertainty=swv_uncertainty,
+                                            pix_tol=pix_tol)
+    match_idx = arch_patt.match_table_to_dict(didx, lidx, cut_tcent.size)
+    codes, best = arch_patt.score_quad_table(didx, lidx, cut_tcent.size)
+    scores = np.array(arch_patt.quad_labels)[codes]
 
     # Check quadrants
     xquad = npix//4 + 1
@@ -73,13 +85,9 @@ def basic(spec, lines, wv_cen, disp, siglev=20., min_ampl=300.,
 
     # Go for it!?
     mask = np.array([False]*len(all_tcent))
-    IDs = []
-    for kk,score in enumerate(scores):
-        if score in ['Perf', 'Good', 'Ok']:
-            mask[icut[kk]] = True
-            uni, counts = np.unique(match_idx[kk]['matches'], return_counts=True)
-            imx = np.argmax(counts)
-            IDs.append(wvdata[uni[imx]])
+    gdscore = codes >= arch_patt.QuadScore.GOOD
+    mask[icut[gdscore]] = True
+    IDs = list(wvdata[best[gdscore]])
     ngd_match = np.sum(mask)
     if ngd_match < min_match:
         print("Insufficient matches to continue")
@@ -98,7 +106,8 @@ def basic(spec, lines, wv_cen, disp, siglev=20., min_ampl=300.,
 
 def semi_brute(spec, lines, wv_cen, disp, min_ampl=300.,
                outroot=None, debug=False, do_fit=True, verbose=False,
-               fit_parm=None, min_nmatch=3, lowest_ampl=200.):
+               fit_parm=None, min_nmatch=3, lowest_ampl=200., index=None,
+               prior_fit=None, prior_shift=50., prior_nfit=10, prior_rms=0.5):
     """
     Parameters
     ----------
@@ -115,6 +124,17 @@ def semi_brute(spec, lines, wv_cen, disp, min_ampl=300.,
     fit_parm
     min_nmatch
     lowest_ampl
+    index : LinePatternIndex, optional
+      Prebuilt index for these lines
+    prior_fit : dict, optional
+      final_fit of a known solution for this setup, e.g. from iterative_fitting.
+      Its wavelengths for the detected lines (searching for a shift of up
+      to prior_shift pixels) are used instead of the scan, unless the
+      resulting fit has fewer than prior_nfit lines or an RMS above
+      prior_rms pixels
+    prior_shift : float, optional
+    prior_nfit : int, optional
+    prior_rms : float, optional
 
     Returns
     -------
@@ -129,9 +149,27 @@ def semi_brute(spec, lines, wv_cen, disp, min_ampl=300.,
     # Load line lists
     line_lists = arcl_io.load_line_lists(lines)
     unknwns = arcl_io.load_unknown_list(lines)
+    if index is not None:
+        index.check_lines(lines)
 
     npix = spec.size
 
+    # Known solution?
+    if (prior_fit is not None) and do_fit:
+        tot_list = vstack([line_lists,unknwns])
+        if index is None:
+            wvdata = np.array(tot_list['wave'].data) # Removes mask if any
+            wvdata.sort()
+        else:
+            wvdata = index.wvdata[True]
+        plot_fil = None if outroot is None else outroot+'_fit.pdf'
+        prior_out = _semi_brute_prior(spec, line_lists, tot_list, wvdata, disp, prior_fit,
+                                      min_ampl, lowest_ampl, 2., prior_shift, prior_nfit,
+                                      prior_rms, plot_fil, verbose, fit_parm)
+        if prior_out is not None:
+            return prior_out
+        print("The prior solution failed;  scanning for a new one")
+
     # Lines
     all_tcent, cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=min_ampl)
 
@@ -151,8 +189,11 @@ def semi_brute(spec, lines, wv_cen, disp, min_ampl=300.,
             tot_list = vstack([line_lists,unknwns])
         else:
             tot_list = line_lists
-        wvdata = np.array(tot_list['wave'].data) # Removes mask if any
-        wvdata.sort()
+        if index is None:
+            wvdata = np.array(tot_list['wave'].data) # Removes mask if any
+            wvdata.sort()
+        else:
+            wvdata = index.wvdata[unknown]
         sav_nmatch = best_dict['nmatch']
 
         # Loop on pix_tol
@@ -185,8 +226,11 @@ def semi_brute(spec, lines, wv_cen, disp, min_ampl=300.,
         tot_list = line_lists
     else:
         tot_list = vstack([line_lists,unknwns])
-    wvdata = np.array(tot_list['wave'].data) # Removes mask if any
-    wvdata.sort()
+    if index is None:
+        wvdata = np.array(tot_list['wave'].data) # Removes mask if any
+        wvdata.sort()
+    else:
+        wvdata = index.wvdata[not best_dict['unknown']]
     tmp_dict = best_dict.copy()
     tmp_dict['nmatch'] = 0
     arch_patt.scan_for_matches(best_dict['bwv'], disp, npix, cut_tcent, wvdata,
@@ -256,40 +300,75 @@ def semi_brute(spec, lines, wv_cen, disp, min_ampl=300.,
         line_lists = vstack([line_lists, full_NIST[keep]])
         '''
         #
-        NIST_lines = line_lists['NIST'] > 0
-        ifit = np.where(best_dict['mask'])[0]
         if outroot is not None:
             plot_fil = outroot+'_fit.pdf'
         else:
             plot_fil = None
-        # Purge UNKNOWNS from ifit
-        imsk = np.array([True]*len(ifit))
-        for kk, idwv in enumerate(np.array(best_dict['IDs'])[ifit]):
-            if np.min(np.abs(line_lists['wave'][NIST_lines]-idwv)) > 0.01:
-                imsk[kk] = False
-        ifit = ifit[imsk]
-        # Allow for weaker lines in the fit
-        all_tcent, weak_cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=lowest_ampl)
-        add_weak = []
-        for weak in weak_cut_tcent:
-            if np.min(np.abs(cut_tcent-weak)) > 5.:
-                add_weak += [weak]
-        if len(add_weak) > 0:
-            cut_tcent = np.concatenate([cut_tcent, np.array(add_weak)])
-        # Fit
-        final_fit = arch_fit.iterative_fitting(spec, cut_tcent, ifit,
-                                               np.array(best_dict['IDs'])[ifit], line_lists[NIST_lines],
-                                               disp, plot_fil=plot_fil, verbose=verbose, aparm=fit_parm)
-        if plot_fil is not None:
-            print("Wrote: {:s}".format(plot_fil))
+        final_fit = _fit_semi_brute(spec, line_lists, best_dict, cut_tcent, disp,
+                                    lowest_ampl, plot_fil, verbose, fit_parm)
 
     # Return
     return best_dict, final_fit
 
 
+def _fit_semi_brute(spec, line_lists, best_dict, cut_tcent, disp, lowest_ampl,
+                    plot_fil, verbose, fit_parm):
+    """ Fit the NIST lines matched by semi_brute, with weaker lines added
+    """
+    NIST_lines = line_lists['NIST'] > 0
+    ifit = np.where(best_dict['mask'])[0]
+    # Purge UNKNOWNS from ifit
+    _, dwv = arcl_match.nearest(line_lists['wave'][NIST_lines], np.array(best_dict['IDs'])[ifit])
+    imsk = ~(dwv > 0.01)
+    ifit = ifit[imsk]
+    # Allow for weaker lines in the fit
+    all_tcent, weak_cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=lowest_ampl)
+    _, dpix = arcl_match.nearest(cut_tcent, weak_cut_tcent)
+    add_weak = weak_cut_tcent[dpix > 5.]
+    if len(add_weak) > 0:
+        cut_tcent = np.concatenate([cut_tcent, np.array(add_weak)])
+    # Fit
+    final_fit = arch_fit.iterative_fitting(spec, cut_tcent, ifit,
+                                           np.array(best_dict['IDs'])[ifit], line_lists[NIST_lines],
+                                           disp, plot_fil=plot_fil, verbose=verbose, aparm=fit_parm)
+    if plot_fil is not None:
+        print("Wrote: {:s}".format(plot_fil))
+    return final_fit
+
+
+def _semi_brute_prior(spec, line_lists, tot_list, wvdata, disp, prior_fit, min_ampl,
+                      lowest_ampl, pix_tol, max_shift, min_nfit, max_rms,
+                      plot_fil, verbose, fit_parm):
+    """ semi_brute from a known solution
+
+    Returns
+    -------
+    best_dict, final_fit, or None if the solution fails the quality gate
+    """
+    all_tcent, cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=min_ampl)
+    best_dict = arch_patt.match_to_prior(cut_tcent, prior_fit, wvdata, disp,
+                                         pix_tol=pix_tol, max_shift=max_shift)
+    best_dict.update(dict(min_ampl=min_ampl, ampl=min_ampl, unknown=True, prior=True,
+                          line_list=tot_list.copy()))
+    print('---------------------------------------------------')
+    print('Report (prior solution):')
+    print('::   Number of lines analyzed = {:d}'.format(cut_tcent.size))
+    print('::   Number of matches = {:d}'.format(best_dict['nmatch']))
+    print('::   Shift from prior = {:g} pix'.format(best_dict['shift']))
+    print('---------------------------------------------------')
+    if best_dict['nmatch'] < min_nfit:
+        return None
+    final_fit = _fit_semi_brute(spec, line_lists, best_dict, cut_tcent, disp,
+                                lowest_ampl, plot_fil, verbose, fit_parm)
+    if (len(final_fit['xfit']) < min_nfit) or (final_fit['rms'] > max_rms):
+        return None
+    return best_dict, final_fit
+
+
 def general(spec, lines, min_ampl=300.,
             outroot=None, debug=False, do_fit=True, verbose=False,
-            fit_parm=None, lowest_ampl=200.):
+            fit_parm=None, lowest_ampl=200., nthreads=None, index=None,
+            ngrid=1000, ncoarse=10, ncand=3):
     """
     Parameters
     ----------
@@ -304,24 +383,42 @@ def general(spec, lines, min_ampl=300.,
     fit_parm
     min_nmatch
     lowest_ampl
+    nthreads : int, optional
+      Number of threads for the triangles search
+    index : LinePatternIndex, optional
+      Prebuilt index for these lines;  built here if not provided
+    ngrid : int, optional
+      Number of (central wavelength, dispersion) grid points for the vote
+    ncoarse : int, optional
+      Grid points per cell of the coarse vote
+    ncand : int, optional
+      Number of candidate solutions from the vote to solve
 
     Returns
     -------
     best_dict : dict
+      Includes the candidates, ranked best first (see _rank_candidates())
     final_fit : dict
 
+    Notes
+    -----
+    The triangle matches are not streamed (cf. iter_triangles()).  The vote
+    takes its grid from the range of all the matches, and each candidate is
+    then solved with the matches near it, so all of them are held in memory.
+    That is a few MB at most for the arcs in data/test_arcs.
     """
     # imports
     from astropy.table import vstack
     from linetools import utils as ltu
     from arclines import plots as arcl_plots
 
-    # Import the triangles algorithm
-    from arclines.holy.patterns import triangles
-
     # Load line lists
     line_lists = arcl_io.load_line_lists(lines)
     unknwns = arcl_io.load_unknown_list(lines)
+    if index is None:
+        index = arch_patt.LinePatternIndex(lines)
+    else:
+        index.check_lines(lines)
 
     npix = spec.size
 
@@ -333,7 +430,11 @@ def general(spec, lines, min_ampl=300.,
     # Best
     best_dict = dict(nmatch=0, ibest=-1, bwv=0., min_ampl=min_ampl)
 
-    ngrid = 1000
+    # Candidates, and the line list each was solved with
+    candidates = []
+    lists = []
+    # Good lines = NIST or OH;  the candidates are judged by these
+    good_wave = line_lists['wave'][np.any([line_lists['NIST']>0, line_lists['ion'] == 'OH'], axis=0)]
 
     # Loop on unknowns
     for unknown in [False, True]:
@@ -341,65 +442,60 @@ def general(spec, lines, min_ampl=300.,
             tot_list = vstack([line_lists,unknwns])
         else:
             tot_list = line_lists
-        wvdata = np.array(tot_list['wave'].data)  # Removes mask if any
-        wvdata.sort()
-
-        sav_nmatch = best_dict['nmatch']
+        wvdata = index.wvdata[unknown]
 
         # Loop on pix_tol
         for pix_tol in [1.]:#, 2.]:
-            # Triangle pattern matching
-            dindex, lindex, wvcen, disps = triangles(use_tcent, wvdata, npix, 5, 10, pix_tol)
-
+            # Triangle pattern matching;  all of the matches are needed at once
+            # (see the Notes above)
+            dindex, lindex, wvcen, disps = index.triangles(use_tcent, npix, unknown, 5, pix_tol,
+                                                           nthreads=nthreads)
             # Remove any invalid results
             ww = np.where((wvcen > 0.0) & (disps > 0.0))
             dindex = dindex[ww[0], :]
             lindex = lindex[ww[0], :]
-            disps = disps[ww]
             wvcen = wvcen[ww]
+            disps = disps[ww]
 
-            # Setup the grids and histogram
+            # Setup the grids and vote, coarse to fine
             binw = np.linspace(max(np.min(wvcen), np.min(wvdata)), min(np.max(wvcen), np.max(wvdata)), ngrid)
             bind = np.linspace(np.min(np.log10(disps)), np.max(np.log10(disps)), ngrid)
-            histimg, xed, yed = np.histogram2d(wvcen, np.log10(disps), bins=[binw, bind])
-            histimg = gaussian_filter(histimg, 3)
-
-            # Find the best combination of central wavelength and dispersion
-            bidx = np.unravel_index(np.argmax(histimg), histimg.shape)
-
-            debug = False
-            if debug:
-                from matplotlib import pyplot as plt
-                plt.clf()
-                plt.imshow(histimg[:, ::-1].T, extent=[binw[0], binw[-1], bind[0], bind[-1]], aspect='auto')
-                plt.axvline(binw[bidx[0]], color='r', linestyle='--')
-                plt.axhline(bind[bidx[1]], color='r', linestyle='--')
-                plt.show()
-                print(histimg[bidx], binw[bidx[0]], 10.0**bind[bidx[1]])
-                pdb.set_trace()
-
-            # Find all good solutions
-            nsel = 5  # Select all solutions around the best solution within a square of side 2*nsel
-            wlo = binw[bidx[0] - nsel]
-            whi = binw[bidx[0] + nsel]
-            dlo = 10.0 ** bind[bidx[1] - 5*nsel]
-            dhi = 10.0 ** bind[bidx[1] + 5*nsel]
-            wgd = np.where((wvcen > wlo) & (wvcen < whi) & (disps > dlo) & (disps < dhi))
-            dindex = dindex[wgd[0], :].flatten()
-            lindex = lindex[wgd[0], :].flatten()
-
-            # Given this solution, fit for all detlines
-            arch_patt.solve_triangles(use_tcent, wvdata, dindex, lindex, best_dict)
-            if best_dict['nmatch'] > sav_nmatch:
-                best_dict['pix_tol'] = pix_tol
+            votes = vote_solutions(wvcen, np.log10(disps), binw, bind, ncoarse=ncoarse,
+                                   ncand=ncand)
+
+            # Solve each candidate combination of central wavelength and dispersion
+            for bidx, nvote in votes:
+                # Find all good solutions
+                nsel = 5  # Select all solutions around the best solution within a square of side 2*nsel
+                wlo, whi = _grid_window(binw, bidx[0], nsel)
+                dlo, dhi = 10.0 ** _grid_window(bind, bidx[1], 5*nsel)
+                wgd = np.where((wvcen > wlo) & (wvcen < whi) & (disps > dlo) & (disps < dhi))
+                cand_dict = dict(nmatch=0, bwv=binw[bidx[0]], bdisp=10.0**bind[bidx[1]],
+                                 votes=nvote, unknown=unknown, pix_tol=pix_tol)
+                # Given this solution, fit for all detlines
+                arch_patt.solve_triangles(use_tcent, wvdata, dindex[wgd[0], :].flatten(),
+                                          lindex[wgd[0], :].flatten(), cand_dict)
+                # And judge it by a quick fit to its NIST matches
+                _fit_candidate(use_tcent, npix, cand_dict, good_wave)
+                candidates.append(cand_dict)
+                lists.append(tot_list)
+
+    # Rank the candidates;  the best one is the solution
+    irank = _rank_candidates(candidates)
+    best_dict['candidates'] = [candidates[ii] for ii in irank]
+
+    if (len(candidates) == 0) or (best_dict['candidates'][0]['nmatch'] == 0):
+        print('---------------------------------------------------')
+        print('Report:')
+        print('::   No matches! Try another algorithm')
+        print('---------------------------------------------------')
+        return
 
-        # Save linelist?
-        if best_dict['nmatch'] > sav_nmatch:
-            best_dict['bwv'] = binw[bidx[0]]
-            best_dict['bdisp'] = 10.0**bind[bidx[1]]
-            best_dict['line_list'] = tot_list.copy()
-            best_dict['unknown'] = unknown
-            best_dict['ampl'] = unknown
+    bcand = best_dict['candidates'][0]
+    for key in ['mask', 'nmatch', 'scores', 'IDs', 'pix_tol', 'bwv', 'bdisp', 'unknown']:
+        best_dict[key] = bcand[key]
+    best_dict['line_list'] = lists[irank[0]].copy()
+    best_dict['ampl'] = bcand['unknown']
 
     # Try to pick up some extras by turning off/on unknowns
     if best_dict['unknown']:
@@ -411,13 +507,6 @@ def general(spec, lines, min_ampl=300.,
     wvdata = np.array(tot_list['wave'].data)  # Removes mask if any
     wvdata.sort()
 
-    if best_dict['nmatch'] == 0:
-        print('---------------------------------------------------')
-        print('Report:')
-        print('::   No matches! Try another algorithm')
-        print('---------------------------------------------------')
-        return
-
     # Report
     print('---------------------------------------------------')
     print('Report:')
@@ -456,18 +545,14 @@ def general(spec, lines, min_ampl=300.,
         else:
             plot_fil = None
         # Purge UNKNOWNS from ifit
-        imsk = np.array([True]*len(ifit))
-        for kk, idwv in enumerate(np.array(best_dict['IDs'])[ifit]):
-            if np.min(np.abs(line_lists['wave'][good_lines]-idwv)) > 0.01:
-                imsk[kk] = False
+        _, dwv = arcl_match.nearest(line_lists['wave'][good_lines], np.array(best_dict['IDs'])[ifit])
+        imsk = ~(dwv > 0.01)
         ifit = ifit[imsk]
         # Allow for weaker lines in the fit
         all_tcent, weak_cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=lowest_ampl)
         use_weak_tcent = all_tcent.copy()
-        add_weak = []
-        for weak in use_weak_tcent:
-            if np.min(np.abs(use_tcent-weak)) > 5.:
-                add_weak += [weak]
+        _, dpix = arcl_match.nearest(use_tcent, use_weak_tcent)
+        add_weak = use_weak_tcent[dpix > 5.]
         if len(add_weak) > 0:
             use_tcent = np.concatenate([use_tcent, np.array(add_weak)])
         # Fit
@@ -480,3 +565,263 @@ def general(spec, lines, min_ampl=300.,
 
     # Return
     return best_dict, final_fit
+
+
+def _grid_window(grid, idx, nsel):
+    """ Grid values nsel points either side of grid[idx], clipped to the grid
+    """
+    return np.array([grid[max(idx-nsel, 0)], grid[min(idx+nsel, grid.size-1)]])
+
+
+def _fit_candidate(tcent, npix, cand_dict, good_wave, order=3, sigma=3.):
+    """ Quick robust fit to the NIST (or OH) lines matched by a candidate
+
+    Parameters
+    ----------
+    tcent : ndarray
+      Detected lines
+    npix : int
+    cand_dict : dict
+      Candidate from solve_triangles();  nfit and rms (pixels) are added to it
+    good_wave : ndarray
+      Wavelengths of the good lines
+    order : int, optional
+    sigma : float, optional
+    """
+    cand_dict['nfit'], cand_dict['rms'] = 0, np.inf
+    if cand_dict['nmatch'] == 0:
+        return
+    ifit = np.where(cand_dict['mask'])[0]
+    IDs = np.array(cand_dict['IDs'])[ifit]
+    _, dwv = arcl_match.nearest(good_wave, IDs)
+    gd = ~(dwv > 0.01)
+    if np.sum(gd) <= order+1:
+        return
+    xfit, yfit = tcent[ifit[gd]]/(npix-1), IDs[gd]
+    mask, fit = robust_polyfit(xfit, yfit, order, function='legendre', sigma=sigma,
+                               minv=0., maxv=1.)
+    cand_dict['nfit'] = int(np.sum(mask == 0))
+    cand_dict['rms'] = calc_fit_rms(xfit[mask == 0], yfit[mask == 0], fit, 'legendre',
+                                    minv=0., maxv=1.) / cand_dict['bdisp']
+
+
+def _rank_candidates(candidates, min_nfit=8, max_rms=1.):
+    """ Order the candidates, best first
+
+    A candidate whose quick fit (see _fit_candidate()) kept at least min_nfit
+    lines with an RMS under max_rms pixels beats any that did not, however
+    many matches those have;  a wrong solution can match more lines than the
+    right one.  Within each group they are ranked by their number of
+    matches, and ties keep the order of the input.
+
+    Parameters
+    ----------
+    candidates : list of dict
+    min_nfit : int, optional
+    max_rms : float, optional
+
+    Returns
+    -------
+    irank : list
+      Indices of the candidates, best first
+    """
+    def rank_key(ii):
+        cand = candidates[ii]
+        good = (cand['nfit'] >= min_nfit) and (cand['rms'] < max_rms)
+        return (not good, -cand['nmatch'])
+    return sorted(range(len(candidates)), key=rank_key)
+
+
+def vote_solutions(wvcen, ldisps, binw, bind, ncoarse=10, ncand=3, sigma=3.):
+    """ Most popular (central wavelength, log dispersion) of the triangle solutions
+
+    The smoothed 2D histogram on the (binw, bind) grid is only made around
+    the ncand highest peaks of a coarse histogram, with cells of ncoarse
+    by ncoarse grid points.  Its values there are the same as for the full
+    histogram smoothed with gaussian_filter(histimg, sigma).
+
+    Parameters
+    ----------
+    wvcen : ndarray
+    ldisps : ndarray
+      log10 of the dispersions
+    binw, bind : ndarray
+      Bin edges
+    ncoarse : int, optional
+    ncand : int, optional
+    sigma : float, optional
+      Smoothing, in grid points
+
+    Returns
+    -------
+    votes : list
+      (bidx, value) of each candidate, best first;  bidx indexes the full grid
+    """
+    from scipy.ndimage import maximum_filter
+    nbin = (binw.size-1, bind.size-1)
+    # Coarse
+    cedges = [np.unique(np.append(np.arange(0, nb, ncoarse), nb)) for nb in nbin]
+    chist, _, _ = np.histogram2d(wvcen, ldisps, bins=[binw[cedges[0]], bind[cedges[1]]])
+    chist = gaussian_filter(chist, sigma/ncoarse)
+    cpeaks = np.where((chist == maximum_filter(chist, size=3)) & (chist > 0.))
+    isort = np.argsort(-chist[cpeaks], kind='mergesort')[:ncand]
+    # Fine, around each coarse peak (+/- one cell);  padded for the smoothing
+    pad = int(4*sigma+0.5) + 2
+    votes = []
+    for ci, cj in zip(cpeaks[0][isort], cpeaks[1][isort]):
+        srch = [(cedges[0][max(ci-1, 0)], cedges[0][min(ci+2, cedges[0].size-1)]),
+                (cedges[1][max(cj-1, 0)], cedges[1][min(cj+2, cedges[1].size-1)])]
+        win = [(max(s0-pad, 0), min(s1+pad, nb)) for (s0, s1), nb in zip(srch, nbin)]
+        fhist, _, _ = np.histogram2d(wvcen, ldisps, bins=[binw[win[0][0]:win[0][1]+1],
+                                                          bind[win[1][0]:win[1][1]+1]])
+        fhist = gaussian_filter(fhist, sigma)
+        fhist = fhist[srch[0][0]-win[0][0]:srch[0][1]-win[0][0],
+                      srch[1][0]-win[1][0]:srch[1][1]-win[1][0]]
+        fidx = np.unravel_index(np.argmax(fhist), fhist.shape)
+        bidx = (fidx[0]+srch[0][0], fidx[1]+srch[1][0])
+        if bidx not in [vote[0] for vote in votes]:
+            votes.append((bidx, fhist[fidx]))
+    # Best first
+    return [votes[ii] for ii in np.argsort([-vote[1] for vote in votes], kind='mergesort')]
+
+
+def batch_general(specs, lines, nproc=1, index=None, **kwargs):
+    """ general() for a set of spectra, e.g. all slits of a mask
+
+    Parameters
+    ----------
+    specs : ndarray (nslit, npix) or list of ndarray
+    lines : list
+      List of arc lamps on
+    nproc : int, optional
+      Number of processes to calibrate the slits with
+    index : LinePatternIndex, optional
+      Built once here if not provided
+    **kwargs :
+      Passed to general()
+
+    Returns
+    -------
+    results : list
+      (best_dict, final_fit) for each slit;  see _batch_slit()
+    """
+    if index is None:
+        index = arch_patt.LinePatternIndex(lines)
+    return _run_batch('general', specs, (lines,), kwargs, index, nproc, False)
+
+
+def batch_semi_brute(specs, lines, wv_cen, disp, nproc=1, use_prior=False,
+                     index=None, **kwargs):
+    """ semi_brute() for a set of spectra, e.g. all slits of a mask
+
+    Parameters
+    ----------
+    specs : ndarray (nslit, npix) or list of ndarray
+    lines : list
+      List of arc lamps on
+    wv_cen : float
+      Guess at central wavelength
+    disp : float
+      Dispersion A/pix
+    nproc : int, optional
+      Number of processes to calibrate the slits with
+    use_prior : bool, optional
+      Start each slit from the solution of the previous one
+      (its central wavelength and, as prior_fit, its fit).
+      The slits are then run in turn
+    index : LinePatternIndex, optional
+      Built once here if not provided
+    **kwargs :
+      Passed to semi_brute()
+
+    Returns
+    -------
+    results : list
+      (best_dict, final_fit) for each slit;  see _batch_slit()
+    """
+    if index is None:
+        index = arch_patt.LinePatternIndex(lines)
+    return _run_batch('semi_brute', specs, (lines, wv_cen, disp), kwargs, index,
+                      nproc, use_prior)
+
+
+def _run_batch(algorithm, specs, args, kwargs, index, nproc, use_prior):
+    """ Calibrate a set of spectra with one of the algorithms above
+    """
+    specs = [np.asarray(spec) for spec in specs]
+    # Warm the line list cache (a copy goes to each process)
+    arcl_io.load_line_lists(index.lines)
+    arcl_io.load_unknown_list(index.lines)
+    if use_prior:
+        # Each slit needs the previous one
+        results = []
+        args, kwargs = list(args), dict(kwargs)
+        for spec in specs:
+            results.append(_batch_slit(algorithm, spec, tuple(args), kwargs, index))
+            if results[-1][0]['status'] == 'ok':
+                args[1] = results[-1][0]['bwv']
+                if results[-1][1] is not None:
+                    kwargs['prior_fit'] = results[-1][1]
+        return results
+    tasks = [(algorithm, spec, args, kwargs) for spec in specs]
+    if nproc > 1:
+        import multiprocessing
+        # spawn, as forking once the numba thread pool is running can hang;
+        # Python 2 can only fork
+        if hasattr(multiprocessing, 'get_context'):
+            pool = multiprocessing.get_context('spawn').Pool(
+                processes=nproc, initializer=_batch_init, initargs=(index,))
+        else:
+            pool = multiprocessing.Pool(processes=nproc, initializer=_batch_init,
+                                        initargs=(index,))
+        try:
+            return pool.map(_batch_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    _batch_init(index)
+    return [_batch_task(task) for task in tasks]
+
+
+_batch_index = None
+
+
+def _batch_init(index):
+    """ Hand the LinePatternIndex to a (worker) process
+    """
+    global _batch_index
+    _batch_index = index
+
+
+def _batch_task(task):
+    algorithm, spec, args, kwargs = task
+    return _batch_slit(algorithm, spec, args, kwargs, _batch_index)
+
+
+def _batch_slit(algorithm, spec, args, kwargs, index):
+    """ Calibrate one slit of a batch
+
+    Returns
+    -------
+    best_dict : dict
+      As returned by the algorithm, plus
+        status -- 'ok', 'no_match' or 'error'
+        time -- seconds taken
+      Only status, time (and error) if the algorithm did not return a solution
+    final_fit : dict or None
+    """
+    func = dict(general=general, semi_brute=semi_brute)[algorithm]
+    tstart = time.time()
+    try:
+        out = func(spec, *args, index=index, **kwargs)
+    except Exception as err:
+        print("Slit failed with {:s}: {}".format(err.__class__.__name__, err))
+        best_dict = dict(status='error', error='{:s}: {}'.format(err.__class__.__name__, err))
+        out = best_dict, None
+    else:
+        if out is None:
+            out = dict(status='no_match'), None
+        else:
+            out[0]['status'] = 'ok'
+    out[0]['time'] = time.time()-tstart
+    return out
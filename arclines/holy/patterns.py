@@ -8,6 +8,36 @@ import numba as nb
 import pdb
 
 
+class QuadScore(object):
+    """ Integer codes for the quad_match scores
+    Ordered from worst to best;  quad_labels[code] is the label
+    """
+    NONE = 0
+    AMB = 1
+    RISK = 2
+    OK = 3
+    GOOD = 4
+    PERF = 5
+
+
+class TriangleScore(object):
+    """ Integer codes for the triangle scores
+    Ordered from worst to best;  triangle_labels[code] is the label
+    """
+    NONE = 0
+    AMBITIOUS = 1
+    RISKY = 2
+    OK = 3
+    GOOD = 4
+    VERY_GOOD = 5
+    PERFECT = 6
+
+
+# Labels used by score_quad_matches and score_triangles
+quad_labels = ['None', 'Amb', 'Risk', 'OK', 'Good', 'Perf']
+triangle_labels = ['None', 'Ambitious', 'Risky', 'OK', 'Good', 'Very Good', 'Perfect']
+
+
 def match_quad_to_list(spec_lines, line_list, wv_guess, dwv_guess,
                   tol=2., dwv_uncertainty=0.2, min_ftol=0.005):
     """
@@ -71,7 +101,7 @@ def run_quad_match(tcent, twave, llist_wv, disp, swv_uncertainty=250., pix_tol=1
     twave : ndarray
       Crude guess at wavelength solution, e.g. from wvcen, disp
     llist_wv : ndarray
-      Lines to match against (from a line list)
+      Lines to match against (from a line list);  sorted, increasing
     pix_tol : float
       Tolerance in units of pixels to match to
 
@@ -82,40 +112,177 @@ def run_quad_match(tcent, twave, llist_wv, disp, swv_uncertainty=250., pix_tol=1
     scores : ndarray
       str array of scores
     """
+    # Match
+    didx, lidx = quad_match_table(tcent, twave, llist_wv, disp,
+                                  swv_uncertainty=swv_uncertainty, pix_tol=pix_tol)
+    # Repackage
+    match_idx = match_table_to_dict(didx, lidx, tcent.size)
+    # Score
+    codes, _ = score_quad_table(didx, lidx, tcent.size)
+    scores = np.array(quad_labels)[codes]
 
-    # Init
-    nlin = tcent.size
+    # Return
+    return match_idx, scores
+
+
+def match_table_to_dict(didx, lidx, ndet):
+    """ Convert a (detection, line) match table to the match_idx dict
+
+    Parameters
+    ----------
+    didx : ndarray
+    lidx : ndarray
+    ndet : int
+      Number of detected lines
+
+    Returns
+    -------
+    match_idx : dict
+    """
     match_idx = {}
-    for ii in range(nlin):
+    for ii in range(ndet):
         match_idx[ii] = {}
         match_idx[ii]['matches'] = []
+    for dd, ll in zip(didx.tolist(), lidx.tolist()):
+        match_idx[dd]['matches'].append(ll)
+    return match_idx
+
+
+def quad_match_table(tcent, twave, llist_wv, disp, swv_uncertainty=250., pix_tol=1.,
+                     dwv_uncertainty=0.2, min_ftol=0.005):
+    """ Match every quad of detected lines to the line list
+    Same quads and matches as looping match_quad_to_list over
+    5-line windows of tcent, but run in a compiled kernel
 
-    # Run -- quad
+    Parameters
+    ----------
+    tcent : ndarray
+      Pixel positions of arc lines
+    twave : ndarray
+      Crude guess at wavelength solution, e.g. from wvcen, disp
+    llist_wv : ndarray
+      Lines to match against (from a line list);  sorted, increasing
+    disp : float
+    swv_uncertainty : float, optional
+    pix_tol : float, optional
+
+    Returns
+    -------
+    didx : ndarray
+      Index of the detected line for each match
+    lidx : ndarray
+      Index into llist_wv for each match
+    """
+    tcent = np.asarray(tcent, dtype=float)
+    nlin = tcent.size
+    if nlin < 5:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # Starting wavelength windows
+    widx = np.round(tcent[:nlin-4]).astype(int)
+    wvmin = twave[widx]-swv_uncertainty
+    wvmax = twave[widx]+swv_uncertainty
+    # Run
+    return _quad_match(tcent, wvmin.astype(float), wvmax.astype(float),
+                       np.asarray(llist_wv, dtype=float), float(disp), float(pix_tol),
+                       float(dwv_uncertainty), float(min_ftol))
+
+
+@nb.jit(nopython=True, cache=True)
+def _quad_match(tcent, wvmin, wvmax, line_list, dwv_guess, tol, dwv_uncertainty, min_ftol):
+    """ Compiled kernel for quad_match_table
+
+    Returns
+    -------
+    didx : ndarray
+    lidx : ndarray
+    """
+    nlin = tcent.size
+    nbuf = 1024
+    didx = np.zeros(nbuf, dtype=np.int64)
+    lidx = np.zeros(nbuf, dtype=np.int64)
+    sidx = np.zeros(4, dtype=np.int64)
+    match = np.zeros(4, dtype=np.int64)
+    nmatch = 0
     for idx in range(nlin-4):
+        # Possible starts
+        s0 = np.searchsorted(line_list, wvmin[idx], side='right')
+        s1 = np.searchsorted(line_list, wvmax[idx], side='left')
         for jj in range(4):
-            sub_idx = idx + np.arange(5).astype(int)
-            msk = np.array([True]*5)
-            msk[jj+1] = False
-            # Setup
-            sidx = sub_idx[msk]
-            spec_lines = np.array(tcent)[sidx]
-            #
-            widx = int(np.round(tcent[idx]))
-            wvmnx = [twave[widx]-swv_uncertainty, twave[widx]+swv_uncertainty]
-            # Run
-            #import pdb; pdb.set_trace()
-            matches = match_quad_to_list(spec_lines, llist_wv, wvmnx, disp, tol=pix_tol)
-            # Save
-            for match in matches:
-                for ii in range(4):
-                    match_idx[sidx[ii]]['matches'].append(match[ii])
-            #pdb.set_trace()
-    # Score
-    scores = score_quad_matches(match_idx)
-    scores = np.array(scores)
+            # Drop one of the middle lines
+            kk = 0
+            for ii in range(5):
+                if ii != jj+1:
+                    sidx[kk] = idx+ii
+                    kk += 1
+            npix = tcent[sidx[3]]-tcent[sidx[0]]
+            spec0 = (tcent[sidx[1]]-tcent[sidx[0]])/(tcent[sidx[3]]-tcent[sidx[0]])
+            spec1 = (tcent[sidx[2]]-tcent[sidx[0]])/(tcent[sidx[3]]-tcent[sidx[0]])
+            ftol = max(tol/npix, min_ftol)
+            for start in range(s0, s1):
+                # Possible ends
+                e0 = np.searchsorted(line_list, line_list[start] + npix*dwv_guess*(1-dwv_uncertainty),
+                                     side='right')
+                e1 = np.searchsorted(line_list, line_list[start] + npix*dwv_guess*(1+dwv_uncertainty),
+                                     side='left')
+                for end in range(e0, e1):
+                    # Best middle lines
+                    i0, diff0 = _nearest_ratio(line_list, start, end, spec0)
+                    i1, diff1 = _nearest_ratio(line_list, start, end, spec1)
+                    if (diff0 < ftol) and (diff1 < ftol):
+                        # Grow the buffers?
+                        if nmatch+4 > didx.size:
+                            tmp = np.zeros(2*didx.size, dtype=np.int64)
+                            tmp[:nmatch] = didx[:nmatch]
+                            didx = tmp
+                            tmp = np.zeros(2*lidx.size, dtype=np.int64)
+                            tmp[:nmatch] = lidx[:nmatch]
+                            lidx = tmp
+                        match[0], match[1], match[2], match[3] = start, i0, i1, end
+                        for ii in range(4):
+                            didx[nmatch] = sidx[ii]
+                            lidx[nmatch] = match[ii]
+                            nmatch += 1
+    return didx[:nmatch], lidx[:nmatch]
 
-    # Return
-    return match_idx, scores
+
+@nb.jit(nopython=True, cache=True)
+def _nearest_ratio(line_list, start, end, target):
+    """ First line start < kk < end minimizing
+    |(line_list[kk]-line_list[start])/(line_list[end]-line_list[start]) - target|
+    The ratios are non-decreasing in kk, so this is a binary search
+    that returns the same line as a linear scan
+
+    Returns
+    -------
+    kk : int
+      -1 if there are no lines between start and end
+    diff : float
+    """
+    if end - start < 2:
+        return -1, np.inf
+    span = line_list[end]-line_list[start]
+    # First line with ratio >= target
+    lo, hi = start+1, end
+    while lo < hi:
+        mid = (lo+hi) // 2
+        if (line_list[mid]-line_list[start]) / span < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    dl, dr = np.inf, np.inf
+    if lo > start+1:
+        dl = abs((line_list[lo-1]-line_list[start]) / span - target)
+    if lo < end:
+        dr = abs((line_list[lo]-line_list[start]) / span - target)
+    if dr < dl:
+        return lo, dr
+    if dl == np.inf:
+        return -1, np.inf
+    # Earliest line with the same difference
+    kk = lo-1
+    while (kk > start+1) and (abs((line_list[kk-1]-line_list[start]) / span - target) == dl):
+        kk -= 1
+    return kk, dl
 
 
 def scan_for_matches(wvcen, disp, npix, cut_tcent, wvdata, best_dict=None,
@@ -153,28 +320,20 @@ def scan_for_matches(wvcen, disp, npix, cut_tcent, wvdata, best_dict=None,
     for ss,iwv_cen in enumerate(wvcens):
         # Wavelength array
         wave = iwv_cen + (np.arange(npix) - npix/2.)*disp
-        match_idx, scores = run_quad_match(cut_tcent, wave, wvdata, disp,
-                                           swv_uncertainty=swv_uncertainty,
-                                           pix_tol=pix_tol)
+        didx, lidx = quad_match_table(cut_tcent, wave, wvdata, disp,
+                                      swv_uncertainty=swv_uncertainty,
+                                      pix_tol=pix_tol)
         # Score
-        mask = np.array([False]*len(cut_tcent))
-        IDs = []
-        for kk,score in enumerate(scores):
-            if score in ['Perf', 'Good', 'Ok']:
-                mask[kk] = True
-                uni, counts = np.unique(match_idx[kk]['matches'], return_counts=True)
-                imx = np.argmax(counts)
-                IDs.append(wvdata[uni[imx]])
-            else:
-                IDs.append(0.)
+        codes, best = score_quad_table(didx, lidx, cut_tcent.size)
+        mask = codes >= QuadScore.GOOD
+        IDs = np.where(mask, wvdata[np.maximum(best, 0)], 0.).tolist()
         ngd_match = np.sum(mask)
-        #import pdb; pdb.set_trace()
         # Update in place
         if ngd_match > best_dict['nmatch']:
             best_dict['nmatch'] = ngd_match
-            best_dict['midx'] = match_idx
+            best_dict['midx'] = match_table_to_dict(didx, lidx, cut_tcent.size)
             best_dict['mask'] = mask
-            best_dict['scores'] = scores
+            best_dict['scores'] = np.array(quad_labels)[codes]
             best_dict['ibest'] = ss
             best_dict['bwv'] = iwv_cen
             best_dict['IDs'] = IDs
@@ -185,6 +344,66 @@ def scan_for_matches(wvcen, disp, npix, cut_tcent, wvdata, best_dict=None,
             best_dict['ampl'] = ampl
 
 
+def match_to_prior(cut_tcent, prior_fit, wvdata, disp, pix_tol=2., max_shift=50.,
+                   step=0.25):
+    """ Identify lines with a known wavelength solution
+
+    The solution is first shifted (in pixels) to match the most lines,
+    i.e. a cross-correlation of the detections with the line list;
+    ties go to the smallest summed offset of the matches.
+
+    Parameters
+    ----------
+    cut_tcent : ndarray
+      Detected lines
+    prior_fit : dict
+      final_fit from iterative_fitting
+    wvdata : ndarray
+      Sorted line list
+    disp : float
+    pix_tol : float, optional
+      Tolerance for a match in pixels
+    max_shift : float, optional
+      Largest shift searched, in pixels
+    step : float, optional
+
+    Returns
+    -------
+    best_dict : dict
+      As filled by scan_for_matches, with the matches scored 'Good',
+      plus the shift
+    """
+    from arclines.utils import func_val
+    from arclines import match as arcl_match
+    tol = pix_tol*disp
+    shifts = np.arange(-max_shift, max_shift+step/2., step)
+    # Wavelengths of the shifted lines
+    xnorm = prior_fit['xnorm'] - 1.
+    twave = func_val(prior_fit['fitc'], (cut_tcent[None, :]+shifts[:, None])/xnorm,
+                     prior_fit['function'], minv=prior_fit['fmin'], maxv=prior_fit['fmax'])
+    imn, dwv = arcl_match.nearest(wvdata, twave.flatten())
+    imn, dwv = imn.reshape(twave.shape), dwv.reshape(twave.shape)
+    inrange = dwv < tol
+    nmtch = np.sum(inrange, axis=1)
+    resid = np.sum(np.where(inrange, dwv, 0.), axis=1)
+    ibest = np.lexsort((np.abs(shifts), resid, -nmtch))[0]
+    # Matches
+    imn = imn[ibest]
+    mask = inrange[ibest]
+    didx = np.where(mask)[0]
+    lidx = imn[mask]
+    codes = np.where(mask, QuadScore.GOOD, QuadScore.NONE)
+    # Central wavelength
+    bwv = func_val(prior_fit['fitc'], (prior_fit['xnorm']/2.+shifts[ibest])/xnorm,
+                   prior_fit['function'], minv=prior_fit['fmin'], maxv=prior_fit['fmax'])
+    best_dict = dict(nmatch=int(np.sum(mask)), ibest=-1, bwv=float(bwv),
+                     midx=match_table_to_dict(didx, lidx, cut_tcent.size),
+                     mask=mask, scores=np.array(quad_labels)[codes],
+                     IDs=np.where(mask, wvdata[imn], 0.).tolist(),
+                     pix_tol=pix_tol, shift=shifts[ibest])
+    return best_dict
+
+
 def score_quad_matches(fidx):
     """  Grades quad_match results
     Parameters
@@ -228,9 +447,128 @@ def score_quad_matches(fidx):
     return scores
 
 
-@nb.jit(nopython=True, cache=True)
-def triangles(detlines, linelist, npixels, detsrch=5, lstsrch=10, pixtol=1.0):
+def match_counts(didx, lidx, ndet):
+    """ Per-detection statistics of a (detection, line) match table
+    One sort of the combined (detection, line) key, then reductions
+    over the detection groups
+
+    Parameters
+    ----------
+    didx : ndarray
+      Index of the detected line for each match
+    lidx : ndarray
+      Index of the line list entry for each match
+    ndet : int
+      Number of detected lines
+
+    Returns
+    -------
+    nmatch : ndarray (ndet)
+      Total number of matches
+    nuni : ndarray (ndet)
+      Number of unique lines matched
+    max_counts : ndarray (ndet)
+      Number of matches to the most frequent line
+    best : ndarray (ndet)
+      Index of the most frequent line (lowest index on a tie); -1 if none
+    """
+    nmatch = np.zeros(ndet, dtype=int)
+    nuni = np.zeros(ndet, dtype=int)
+    max_counts = np.zeros(ndet, dtype=int)
+    best = -1*np.ones(ndet, dtype=int)
+    if didx.size == 0:
+        return nmatch, nuni, max_counts, best
+    didx = np.asarray(didx).astype(np.int64)
+    lidx = np.asarray(lidx).astype(np.int64)
+    nline = int(lidx.max()) + 1
+    # Unique (detection, line) pairs, sorted by detection then line
+    ukey, counts = np.unique(didx*nline + lidx, return_counts=True)
+    ud, ul = ukey // nline, ukey % nline
+    # Detection groups
+    gstart = np.where(np.concatenate([[True], ud[1:] != ud[:-1]]))[0]
+    gdet = ud[gstart]
+    nmatch[gdet] = np.add.reduceat(counts, gstart)
+    nuni[gdet] = np.diff(np.append(gstart, ud.size))
+    gmax = np.maximum.reduceat(counts, gstart)
+    max_counts[gdet] = gmax
+    # Lowest line index with the max count
+    ismax = counts == np.repeat(gmax, np.diff(np.append(gstart, ud.size)))
+    best[gdet] = np.minimum.reduceat(np.where(ismax, ul, nline), gstart)
+    return nmatch, nuni, max_counts, best
+
+
+def score_quad_table(didx, lidx, ndet):
+    """ Vectorized score_quad_matches for a (detection, line) match table
+
+    Parameters
+    ----------
+    didx : ndarray
+    lidx : ndarray
+    ndet : int
+      Number of detected lines
+
+    Returns
+    -------
+    codes : ndarray
+      QuadScore values;  quad_labels[code] is the score_quad_matches label
+    best : ndarray
+      Index of the best line for each detection;  -1 if none
     """
+    nmatch, nuni, max_counts, best = match_counts(didx, lidx, ndet)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = max_counts/nmatch
+    # Same order of precedence as score_quad_matches
+    conds = [nmatch == 0,
+             (nuni == 1) & (nmatch >= 4),
+             (max_counts == 4) & (nmatch == 5),
+             (frac >= 2./3) & (nmatch >= 6),
+             (nuni == 1) & (nmatch == 3),
+             (max_counts == 3) & (nmatch == 4),
+             (nuni == 1) & (nmatch == 2)]
+    choices = [QuadScore.NONE, QuadScore.PERF, QuadScore.GOOD, QuadScore.GOOD,
+               QuadScore.GOOD, QuadScore.OK, QuadScore.RISK]
+    codes = np.select(conds, choices, default=QuadScore.AMB)
+    return codes, best
+
+
+def score_triangle_table(didx, lidx, ndet):
+    """ Vectorized score_triangles for a (detection, line) match table
+
+    Parameters
+    ----------
+    didx : ndarray
+    lidx : ndarray
+    ndet : int
+      Number of detected lines
+
+    Returns
+    -------
+    codes : ndarray
+      TriangleScore values;  triangle_labels[code] is the score_triangles label
+    best : ndarray
+      Index of the best line for each detection;  -1 if none
+    """
+    nmatch, nuni, max_counts, best = match_counts(didx, lidx, ndet)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = nmatch/max_counts
+    # Same order of precedence as score_triangles
+    conds = [nmatch == 0,
+             (nuni == 1) & (max_counts >= 4),
+             ratio >= 0.8,
+             ratio >= 0.65,
+             ratio >= 0.5,
+             ratio >= 0.3]
+    choices = [TriangleScore.NONE, TriangleScore.PERFECT, TriangleScore.VERY_GOOD,
+               TriangleScore.GOOD, TriangleScore.OK, TriangleScore.RISKY]
+    codes = np.select(conds, choices, default=TriangleScore.AMBITIOUS)
+    return codes, best
+
+
+def triangles(detlines, linelist, npixels, detsrch=5, lstsrch=10, pixtol=1.0,
+              nthreads=None):
+    """ Triangle pattern matching of detected lines to a line list
+    Only the matched patterns are returned
+
     Parameters
     ----------
     detlines : ndarray
@@ -245,12 +583,15 @@ def triangles(detlines, linelist, npixels, detsrch=5, lstsrch=10, pixtol=1.0):
       Number of consecutive elements in linelist to use to create a pattern (-1 means all lines in detlines)
     pixtol : float
       tolerance that is used to determine if a match is successful (in units of pixels)
+    nthreads : int, optional
+      Number of threads for the search;  None or 1 runs the serial kernel.
+      The output is identical (and in the same order) for any value
 
     Returns
     -------
-    dindex : ndarray
+    dindex : ndarray (nmatch, 3)
       Index array of all detlines used in each triangle
-    lindex : ndarray
+    lindex : ndarray (nmatch, 3)
       Index array of the assigned line to each index in dindex
     wvcen : ndarray
       central wavelength of each triangle
@@ -258,40 +599,91 @@ def triangles(detlines, linelist, npixels, detsrch=5, lstsrch=10, pixtol=1.0):
       Dispersion of each triangle (angstroms/pixel)
 
     """
+    detlines = np.asarray(detlines, dtype=float)
+    linelist = np.asarray(linelist, dtype=float)
+    return _run_triangles(detlines, linelist, float(npixels), detsrch, lstsrch,
+                          float(pixtol), 0, detlines.size, nthreads)
+
+
+def _run_triangles(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1, nthreads):
+    """ Dispatch to the serial or parallel triangles kernel
+    """
+    if (nthreads is None) or (nthreads <= 1):
+        return _triangles(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1)
+    # Parallel
+    sav_threads = nb.get_num_threads()
+    nb.set_num_threads(min(nthreads, nb.config.NUMBA_NUM_THREADS))
+    try:
+        # Count, then fill each starting detection at its offset
+        counts = _triangles_count(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1)
+        offsets = np.zeros(counts.size+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return _triangles_fill(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1,
+                               offsets)
+    finally:
+        nb.set_num_threads(sav_threads)
+
+
+def iter_triangles(detlines, linelist, npixels, detsrch=5, lstsrch=10, pixtol=1.0,
+                   nchunk=50, nthreads=None):
+    """ Generator version of triangles()
+    Yields the matches in chunks of starting detection index so that
+    the matches can be consumed without holding all of them in memory.
+    Not used by grail.general(), which needs all of them for its vote
+
+    Parameters
+    ----------
+    detlines : ndarray
+    linelist : ndarray
+    npixels : float
+    detsrch : int
+    lstsrch : int
+    pixtol : float
+      See triangles()
+    nchunk : int, optional
+      Number of starting detections per chunk
+    nthreads : int, optional
+      See triangles()
+
+    Returns
+    -------
+    Yields dindex, lindex, wvcen, disps for each chunk, in the order of triangles()
+    """
+    detlines = np.asarray(detlines, dtype=float)
+    linelist = np.asarray(linelist, dtype=float)
+    for d0 in range(0, detlines.size, nchunk):
+        d1 = min(d0+nchunk, detlines.size)
+        yield _run_triangles(detlines, linelist, float(npixels), detsrch, lstsrch,
+                             float(pixtol), d0, d1, nthreads)
+
 
+@nb.jit(nopython=True, cache=True)
+def _triangles(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1):
+    """ Compiled kernel for triangles
+    Loops over the starting detections d0 <= d < d1 and keeps only the
+    matched patterns in buffers that grow as needed
+
+    Returns
+    -------
+    dindex : ndarray
+    lindex : ndarray
+    wvcen : ndarray
+    disps : ndarray
+    """
     nptn = 3  # Number of lines used to create a pattern
 
     sz_d = detlines.size
     sz_l = linelist.size
 
-    # Count the number of detlines patterns that will be created
-    cntdet = 0
-    dup = 0
-    for d in range(detsrch-nptn+1):
-        dup += d+1
-        if d == detsrch-nptn:
-            cntdet += dup*(sz_d-detsrch+1)
-        else:
-            cntdet += dup
-
-    # Count the number of linelist patterns that will be created
-    cntlst = 0
-    lup = 0
-    for l in range(lstsrch-nptn+1):
-        lup += l+1
-        if l == lstsrch-nptn:
-            cntlst += lup*(sz_l-lstsrch+1)
-        else:
-            cntlst += lup
-
-    lindex = np.zeros((cntdet*cntlst, nptn), dtype=nb.types.uint64)
-    dindex = np.zeros((cntdet*cntlst, nptn), dtype=nb.types.uint64)
-    wvcen = np.zeros((cntdet*cntlst))
-    disps = np.zeros((cntdet*cntlst))
+    nbuf = 1024
+    lindex = np.zeros((nbuf, nptn), dtype=np.int32)
+    dindex = np.zeros((nbuf, nptn), dtype=np.int32)
+    wvcen = np.zeros(nbuf)
+    disps = np.zeros(nbuf)
 
     # Test each detlines combination
-    cntdet = 0
-    for d in range(0, sz_d-nptn+1):
+    nmatch = 0
+    for d in range(d0, min(d1, sz_d-nptn+1)):
         dup = d + detsrch
         if dup > sz_d:
             dup = sz_d
@@ -316,16 +708,382 @@ def triangles(detlines, linelist, npixels, detsrch=5, lstsrch=10, pixtol=1.0):
                             if tst < 0.0:
                                 tst *= -1.0
                             if tst <= tol:
-                                lindex[cntdet, 0] = l
-                                lindex[cntdet, 1] = xl
-                                lindex[cntdet, 2] = ll
-                                dindex[cntdet, 0] = d
-                                dindex[cntdet, 1] = xd
-                                dindex[cntdet, 2] = dd
+                                # Grow the buffers?
+                                if nmatch == wvcen.size:
+                                    nbuf = 2*wvcen.size
+                                    tmpi = np.zeros((nbuf, nptn), dtype=np.int32)
+                                    tmpi[:nmatch] = lindex[:nmatch]
+                                    lindex = tmpi
+                                    tmpi = np.zeros((nbuf, nptn), dtype=np.int32)
+                                    tmpi[:nmatch] = dindex[:nmatch]
+                                    dindex = tmpi
+                                    tmpf = np.zeros(nbuf)
+                                    tmpf[:nmatch] = wvcen[:nmatch]
+                                    wvcen = tmpf
+                                    tmpf = np.zeros(nbuf)
+                                    tmpf[:nmatch] = disps[:nmatch]
+                                    disps = tmpf
+                                lindex[nmatch, 0] = l
+                                lindex[nmatch, 1] = xl
+                                lindex[nmatch, 2] = ll
+                                dindex[nmatch, 0] = d
+                                dindex[nmatch, 1] = xd
+                                dindex[nmatch, 2] = dd
                                 tst = (linelist[ll]-linelist[l]) / (detlines[dd]-detlines[d])
-                                wvcen[cntdet] = (npixels/2.0) * tst + (linelist[ll]-tst*detlines[dd])
-                                disps[cntdet] = tst
-                            cntdet += 1
+                                wvcen[nmatch] = (npixels/2.0) * tst + (linelist[ll]-tst*detlines[dd])
+                                disps[nmatch] = tst
+                                nmatch += 1
+    return dindex[:nmatch], lindex[:nmatch], wvcen[:nmatch], disps[:nmatch]
+
+
+@nb.jit(nopython=True, cache=True)
+def _triangles_one(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d,
+                   dindex, lindex, wvcen, disps, i0, fill):
+    """ Triangle matches for the single starting detection d
+    Written from row i0 when fill is True
+
+    Returns
+    -------
+    nmatch : int
+    """
+    nptn = 3
+    sz_d = detlines.size
+    sz_l = linelist.size
+    nmatch = 0
+    dup = d + detsrch
+    if dup > sz_d:
+        dup = sz_d
+    if detsrch == -1:
+        dup = sz_d
+    for dd in range(d+nptn-1, dup):
+        for xd in range(d+1, dd):
+            dval = (detlines[xd]-detlines[d])/(detlines[dd]-detlines[d])
+            tol = pixtol/(detlines[dd]-detlines[d])
+            for l in range(0, sz_l-nptn+1):
+                lup = l + lstsrch
+                if lup > sz_l:
+                    lup = sz_l
+                if lstsrch == -1:
+                    lup = sz_l
+                for ll in range(l+nptn-1, lup):
+                    for xl in range(l+1, ll):
+                        lval = (linelist[xl]-linelist[l])/(linelist[ll]-linelist[l])
+                        tst = lval-dval
+                        if tst < 0.0:
+                            tst *= -1.0
+                        if tst <= tol:
+                            if fill:
+                                ii = i0 + nmatch
+                                lindex[ii, 0] = l
+                                lindex[ii, 1] = xl
+                                lindex[ii, 2] = ll
+                                dindex[ii, 0] = d
+                                dindex[ii, 1] = xd
+                                dindex[ii, 2] = dd
+                                tst = (linelist[ll]-linelist[l]) / (detlines[dd]-detlines[d])
+                                wvcen[ii] = (npixels/2.0) * tst + (linelist[ll]-tst*detlines[dd])
+                                disps[ii] = tst
+                            nmatch += 1
+    return nmatch
+
+
+@nb.jit(nopython=True, cache=True, parallel=True)
+def _triangles_count(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1):
+    """ Number of triangle matches for each starting detection d0 <= d < d1
+    """
+    nptn = 3
+    d1 = min(d1, detlines.size-nptn+1)
+    counts = np.zeros(max(d1-d0, 0), dtype=np.int64)
+    empty_i = np.zeros((0, nptn), dtype=np.int32)
+    empty_f = np.zeros(0)
+    for jj in nb.prange(counts.size):
+        counts[jj] = _triangles_one(detlines, linelist, npixels, detsrch, lstsrch, pixtol,
+                                    d0+jj, empty_i, empty_i, empty_f, empty_f, 0, False)
+    return counts
+
+
+@nb.jit(nopython=True, cache=True, parallel=True)
+def _triangles_fill(detlines, linelist, npixels, detsrch, lstsrch, pixtol, d0, d1, offsets):
+    """ Fill the triangle matches for d0 <= d < d1 at the given row offsets
+    """
+    nptn = 3
+    nmatch = offsets[-1]
+    lindex = np.zeros((nmatch, nptn), dtype=np.int32)
+    dindex = np.zeros((nmatch, nptn), dtype=np.int32)
+    wvcen = np.zeros(nmatch)
+    disps = np.zeros(nmatch)
+    for jj in nb.prange(offsets.size-1):
+        _triangles_one(detlines, linelist, npixels, detsrch, lstsrch, pixtol,
+                       d0+jj, dindex, lindex, wvcen, disps, offsets[jj], True)
+    return dindex, lindex, wvcen, disps
+
+
+class LinePatternIndex(object):
+    """ Precomputed line list patterns for a set of arc lamps
+    Built once and reused for every spectrum taken with the same lamps
+
+    The line list triangles (within lstsrch consecutive lines) are sorted
+    by their ratio so that the patterns matching a detected triangle are
+    found by binary search.  Matches are returned in the same order as
+    triangles().  Quads span a dispersion-dependent number of lines, so
+    for those the index only holds the sorted line lists.
+
+    Parameters
+    ----------
+    lines : list
+      List of arc lamps on
+    lstsrch : int, optional
+      Number of consecutive elements in the line list to use to create a pattern
+    wvdata : dict, optional
+      Sorted line list wavelengths keyed by unknown (False/True)
+      Loaded from the line lists if not provided
+    """
+    def __init__(self, lines, lstsrch=10, wvdata=None):
+        from astropy.table import vstack
+        from arclines import io as arcl_io
+        self.lines = [str(line) for line in lines]
+        self.lstsrch = int(lstsrch)
+        if wvdata is None:
+            line_lists = arcl_io.load_line_lists(self.lines)
+            unknwns = arcl_io.load_unknown_list(self.lines)
+            wvdata = {}
+            for unknown in [False, True]:
+                if unknown:
+                    tot_list = vstack([line_lists, unknwns])
+                else:
+                    tot_list = line_lists
+                wvdata[unknown] = np.array(tot_list['wave'].data)  # Removes mask if any
+                wvdata[unknown].sort()
+        self.wvdata = {}
+        for unknown in [False, True]:
+            self.wvdata[unknown] = np.asarray(wvdata[unknown], dtype=float)
+        # Triangles
+        self.tables = {}
+        for unknown in [False, True]:
+            self.tables[unknown] = _build_triangle_table(self.wvdata[unknown], self.lstsrch)
+
+    def __repr__(self):
+        return ('<{:s}: lines={}, lstsrch={:d}, ntri={:d}/{:d}>'.format(
+            self.__class__.__name__, self.lines, self.lstsrch,
+            self.tables[False][0].size, self.tables[True][0].size))
+
+    def check_lines(self, lines):
+        """ Raise an IOError if the index was built for a different set of lamps
+        """
+        if [str(line) for line in lines] != self.lines:
+            raise IOError("LinePatternIndex was built for lines={}, not {}".format(
+                self.lines, list(lines)))
+
+    def triangles(self, detlines, npixels, unknown=False, detsrch=5, pixtol=1.0,
+                  nthreads=None):
+        """ Same as triangles() with the line list of the index
+
+        Parameters
+        ----------
+        detlines : ndarray
+          list of detected lines in pixels (sorted, increasing)
+        npixels : float
+        unknown : bool, optional
+          Include the UNKNWN lines
+        detsrch : int, optional
+        pixtol : float, optional
+        nthreads : int, optional
+
+        Returns
+        -------
+        dindex, lindex, wvcen, disps
+        """
+        detlines = np.asarray(detlines, dtype=float)
+        return self._run(detlines, float(npixels), unknown, detsrch, float(pixtol),
+                         0, detlines.size, nthreads)
+
+    def iter_triangles(self, detlines, npixels, unknown=False, detsrch=5, pixtol=1.0,
+                       nchunk=50, nthreads=None):
+        """ Same as iter_triangles() with the line list of the index
+        """
+        detlines = np.asarray(detlines, dtype=float)
+        for d0 in range(0, detlines.size, nchunk):
+            d1 = min(d0+nchunk, detlines.size)
+            yield self._run(detlines, float(npixels), unknown, detsrch, float(pixtol),
+                            d0, d1, nthreads)
+
+    def quad_match_table(self, tcent, twave, disp, unknown=True, **kwargs):
+        """ Same as quad_match_table() with the line list of the index
+        """
+        return quad_match_table(tcent, twave, self.wvdata[unknown], disp, **kwargs)
+
+    def _run(self, detlines, npixels, unknown, detsrch, pixtol, d0, d1, nthreads):
+        linelist = self.wvdata[unknown]
+        ratio, rid, ltrip = self.tables[unknown]
+        sav_threads = nb.get_num_threads()
+        if (nthreads is None) or (nthreads <= 1):
+            nb.set_num_threads(1)
+        else:
+            nb.set_num_threads(min(nthreads, nb.config.NUMBA_NUM_THREADS))
+        try:
+            counts = _index_count(detlines, linelist, ratio, rid, ltrip, npixels,
+                                  detsrch, pixtol, d0, d1)
+            offsets = np.zeros(counts.size+1, dtype=np.int64)
+            offsets[1:] = np.cumsum(counts)
+            return _index_fill(detlines, linelist, ratio, rid, ltrip, npixels,
+                               detsrch, pixtol, d0, d1, offsets)
+        finally:
+            nb.set_num_threads(sav_threads)
+
+    def write(self, outfile):
+        """ Write the index to an npz file
+
+        Parameters
+        ----------
+        outfile : str
+        """
+        tdict = dict(lines=np.array(self.lines), lstsrch=self.lstsrch)
+        for unknown in [False, True]:
+            sfx = '_{:d}'.format(int(unknown))
+            tdict['wvdata'+sfx] = self.wvdata[unknown]
+            for key, item in zip(['ratio', 'rid', 'ltrip'], self.tables[unknown]):
+                tdict[key+sfx] = item
+        np.savez(outfile, **tdict)
+        print("Wrote LinePatternIndex to {:s}".format(outfile))
+
+    @classmethod
+    def from_file(cls, infile):
+        """ Load an index written by write()
+
+        Parameters
+        ----------
+        infile : str
+
+        Returns
+        -------
+        LinePatternIndex
+        """
+        data = np.load(infile)
+        slf = cls.__new__(cls)
+        slf.lines = [str(line) for line in data['lines']]
+        slf.lstsrch = int(data['lstsrch'])
+        slf.wvdata = {}
+        slf.tables = {}
+        for unknown in [False, True]:
+            sfx = '_{:d}'.format(int(unknown))
+            slf.wvdata[unknown] = data['wvdata'+sfx]
+            slf.tables[unknown] = tuple([data[key+sfx] for key in ['ratio', 'rid', 'ltrip']])
+        return slf
+
+
+@nb.jit(nopython=True, cache=True)
+def _build_triangle_table(linelist, lstsrch):
+    """ All line list triangles of the triangles() search, sorted by ratio
+
+    Returns
+    -------
+    ratio : ndarray
+      Sorted ratios
+    rid : ndarray
+      Pattern number (in the triangles() loop order) of each ratio
+    ltrip : ndarray (npattern, 3)
+      Line indices of each pattern, in loop order
+    """
+    nptn = 3
+    sz_l = linelist.size
+    npattern = 0
+    for l in range(0, sz_l-nptn+1):
+        lup = l + lstsrch
+        if (lup > sz_l) or (lstsrch == -1):
+            lup = sz_l
+        for ll in range(l+nptn-1, lup):
+            npattern += ll - l - 1
+    ltrip = np.zeros((npattern, nptn), dtype=np.int32)
+    lval = np.zeros(npattern)
+    cnt = 0
+    for l in range(0, sz_l-nptn+1):
+        lup = l + lstsrch
+        if (lup > sz_l) or (lstsrch == -1):
+            lup = sz_l
+        for ll in range(l+nptn-1, lup):
+            for xl in range(l+1, ll):
+                lval[cnt] = (linelist[xl]-linelist[l])/(linelist[ll]-linelist[l])
+                ltrip[cnt, 0] = l
+                ltrip[cnt, 1] = xl
+                ltrip[cnt, 2] = ll
+                cnt += 1
+    rid = np.argsort(lval, kind='mergesort')
+    return lval[rid], rid, ltrip
+
+
+@nb.jit(nopython=True, cache=True)
+def _index_one(detlines, linelist, ratio, rid, ltrip, npixels, detsrch, pixtol, d,
+               dindex, lindex, wvcen, disps, i0, fill):
+    """ Indexed triangle matches for the single starting detection d
+    Written from row i0 when fill is True
+
+    Returns
+    -------
+    nmatch : int
+    """
+    nptn = 3
+    sz_d = detlines.size
+    nmatch = 0
+    dup = d + detsrch
+    if (dup > sz_d) or (detsrch == -1):
+        dup = sz_d
+    for dd in range(d+nptn-1, dup):
+        for xd in range(d+1, dd):
+            dval = (detlines[xd]-detlines[d])/(detlines[dd]-detlines[d])
+            tol = pixtol/(detlines[dd]-detlines[d])
+            # Candidates;  padded for round-off and then tested exactly
+            pad = 1e-12 + 1e-9*tol
+            k0 = np.searchsorted(ratio, dval-tol-pad, side='left')
+            k1 = np.searchsorted(ratio, dval+tol+pad, side='right')
+            ids = rid[k0:k1][np.abs(ratio[k0:k1]-dval) <= tol]
+            if ids.size == 0:
+                continue
+            if fill:
+                ids = np.sort(ids)  # Loop order
+                for kk in range(ids.size):
+                    ii = i0 + nmatch + kk
+                    l, ll = ltrip[ids[kk], 0], ltrip[ids[kk], 2]
+                    lindex[ii, 0] = l
+                    lindex[ii, 1] = ltrip[ids[kk], 1]
+                    lindex[ii, 2] = ll
+                    dindex[ii, 0] = d
+                    dindex[ii, 1] = xd
+                    dindex[ii, 2] = dd
+                    tst = (linelist[ll]-linelist[l]) / (detlines[dd]-detlines[d])
+                    wvcen[ii] = (npixels/2.0) * tst + (linelist[ll]-tst*detlines[dd])
+                    disps[ii] = tst
+            nmatch += ids.size
+    return nmatch
+
+
+@nb.jit(nopython=True, cache=True, parallel=True)
+def _index_count(detlines, linelist, ratio, rid, ltrip, npixels, detsrch, pixtol, d0, d1):
+    """ Number of indexed triangle matches for each starting detection d0 <= d < d1
+    """
+    nptn = 3
+    d1 = min(d1, detlines.size-nptn+1)
+    counts = np.zeros(max(d1-d0, 0), dtype=np.int64)
+    empty_i = np.zeros((0, nptn), dtype=np.int32)
+    empty_f = np.zeros(0)
+    for jj in nb.prange(counts.size):
+        counts[jj] = _index_one(detlines, linelist, ratio, rid, ltrip, npixels, detsrch, pixtol,
+                                d0+jj, empty_i, empty_i, empty_f, empty_f, 0, False)
+    return counts
+
+
+@nb.jit(nopython=True, cache=True, parallel=True)
+def _index_fill(detlines, linelist, ratio, rid, ltrip, npixels, detsrch, pixtol, d0, d1, offsets):
+    """ Fill the indexed triangle matches for d0 <= d < d1 at the given row offsets
+    """
+    nptn = 3
+    nmatch = offsets[-1]
+    lindex = np.zeros((nmatch, nptn), dtype=np.int32)
+    dindex = np.zeros((nmatch, nptn), dtype=np.int32)
+    wvcen = np.zeros(nmatch)
+    disps = np.zeros(nmatch)
+    for jj in nb.prange(offsets.size-1):
+        _index_one(detlines, linelist, ratio, rid, ltrip, npixels, detsrch, pixtol,
+                   d0+jj, dindex, lindex, wvcen, disps, offsets[jj], True)
     return dindex, lindex, wvcen, disps
 
 
@@ -354,21 +1112,11 @@ def solve_triangles(detlines, linelist, dindex, lindex, best_dict=None):
         best_dict = dict(nmatch=0, ibest=-1, bwv=0.)
 
     # Find the best ID of each line
-    detids = np.zeros(nlines)
-    scores = ['None' for xx in range(nlines)]
-    mask = np.zeros(nlines, dtype=np.bool)
-    ngd_match = 0
-    for dd in range(nlines):
-        ww = np.where(dindex == dd)
-        if ww[0].size == 0:
-            continue
-        unq, cnts = np.unique(lindex[ww], return_counts=True)
-        detids[dd] = linelist[unq[np.argmax(cnts)]]
-        scr = score_triangles(cnts)
-        scores[dd] = scr
-        if scr in ["Perfect", "Very Good", "Good", "OK"]:
-            mask[dd] = True
-            ngd_match += 1
+    codes, best = score_triangle_table(dindex, lindex, nlines)
+    detids = np.where(best >= 0, linelist[np.maximum(best, 0)], 0.)
+    scores = [triangle_labels[code] for code in codes]
+    mask = codes >= TriangleScore.OK
+    ngd_match = np.sum(mask)
 
     # Iteratively fit this solution, and ID all lines.
     if ngd_match > best_dict['nmatch']:
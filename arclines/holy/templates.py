@@ -0,0 +1,304 @@
+""" Module for solving arc spectra by cross-correlation with archived templates
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import numpy as np
+import glob
+import json
+import os
+import pdb
+
+import arclines
+from arclines import io as arcl_io
+from arclines import match as arcl_match
+from arclines.utils import func_val
+from arclines.holy import fitting as arch_fit
+from arclines.holy import utils as arch_utils
+
+template_path = arclines.__path__[0]+'/data/test_arcs/'
+
+# Templates already loaded in this process;  see load_templates()
+_template_cache = {}
+
+
+def mk_template(spec, final_fit, name, lines=None):
+    """ Template from a spectrum and its solution
+
+    Parameters
+    ----------
+    spec : ndarray
+    final_fit : dict
+      As from iterative_fitting() or in a PYPIT JSON file
+    name : str
+    lines : list, optional
+      Arc lamps;  taken from the ions of final_fit if not provided
+
+    Returns
+    -------
+    template : dict
+      name, lines, spec, fit, xIDs (pixels), IDs (wavelengths), ions (of
+      the IDs), wave, xcorr_spec (spec prepared for cross-correlation)
+    """
+    spec = np.asarray(spec, dtype=float)
+    fit = dict([(key, final_fit[key]) for key in ['fitc', 'function', 'fmin', 'fmax', 'xnorm']])
+    fit['fitc'] = np.asarray(fit['fitc'], dtype=float)
+    xnorm = fit['xnorm'] - 1.
+    if lines is None:
+        lines = sorted(set([str(ion) for ion in final_fit['ions']]))
+    IDs = np.asarray(final_fit['yfit'], dtype=float)
+    # Ion of each ID;  from the line lists if final_fit does not have them
+    if ('ions' in final_fit.keys()) and (len(final_fit['ions']) == IDs.size):
+        ions = np.array([str(ion) for ion in final_fit['ions']])
+    else:
+        line_lists = arcl_io.load_line_lists(lines)
+        imn, _ = arcl_match.nearest(line_lists['wave'], IDs)
+        ions = np.array(line_lists['ion'])[imn]
+    template = dict(name=name, lines=list(lines), spec=spec, fit=fit,
+                    xIDs=np.asarray(final_fit['xfit'], dtype=float)*xnorm,
+                    IDs=IDs, ions=ions,
+                    wave=func_val(fit['fitc'], np.arange(spec.size)/xnorm, fit['function'],
+                                  minv=fit['fmin'], maxv=fit['fmax']))
+    template['xcorr_spec'] = _xcorr_prep(spec)
+    return template
+
+
+def load_template(tmpl_file):
+    """ Template from a PYPIT JSON solution
+
+    Parameters
+    ----------
+    tmpl_file : str
+
+    Returns
+    -------
+    template : dict
+    """
+    with open(tmpl_file, 'r') as f:
+        pypit_fit = json.load(f)
+    if '0' in pypit_fit.keys():  # PYPIT v2;  first slit
+        pypit_fit = pypit_fit['0']
+    name = os.path.basename(tmpl_file).replace('.json', '')
+    return mk_template(pypit_fit['spec'], pypit_fit, name)
+
+
+def write_template(template, outfile):
+    """ Write a template as a PYPIT JSON solution
+
+    Parameters
+    ----------
+    template : dict
+    outfile : str
+    """
+    from linetools import utils as ltu
+    fit = template['fit']
+    out_dict = dict(spec=template['spec'], fitc=fit['fitc'], function=fit['function'],
+                    fmin=fit['fmin'], fmax=fit['fmax'], xnorm=fit['xnorm'],
+                    xfit=template['xIDs']/(fit['xnorm']-1.), yfit=template['IDs'],
+                    ions=template['ions'])
+    jdict = ltu.jsonify(out_dict)
+    ltu.savejson(outfile, jdict, easy_to_read=True, overwrite=True)
+
+
+def load_templates(tmpl_files=None, use_cache=True):
+    """ Load a library of templates
+
+    Parameters
+    ----------
+    tmpl_files : list, optional
+      PYPIT JSON solutions;  defaults to those in data/test_arcs/
+    use_cache : bool, optional
+
+    Returns
+    -------
+    templates : list of dict
+    """
+    if tmpl_files is None:
+        tmpl_files = sorted(glob.glob(template_path+'*_PYPIT.json'))
+    templates = []
+    for tmpl_file in tmpl_files:
+        stamp = os.path.getmtime(tmpl_file)
+        if use_cache and (tmpl_file in _template_cache) and (_template_cache[tmpl_file][0] == stamp):
+            templates.append(_template_cache[tmpl_file][1])
+            continue
+        template = load_template(tmpl_file)
+        _template_cache[tmpl_file] = (stamp, template)
+        templates.append(template)
+    return templates
+
+
+def _xcorr_prep(spec):
+    """ Arc spectrum for cross-correlation;  background removed, lines compressed
+    """
+    spec = np.asarray(spec, dtype=float)
+    spec = np.sqrt(np.maximum(spec - np.median(spec), 0.))
+    norm = np.sqrt(np.sum(spec**2))
+    if norm > 0.:
+        spec = spec/norm
+    return spec
+
+
+def _xcorr_shift(fspec, tspec, nfft, max_shift):
+    """ Best shift of tspec onto the spectrum (already FFT'd as fspec)
+    Sub-pixel from a parabola through the peak
+    """
+    corr = np.fft.irfft(fspec*np.conj(np.fft.rfft(tspec, nfft)), nfft)
+    lags = np.fft.fftfreq(nfft, 1./nfft)
+    corr = np.where(np.abs(lags) <= max_shift, corr, -np.inf)
+    imx = np.argmax(corr)
+    cmx = corr[imx]
+    c0, c1 = corr[imx-1], corr[(imx+1) % nfft]
+    denom = c0 - 2*cmx + c1
+    dlag = 0.
+    if np.isfinite(denom) and denom < 0.:
+        dlag = 0.5*(c0-c1)/denom
+    return lags[imx]+dlag, cmx
+
+
+def xcorr_template(spec, template, stretches=None, max_shift=None):
+    """ Shift and stretch of a template that best match an arc spectrum
+
+    Template pixel q lands on pixel
+      p = cen + stretch*(q-cen) + shift
+    with cen the centre of the template.  The shift is found by FFT
+    cross-correlation for each stretch on a coarse grid, then on a
+    finer one around the best.
+
+    Parameters
+    ----------
+    spec : ndarray
+    template : dict
+    stretches : ndarray, optional
+      Coarse stretch grid;  default 0.9 to 1.1
+    max_shift : float, optional
+      Largest shift in pixels;  default half the spectrum
+
+    Returns
+    -------
+    shift : float
+    stretch : float
+    corr : float
+      Normalised cross-correlation (1 = identical)
+    """
+    if stretches is None:
+        stretches = np.linspace(0.9, 1.1, 41)
+    npix = spec.size
+    if max_shift is None:
+        max_shift = npix/2.
+    # Setup
+    sprep = _xcorr_prep(spec)
+    tprep = template['xcorr_spec']
+    tpix = np.arange(tprep.size, dtype=float)
+    cen = (tprep.size-1)/2.
+    nfft = 2**int(np.ceil(np.log2(npix+tprep.size)))
+    fspec = np.fft.rfft(sprep, nfft)
+    pix = np.arange(npix, dtype=float)
+
+    def best_shift(stretch):
+        tstretch = np.interp((pix-cen)/stretch + cen, tpix, tprep, left=0., right=0.)
+        tstretch /= max(np.sqrt(np.sum(tstretch**2)), 1e-30)
+        return _xcorr_shift(fspec, tstretch, nfft, max_shift)
+
+    # Coarse grid
+    results = [best_shift(stretch) for stretch in stretches]
+    ibest = np.argmax([corr for _, corr in results])
+    # Fine grid, around the best
+    dstretch = np.median(np.diff(stretches))
+    stretches = stretches[ibest] + np.linspace(-dstretch, dstretch, 21)
+    results = [best_shift(stretch) for stretch in stretches]
+    ibest = np.argmax([corr for _, corr in results])
+    bshift, bcorr = results[ibest]
+    return bshift, stretches[ibest], bcorr
+
+
+def solve(spec, templates=None, lines=None, min_ampl=300., pix_tol=3.,
+          min_corr=0.5, ntry=3, min_nfit=10, max_rms=0.5, plot_fil=None,
+          verbose=False, fit_parm=None):
+    """ Wavelength solution by cross-correlation with archived templates
+
+    The templates are ranked by their cross-correlation with the spectrum.
+    For the best (up to ntry) the template lines are shifted and stretched
+    onto the detected lines and the result refined with iterative_fitting().
+    The first solution with at least min_nfit lines and an RMS below
+    max_rms pixels is returned.
+
+    Parameters
+    ----------
+    spec : ndarray
+    templates : list, optional
+      From load_templates();  all of data/test_arcs/ by default
+    lines : list, optional
+      Arc lamps on;  only templates using a subset of these are tried
+    min_ampl : float, optional
+    pix_tol : float, optional
+      Tolerance for matching a template line, in pixels
+    min_corr : float, optional
+      Minimum cross-correlation of a template
+    ntry : int, optional
+    min_nfit : int, optional
+    max_rms : float, optional
+    plot_fil : str, optional
+    verbose : bool, optional
+    fit_parm : dict, optional
+      Passed to iterative_fitting()
+
+    Returns
+    -------
+    best_dict : dict
+      template, shift, stretch, corr, nmatch, IDs, mask
+    final_fit : dict
+      None (for both) if no template gives a solution
+    """
+    if templates is None:
+        templates = load_templates()
+    if lines is not None:
+        templates = [template for template in templates
+                     if set(template['lines']) <= set(lines)]
+    spec = np.asarray(spec)
+    # Rank the templates
+    xcorrs = [xcorr_template(spec, template) for template in templates]
+    order = np.argsort([-corr for _, _, corr in xcorrs], kind='mergesort')
+    # Lines
+    all_tcent, cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=min_ampl)
+    if cut_tcent.size == 0:
+        return None, None
+    for itmpl in order[:ntry]:
+        template = templates[itmpl]
+        shift, stretch, corr = xcorrs[itmpl]
+        if corr < min_corr:
+            break
+        # Template lines on this spectrum
+        cen = (template['spec'].size-1)/2.
+        xIDs = cen + stretch*(template['xIDs']-cen) + shift
+        imn, dpix = arcl_match.nearest(cut_tcent, xIDs)
+        # One ID per line;  the closest
+        gd = np.where(dpix < pix_tol)[0]
+        gd = gd[np.lexsort((dpix[gd], imn[gd]))]
+        gd = gd[np.concatenate([[True], np.diff(imn[gd]) > 0])] if gd.size > 0 else gd
+        ifit = icut[imn[gd]]
+        IDs = template['IDs'][gd]
+        if verbose:
+            print("Template {:s}: shift={:g}, stretch={:g}, corr={:g}, nmatch={:d}".format(
+                template['name'], shift, stretch, corr, ifit.size))
+        if ifit.size < min(min_nfit, 4):
+            continue
+        # Fit
+        line_lists = arcl_io.load_line_lists(template['lines'])
+        NIST_lines = line_lists['NIST'] > 0
+        disp = np.median(np.abs(np.diff(template['wave'])))/stretch
+        isort = np.argsort(ifit)
+        final_fit = arch_fit.iterative_fitting(spec, all_tcent, ifit[isort], IDs[isort],
+                                               line_lists[NIST_lines], disp,
+                                               plot_fil=plot_fil, verbose=verbose,
+                                               aparm=fit_parm)
+        if (len(final_fit['xfit']) < min_nfit) or (final_fit['rms'] > max_rms):
+            continue
+        # Pack up
+        mask = np.zeros(all_tcent.size, dtype=bool)
+        mask[ifit] = True
+        all_IDs = np.zeros(all_tcent.size)
+        all_IDs[ifit] = IDs
+        best_dict = dict(template=template['name'], shift=shift, stretch=stretch, corr=corr,
+                         nmatch=int(ifit.size), IDs=all_IDs.tolist(), mask=mask)
+        return best_dict, final_fit
+    print("No template gave a solution")
+    return None, None
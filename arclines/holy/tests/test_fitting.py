@@ -0,0 +1,120 @@
+# Module to run tests on arclines.holy.fitting
+
+
+import numpy as np
+import pytest
+
+from arclines import io as arcl_io
+from arclines.utils import func_val, robust_polyfit
+from arclines.holy import fitting as arch_fit
+from arclines.holy import templates as arch_tmpl
+from arclines.holy import utils as arch_utils
+
+
+def reidentify_reference(tcent, ifit, sv_ifit, mask, twave, llist, disp, all_ids, all_idsion,
+                         match_toler=3.):
+    """ Line by line re-identification, as in the original iterative_fitting
+    """
+    ifit = list(ifit[mask == 0]) + list(sv_ifit)
+    for ss, iwave in enumerate(twave):
+        mn = np.min(np.abs(iwave-llist['wave']))
+        if mn/disp < match_toler:
+            imn = np.argmin(np.abs(iwave-llist['wave']))
+            all_ids[ss] = llist['wave'][imn]
+            all_idsion[ss] = llist['ion'][imn]
+            ifit.append(ss)
+    return np.unique(np.array(ifit, dtype=int))
+
+
+def reference_fit(spec, tcent, ifit, IDs, llist, disp, func='legendre', n_first=3, n_final=4):
+    """ Original iterative_fitting;  final fit coefficients and ions
+    """
+    sv_ifit = list(ifit)
+    all_ids = -999.*np.ones(len(tcent))
+    all_idsion = np.array(['UNKNWN']*len(tcent))
+    all_ids[ifit] = IDs
+    n_order = n_first
+    while n_order <= n_final:
+        xfit, yfit = tcent[ifit], all_ids[ifit]
+        mask, fit = robust_polyfit(xfit, yfit, n_order, function=func, sigma=2., minv=-1., maxv=1.)
+        twave = func_val(fit, tcent, func, minv=-1., maxv=1.)
+        ifit = reidentify_reference(tcent, ifit, sv_ifit, mask, twave, llist, disp,
+                                    all_ids, all_idsion)
+        n_order += 1
+    xfit, yfit = tcent[ifit]/(spec.size-1), all_ids[ifit]
+    mask, fit = robust_polyfit(xfit, yfit, n_order, function=func, sigma=3., minv=0., maxv=1.)
+    return fit, all_idsion[ifit][mask == 0]
+
+
+@pytest.mark.parametrize('name', ['kastb_600_PYPIT', 'lrisr_600_7500_PYPIT'])
+def test_iterative_fitting(name):
+    template = [tmpl for tmpl in arch_tmpl.load_templates() if tmpl['name'] == name][0]
+    spec = template['spec']
+    all_tcent, cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=300.)
+    line_lists = arcl_io.load_line_lists(template['lines'])
+    llist = line_lists[line_lists['NIST'] > 0]
+    disp = np.median(np.abs(np.diff(template['wave'])))
+    # Seed with a handful of the archived IDs
+    imn = np.array([np.argmin(np.abs(all_tcent-xID)) for xID in template['xIDs']])
+    keep = np.abs(all_tcent[imn]-template['xIDs']) < 1.
+    ifit, IDs = imn[keep][::2], template['IDs'][keep][::2]
+    isort = np.argsort(ifit)
+    ifit, IDs = ifit[isort], IDs[isort]
+    # Same as line by line
+    rfit, rions = reference_fit(spec, all_tcent, ifit, IDs, llist, disp)
+    final_fit = arch_fit.iterative_fitting(spec, all_tcent, ifit, IDs, llist, disp)
+    assert np.all(final_fit['fitc'] == rfit)
+    assert np.all(final_fit['ions'] == rions)
+    assert len(final_fit['xfit']) >= 10
+    assert final_fit['rms'] < 0.2
+
+
+def test_wavelength_image(tmpdir):
+    fits = [tmpl['fit'] for tmpl in arch_tmpl.load_templates()
+            if tmpl['name'] in ['kastb_600_PYPIT', 'lrisr_600_7500_PYPIT']]
+    nspec, ncol = 2048, 300
+    # Tilted slits, alternating solutions
+    rows = np.arange(nspec)
+    traces = [(20.+50*kk+0.002*rows, 50.+50*kk+0.002*rows) for kk in range(5)]
+    slitmask = arch_fit.slitmask_from_traces(traces, (nspec, ncol))
+    assert slitmask[0, 20] == 0 and slitmask[0, 19] == -1 and slitmask[0, 50] == 0
+    assert slitmask[2047, 24] == -1 and slitmask[2047, 25] == 0 and slitmask[2047, 55] == -1
+    sfits = [fits[kk % 2] for kk in range(5)]
+    outfile = str(tmpdir.join('waveimg.npy'))
+    waveimg = arch_fit.wavelength_image(sfits, (nspec, ncol), traces=traces, outfile=outfile)
+    assert waveimg.dtype == np.float32
+    assert np.all(np.isnan(waveimg[slitmask < 0]))
+    for kk, fit in enumerate(sfits):
+        wave = func_val(fit['fitc'], rows/(fit['xnorm']-1.), fit['function'],
+                        minv=fit['fmin'], maxv=fit['fmax'])
+        r, c = np.where(slitmask == kk)
+        assert np.all(waveimg[r, c] == wave.astype(np.float32)[r])
+        # And back
+        pix = arch_fit.wave_to_pixel(wave, fit)
+        assert np.max(np.abs(pix-rows)) < 0.01
+    np.testing.assert_array_equal(np.load(outfile), waveimg)
+    # No inverse
+    bad_fit = dict(fits[0], fitc=np.array([5000., 0., 100.]), function='legendre')
+    with pytest.raises(ValueError):
+        arch_fit.pixel_table(bad_fit)
+
+
+def test_pixel_table_cache():
+    fit = [tmpl['fit'] for tmpl in arch_tmpl.load_templates()
+           if tmpl['name'] == 'kastb_600_PYPIT'][0]
+    arch_fit._pixel_tables.clear()
+    twave, tpix = arch_fit.pixel_table(fit)
+    assert arch_fit.pixel_table(fit)[0] is twave
+    assert not twave.flags.writeable
+    # Not kept
+    nwave, _ = arch_fit.pixel_table(dict(fit, fitc=np.array(fit['fitc'])+1.), use_cache=False)
+    assert nwave.flags.writeable
+    assert len(arch_fit._pixel_tables) == 1
+    # Bounded;  the least recently used go first
+    for ii in range(2*arch_fit.max_pixel_tables):
+        shift = np.zeros(len(fit['fitc']))
+        shift[0] = ii+1.
+        stwave, stpix = arch_fit.pixel_table(dict(fit, fitc=np.array(fit['fitc'])+shift))
+        assert np.allclose(stwave, twave+ii+1.)
+        assert arch_fit.pixel_table(fit)[0] is twave
+    assert len(arch_fit._pixel_tables) == arch_fit.max_pixel_tables
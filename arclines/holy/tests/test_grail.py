@@ -0,0 +1,133 @@
+# Module to run tests on arclines.holy.grail
+
+
+import numpy as np
+import json
+import pytest
+
+import arclines
+from arclines.holy import grail
+
+test_arc_path = arclines.__path__[0]+'/data/test_arcs/'
+
+
+def load_spec(arc_file):
+    with open(test_arc_path+arc_file, 'r') as f:
+        pypit_fit = json.load(f)
+    # Some hold the fit of each slit
+    pypit_fit = pypit_fit.get('0', pypit_fit)
+    return np.array(pypit_fit['spec'])
+
+
+def test_batch_general():
+    spec = load_spec('kastb_600_PYPIT.json')
+    lines = ['CdI','HeI','HgI']
+    # A good slit, a shifted one and one that will fail
+    specs = np.array([spec, np.roll(spec, 20), spec[::-1]])
+    results = grail.batch_general(specs, lines, min_ampl=1000.)
+    assert len(results) == 3
+    assert [best_dict['status'] for best_dict, _ in results] == ['ok', 'ok', 'error']
+    assert results[2][1] is None
+    for best_dict, _ in results:
+        assert best_dict['time'] > 0.
+    # Same as one at a time
+    for ss in range(2):
+        best_dict, final_fit = grail.general(specs[ss], lines, min_ampl=1000.)
+        assert results[ss][0]['nmatch'] == best_dict['nmatch']
+        assert np.allclose(results[ss][1]['fitc'], final_fit['fitc'])
+
+
+def test_batch_semi_brute():
+    spec = load_spec('kastb_600_PYPIT.json')
+    lines = ['CdI','HeI','HgI']
+    specs = [spec, np.roll(spec, 20)]
+    results = grail.batch_semi_brute(specs, lines, 4400., 1.02, use_prior=True,
+                                     min_ampl=1000., min_nmatch=10)
+    assert [best_dict['status'] for best_dict, _ in results] == ['ok', 'ok']
+    best_dict, final_fit = grail.semi_brute(spec, lines, 4400., 1.02,
+                                            min_ampl=1000., min_nmatch=10)
+    assert np.allclose(results[0][1]['fitc'], final_fit['fitc'])
+
+
+def test_semi_brute_prior():
+    spec = load_spec('kastb_600_PYPIT.json')
+    lines = ['CdI','HeI','HgI']
+    best_dict, final_fit = grail.semi_brute(spec, lines, 4400., 1.02,
+                                            min_ampl=1000., min_nmatch=10)
+    # Shifted spectrum;  the prior solution is used
+    pbest_dict, pfinal_fit = grail.semi_brute(np.roll(spec, 20), lines, 4400., 1.02,
+                                              min_ampl=1000., min_nmatch=10,
+                                              prior_fit=final_fit)
+    assert pbest_dict['prior']
+    assert pbest_dict['shift'] == -20.
+    assert len(pfinal_fit['xfit']) == len(final_fit['xfit'])
+    assert np.isclose(pfinal_fit['rms'], final_fit['rms'], rtol=1e-6)
+    # Solution for another setup;  falls back to the scan
+    kastr_spec = load_spec('kastr_600_7500_PYPIT.json')
+    _, kastr_fit = grail.semi_brute(kastr_spec, ['ArI','NeI','HgI'], 6800., 2.345,
+                                    min_ampl=1000., min_nmatch=10)
+    fbest_dict, ffinal_fit = grail.semi_brute(spec, lines, 4400., 1.02,
+                                              min_ampl=1000., min_nmatch=10,
+                                              prior_fit=kastr_fit)
+    assert 'prior' not in fbest_dict
+    assert np.allclose(ffinal_fit['fitc'], final_fit['fitc'])
+
+
+def test_vote_solutions():
+    from scipy.ndimage.filters import gaussian_filter
+    rstate = np.random.RandomState(1234)
+    # Two clumps of solutions (the second larger) and noise
+    wvcen = np.concatenate([rstate.normal(4400., 3., 300), rstate.normal(6000., 3., 400),
+                            rstate.uniform(3000., 9000., 5000)])
+    ldisps = np.concatenate([rstate.normal(0.01, 0.002, 300), rstate.normal(0.3, 0.002, 400),
+                             rstate.uniform(-0.5, 0.5, 5000)])
+    binw = np.linspace(3000., 9000., 1000)
+    bind = np.linspace(-0.5, 0.5, 1000)
+    votes = grail.vote_solutions(wvcen, ldisps, binw, bind, ncand=3)
+    # Same as the full histogram
+    histimg, _, _ = np.histogram2d(wvcen, ldisps, bins=[binw, bind])
+    histimg = gaussian_filter(histimg, 3)
+    assert votes[0][0] == np.unravel_index(np.argmax(histimg), histimg.shape)
+    for bidx, nvote in votes:
+        assert np.isclose(histimg[bidx], nvote)
+    # Both clumps
+    assert np.abs(binw[votes[0][0][0]]-6000.) < 20.
+    assert np.abs(binw[votes[1][0][0]]-4400.) < 20.
+
+
+def test_general_candidates():
+    spec = load_spec('kastb_600_PYPIT.json')
+    best_dict, final_fit = grail.general(spec, ['CdI','HeI','HgI'], min_ampl=1000.)
+    candidates = best_dict['candidates']
+    assert len(candidates) > 1
+    assert candidates[0]['nmatch'] == best_dict['nmatch']
+    assert best_dict['bwv'] == candidates[0]['bwv']
+    assert candidates[0]['rms'] < 1.
+    # Those with a good quick fit come first, by their number of matches
+    good = [(cand['nfit'] >= 8) and (cand['rms'] < 1.) for cand in candidates]
+    assert good == sorted(good, reverse=True)
+    nmatch = [cand['nmatch'] for cand, gd in zip(candidates, good) if gd]
+    assert nmatch == sorted(nmatch, reverse=True)
+
+
+@pytest.mark.parametrize('arc_file,lines', [
+    ('kastr_600_7500_PYPIT.json', ['ArI','NeI','HgI']),
+    ('deimos_830G_r_PYPIT.json', ['ArI','NeI','KrI','XeI'])])
+def test_general_ncand(arc_file, lines):
+    # Some of the extra candidates match more lines than the right solution
+    spec = load_spec(arc_file)
+    best_dict, final_fit = grail.general(spec, lines, min_ampl=1000.)
+    nbest_dict, nfinal_fit = grail.general(spec, lines, min_ampl=1000., ncand=20)
+    assert len(nbest_dict['candidates']) > len(best_dict['candidates'])
+    assert max([cand['nmatch'] for cand in nbest_dict['candidates']]) > nbest_dict['nmatch']
+    assert nbest_dict['bwv'] == best_dict['bwv']
+    assert np.allclose(nfinal_fit['fitc'], final_fit['fitc'])
+    assert nfinal_fit['rms'] < 0.1
+
+
+def test_grid_window():
+    grid = np.linspace(0., 1., 11)
+    assert np.allclose(grail._grid_window(grid, 5, 2), [0.3, 0.7])
+    # Clipped at either end, not wrapped around
+    assert np.allclose(grail._grid_window(grid, 1, 5), [0., 0.6])
+    assert np.allclose(grail._grid_window(grid, 9, 5), [0.4, 1.])
@@ -0,0 +1,200 @@
+# Module to run tests on arclines.holy.patterns
+
+
+import numpy as np
+import json
+import pytest
+import numba as nb
+
+import arclines
+from arclines import io as arcl_io
+from arclines.holy import patterns as arch_patt
+from arclines.holy import utils as arch_utils
+
+test_arc_path = arclines.__path__[0]+'/data/test_arcs/'
+
+
+def load_arc(arc_file, lines):
+    """ Spectrum, line centroids and sorted line list for a test arc
+    """
+    with open(test_arc_path+arc_file, 'r') as f:
+        pypit_fit = json.load(f)
+    spec = np.array(pypit_fit['spec'])
+    all_tcent, cut_tcent, icut = arch_utils.arc_lines_from_spec(spec, min_ampl=300.)
+    llist = arcl_io.load_line_lists(lines, unknown=True)
+    wvdata = np.array(llist['wave'].data)
+    wvdata.sort()
+    return spec, cut_tcent, wvdata
+
+
+def quad_match_reference(tcent, twave, llist_wv, disp, swv_uncertainty=250., pix_tol=1.):
+    """ Pure python version of run_quad_match
+    """
+    nlin = tcent.size
+    match_idx = {}
+    for ii in range(nlin):
+        match_idx[ii] = {}
+        match_idx[ii]['matches'] = []
+    for idx in range(nlin-4):
+        for jj in range(4):
+            sub_idx = idx + np.arange(5).astype(int)
+            msk = np.array([True]*5)
+            msk[jj+1] = False
+            sidx = sub_idx[msk]
+            spec_lines = np.array(tcent)[sidx]
+            widx = int(np.round(tcent[idx]))
+            wvmnx = [twave[widx]-swv_uncertainty, twave[widx]+swv_uncertainty]
+            matches = arch_patt.match_quad_to_list(spec_lines, llist_wv, wvmnx, disp, tol=pix_tol)
+            for match in matches:
+                for ii in range(4):
+                    match_idx[sidx[ii]]['matches'].append(match[ii])
+    scores = np.array(arch_patt.score_quad_matches(match_idx))
+    return match_idx, scores
+
+
+@pytest.mark.parametrize('arc_file,lines,wv_cen,disp', [
+    ('kastb_600_PYPIT.json', ['CdI','HeI','HgI'], 4400., 1.02),
+    ('lrisb_600_4000_PYPIT.json', ['CdI','HgI','ZnI'], 4400., 1.26),
+    ('kastr_600_7500_PYPIT.json', ['ArI','NeI','HgI'], 6800., 2.345),
+    ])
+def test_quad_match(arc_file, lines, wv_cen, disp):
+    spec, tcent, wvdata = load_arc(arc_file, lines)
+    npix = spec.size
+    for iwv_cen in [wv_cen-280., wv_cen, wv_cen+280.]:
+        wave = iwv_cen + (np.arange(npix) - npix/2.)*disp
+        for pix_tol in [1., 2.]:
+            ref_idx, ref_scores = quad_match_reference(tcent, wave, wvdata, disp,
+                                                       swv_uncertainty=350., pix_tol=pix_tol)
+            match_idx, scores = arch_patt.run_quad_match(tcent, wave, wvdata, disp,
+                                                         swv_uncertainty=350., pix_tol=pix_tol)
+            assert np.all(scores == ref_scores)
+            for key in ref_idx.keys():
+                assert match_idx[key]['matches'] == ref_idx[key]['matches']
+
+
+def test_score_tables():
+    rstate = np.random.RandomState(1234)
+    ndet = 40
+    for ntrial in range(20):
+        nmatch = rstate.randint(0, 300)
+        didx = rstate.randint(0, ndet, nmatch)
+        # Few lines per detection so that the stronger scores occur
+        lidx = didx + rstate.randint(0, 3, nmatch)
+        match_idx = {}
+        for ii in range(ndet):
+            match_idx[ii] = dict(matches=lidx[didx == ii].tolist())
+        # Quads
+        codes, best = arch_patt.score_quad_table(didx, lidx, ndet)
+        ref_scores = arch_patt.score_quad_matches(match_idx)
+        assert [arch_patt.quad_labels[code] for code in codes] == ref_scores
+        # Triangles
+        codes, tbest = arch_patt.score_triangle_table(didx, lidx, ndet)
+        assert np.all(tbest == best)
+        for ii in range(ndet):
+            if len(match_idx[ii]['matches']) == 0:
+                assert codes[ii] == arch_patt.TriangleScore.NONE
+                assert best[ii] == -1
+                continue
+            uni, cnts = np.unique(match_idx[ii]['matches'], return_counts=True)
+            assert best[ii] == uni[np.argmax(cnts)]
+            assert arch_patt.triangle_labels[codes[ii]] == arch_patt.score_triangles(cnts)
+
+
+@nb.jit(nopython=True, cache=True)
+def triangles_reference(detlines, linelist, npixels, detsrch, lstsrch, pixtol):
+    """ Original triangles kernel;  one row per tested pattern
+    """
+    nptn = 3
+    sz_d = detlines.size
+    sz_l = linelist.size
+    nrow = 0
+    for d in range(0, sz_d-nptn+1):
+        dup = min(d + detsrch, sz_d)
+        for dd in range(d+nptn-1, dup):
+            for xd in range(d+1, dd):
+                for l in range(0, sz_l-nptn+1):
+                    lup = min(l + lstsrch, sz_l)
+                    for ll in range(l+nptn-1, lup):
+                        nrow += ll - l - 1
+    lindex = np.zeros((nrow, nptn), dtype=np.uint64)
+    dindex = np.zeros((nrow, nptn), dtype=np.uint64)
+    wvcen = np.zeros(nrow)
+    disps = np.zeros(nrow)
+    cnt = 0
+    for d in range(0, sz_d-nptn+1):
+        dup = min(d + detsrch, sz_d)
+        for dd in range(d+nptn-1, dup):
+            for xd in range(d+1, dd):
+                dval = (detlines[xd]-detlines[d])/(detlines[dd]-detlines[d])
+                tol = pixtol/(detlines[dd]-detlines[d])
+                for l in range(0, sz_l-nptn+1):
+                    lup = min(l + lstsrch, sz_l)
+                    for ll in range(l+nptn-1, lup):
+                        for xl in range(l+1, ll):
+                            lval = (linelist[xl]-linelist[l])/(linelist[ll]-linelist[l])
+                            if abs(lval-dval) <= tol:
+                                lindex[cnt, 0] = l
+                                lindex[cnt, 1] = xl
+                                lindex[cnt, 2] = ll
+                                dindex[cnt, 0] = d
+                                dindex[cnt, 1] = xd
+                                dindex[cnt, 2] = dd
+                                tst = (linelist[ll]-linelist[l]) / (detlines[dd]-detlines[d])
+                                wvcen[cnt] = (npixels/2.0) * tst + (linelist[ll]-tst*detlines[dd])
+                                disps[cnt] = tst
+                            cnt += 1
+    return dindex, lindex, wvcen, disps
+
+
+def test_triangles():
+    spec, tcent, wvdata = load_arc('kastb_600_PYPIT.json', ['CdI','HeI','HgI'])
+    ref = triangles_reference(tcent, wvdata, float(spec.size), 5, 10, 1.)
+    gd = (ref[2] > 0.) & (ref[3] > 0.)
+    dindex, lindex, wvcen, disps = arch_patt.triangles(tcent, wvdata, spec.size, 5, 10, 1.)
+    gdnew = (wvcen > 0.) & (disps > 0.)
+    assert dindex.dtype == np.int32
+    assert np.all(dindex[gdnew] == ref[0][gd])
+    assert np.all(lindex[gdnew] == ref[1][gd])
+    assert np.all(wvcen[gdnew] == ref[2][gd])
+    assert np.all(disps[gdnew] == ref[3][gd])
+    # Chunks
+    chunks = list(arch_patt.iter_triangles(tcent, wvdata, spec.size, 5, 10, 1., nchunk=7))
+    for ii, item in enumerate([dindex, lindex, wvcen, disps]):
+        assert np.all(np.concatenate([chunk[ii] for chunk in chunks]) == item)
+
+
+def test_triangles_parallel():
+    spec, tcent, wvdata = load_arc('kastr_600_7500_PYPIT.json', ['ArI','NeI','HgI'])
+    serial = arch_patt.triangles(tcent, wvdata, spec.size, 5, 10, 1.)
+    parallel = arch_patt.triangles(tcent, wvdata, spec.size, 5, 10, 1., nthreads=4)
+    for item, pitem in zip(serial, parallel):
+        assert item.dtype == pitem.dtype
+        assert np.all(item == pitem)
+    # Chunks
+    chunks = list(arch_patt.iter_triangles(tcent, wvdata, spec.size, 5, 10, 1.,
+                                           nchunk=11, nthreads=4))
+    for ii, item in enumerate(serial):
+        assert np.all(np.concatenate([chunk[ii] for chunk in chunks]) == item)
+
+
+def test_line_pattern_index(tmpdir):
+    lines = ['ArI','NeI','HgI']
+    spec, tcent, wvdata = load_arc('kastr_600_7500_PYPIT.json', lines)
+    index = arch_patt.LinePatternIndex(lines)
+    assert np.all(index.wvdata[True] == wvdata)
+    for unknown in [False, True]:
+        ref = arch_patt.triangles(tcent, index.wvdata[unknown], spec.size, 5, 10, 1.)
+        for nthreads in [None, 4]:
+            tri = index.triangles(tcent, spec.size, unknown, 5, 1., nthreads=nthreads)
+            for item, ritem in zip(tri, ref):
+                assert np.all(item == ritem)
+    # Write/read
+    outfile = str(tmpdir.join('index.npz'))
+    index.write(outfile)
+    index2 = arch_patt.LinePatternIndex.from_file(outfile)
+    assert index2.lines == lines
+    tri = index2.triangles(tcent, spec.size, True, 5, 1.)
+    assert np.all(tri[1] == ref[1])
+    # Lamps
+    with pytest.raises(IOError):
+        index2.check_lines(['ArI','NeI'])
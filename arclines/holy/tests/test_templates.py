@@ -0,0 +1,78 @@
+# Module to run tests on arclines.holy.templates
+
+
+import numpy as np
+import pytest
+
+from arclines.utils import func_val
+from arclines.holy import templates as arch_tmpl
+
+
+def mk_arc(template, shift, stretch):
+    """ Template spectrum, shifted and stretched, and its true wavelengths
+    """
+    spec = template['spec']
+    npix = spec.size
+    cen = (npix-1)/2.
+    pix = np.arange(npix, dtype=float)
+    qpix = (pix-cen-shift)/stretch + cen
+    fit = template['fit']
+    wave = func_val(fit['fitc'], qpix/(fit['xnorm']-1.), fit['function'],
+                    minv=fit['fmin'], maxv=fit['fmax'])
+    return np.interp(qpix, pix, spec), wave, (qpix > 0.) & (qpix < npix-1)
+
+
+def test_xcorr_template():
+    templates = arch_tmpl.load_templates()
+    template = [tmpl for tmpl in templates if tmpl['name'] == 'lrisr_600_7500_PYPIT'][0]
+    spec, _, _ = mk_arc(template, -42.7, 0.97)
+    shift, stretch, corr = arch_tmpl.xcorr_template(spec, template)
+    assert np.abs(shift+42.7) < 1.
+    assert np.abs(stretch-0.97) < 0.002
+    assert corr > 0.9
+
+
+@pytest.mark.parametrize('name,lines', [
+    ('kastb_600_PYPIT', ['CdI','HeI','HgI']),
+    ('lrisr_600_7500_PYPIT', ['ArI','HgI','KrI','NeI','XeI']),
+    ('kastr_600_7500_PYPIT', ['ArI','NeI','HgI']),
+    ])
+def test_solve(name, lines):
+    templates = arch_tmpl.load_templates()
+    template = [tmpl for tmpl in templates if tmpl['name'] == name][0]
+    spec, wave, gdpix = mk_arc(template, 15.3, 1.02)
+    best_dict, final_fit = arch_tmpl.solve(spec, templates=templates, lines=lines)
+    assert best_dict['template'] == name
+    assert final_fit['rms'] < 0.5
+    # Wavelengths
+    npix = spec.size
+    fit_wave = func_val(final_fit['fitc'], np.arange(npix)/(npix-1.), final_fit['function'],
+                        minv=final_fit['fmin'], maxv=final_fit['fmax'])
+    disp = np.median(np.abs(np.diff(wave)))
+    assert np.max(np.abs(fit_wave-wave)[gdpix]) < disp
+
+
+def test_write_template(tmpdir):
+    import json
+    tmpl_file = arch_tmpl.template_path+'kastr_600_7500_PYPIT.json'
+    template = arch_tmpl.load_template(tmpl_file)
+    outfile = str(tmpdir.join('kastr_600_7500_PYPIT.json'))
+    arch_tmpl.write_template(template, outfile)
+    # A PYPIT solution, with the ion of each line
+    with open(outfile, 'r') as f:
+        written = json.load(f)
+    with open(tmpl_file, 'r') as f:
+        original = json.load(f)
+    assert written['ions'] == original['ions']
+    for key in ['fitc', 'xfit', 'yfit']:
+        np.testing.assert_allclose(written[key], original[key], rtol=1e-12)
+    # Round trip
+    rtemplate = arch_tmpl.load_template(outfile)
+    assert rtemplate['lines'] == template['lines']
+    assert np.all(rtemplate['ions'] == template['ions'])
+    for key in ['xIDs', 'IDs', 'spec', 'wave']:
+        np.testing.assert_allclose(rtemplate[key], template[key], rtol=1e-12)
+    # Ions from the line lists when the solution has none
+    no_ions = dict(original, ions=[])
+    ltemplate = arch_tmpl.mk_template(original['spec'], no_ions, 'no_ions', lines=template['lines'])
+    assert np.all(ltemplate['ions'] == template['ions'])
@@ -32,3 +32,31 @@ def arc_lines_from_spec(spec, min_ampl=300.):
 
     # Return
     return all_tcent, cut_tcent, icut
+
+
+def arc_lines_from_specs(specs, min_ampl=300., method='batch'):
+    """ arc_lines_from_spec for a set of spectra (e.g. all slits)
+
+    Parameters
+    ----------
+    specs : ndarray (nslit, npix)
+    min_ampl : float, optional
+    method : str, optional
+      Fitting method for find_peaks_2d
+
+    Returns
+    -------
+    offsets : ndarray (nslit+1)
+      Lines of spectrum i are in [offsets[i]:offsets[i+1]]
+    all_tcent : ndarray
+      Flat array of line centroids
+    cut_amp : bool ndarray
+      Lines passing min_ampl
+    """
+    from arclines.pypit_utils import find_peaks_2d
+    # Find peaks
+    offsets, all_tampl, all_tcent, _ = find_peaks_2d(specs, method=method)
+    # Cut on Amplitude
+    cut_amp = all_tampl > min_ampl
+    # Return
+    return offsets, all_tcent, cut_amp
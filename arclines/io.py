@@ -17,6 +17,41 @@ from arclines import defs
 line_path = arclines.__path__[0]+'/data/lists/'
 nist_path = arclines.__path__[0]+'/data/NIST/'
 
+# Compiled line database;  see build_lists.compile_line_db()
+line_db_file = line_path+'line_db.npy'
+
+# Tables already parsed in this process;  see clear_cache()
+_table_cache = {}
+
+
+def clear_cache():
+    """ Empty the per-process cache of line lists
+    """
+    _table_cache.clear()
+
+
+def _file_stamp(files):
+    """ Modification times of a set of files, used to invalidate the cache
+    """
+    return tuple([os.path.getmtime(ifile) for ifile in files])
+
+
+def _from_cache(key, files):
+    """ Copy of a cached table, or None if missing or out of date
+    """
+    if key in _table_cache:
+        stamp, tbl = _table_cache[key]
+        if stamp == _file_stamp(files):
+            return tbl.copy()
+    return None
+
+
+def _to_cache(key, files, tbl):
+    """ Cache a table and return a copy of it
+    """
+    _table_cache[key] = (_file_stamp(files), tbl)
+    return tbl.copy()
+
 
 def load_by_hand():
     """ By-hand line list
@@ -48,7 +83,122 @@ def load_by_hand():
     return line_list[['ion', 'wave', 'NIST', 'Instr', 'amplitude', 'Source']]
 
 
-def load_line_list(line_file, add_path=False, use_ion=False, NIST=False):
+def line_db_meta_file(db_file):
+    """ Name of the JSON file holding the offsets and formats of a line database
+    """
+    return db_file.replace('.npy', '.json')
+
+
+def line_db_is_current(db_file=None):
+    """ Is the compiled line database newer than all of the ASCII line lists?
+
+    Parameters
+    ----------
+    db_file : str, optional
+
+    Returns
+    -------
+    current : bool
+    """
+    import glob
+    if db_file is None:
+        db_file = line_db_file
+    meta_file = line_db_meta_file(db_file)
+    if (not os.path.isfile(db_file)) or (not os.path.isfile(meta_file)):
+        return False
+    src_files = glob.glob(line_path+'*_lines.dat') + [line_path+'UNKNWNs.dat']
+    db_time = min(os.path.getmtime(db_file), os.path.getmtime(meta_file))
+    return db_time > max(_file_stamp(src_files))
+
+
+def load_line_db(db_file=None, mmap_mode='r'):
+    """ Load the compiled line database
+
+    Parameters
+    ----------
+    db_file : str, optional
+    mmap_mode : str, optional
+      Passed to np.load;  None reads the whole file into memory
+
+    Returns
+    -------
+    db : ndarray
+      Structured array of all lines, ordered by ion_code
+    meta : dict
+      ions, offsets (per-ion row ranges), and the column names and
+      formats of each original line list
+    """
+    import json
+    if db_file is None:
+        db_file = line_db_file
+    db = np.load(db_file, mmap_mode=mmap_mode)
+    with open(line_db_meta_file(db_file), 'r') as f:
+        meta = json.load(f)
+    return db, meta
+
+
+def line_list_from_db(name, db=None, meta=None):
+    """ Line list of a single ion from the compiled database
+    Same columns, formats and row order as load_line_list()
+
+    Parameters
+    ----------
+    name : str
+      Name of the line list, e.g. ArI or UNKNWNs
+    db : ndarray, optional
+    meta : dict, optional
+      From load_line_db()
+
+    Returns
+    -------
+    line_list : Table
+    """
+    if db is None:
+        db, meta = load_line_db()
+    if name not in meta['ions']:
+        raise IOError("Line list {:s} is not in the line database".format(name))
+    i0, i1 = meta['offsets'][name]
+    rec = db[i0:i1]
+    line_list = Table()
+    for key, dtype in zip(meta['columns'][name], meta['dtypes'][name]):
+        line_list[key] = np.array(rec[key]).astype(dtype)
+    return line_list
+
+
+def rel_intensity(rel_col, dtype):
+    """ Parse the NIST Rel. column into numbers
+    A trailing flag character is stripped (e.g. 1000w -> 1000);
+    entries that still do not parse, and masked entries, are 0
+
+    The conversion is done once per unique value of the column
+
+    Parameters
+    ----------
+    rel_col : Column or MaskedColumn
+    dtype : type
+      float or int
+
+    Returns
+    -------
+    relint : ndarray
+    """
+    data = np.asarray(rel_col)
+    uni, inv = np.unique(data, return_inverse=True)
+    vals = np.zeros(uni.size, dtype=dtype)
+    for kk, item in enumerate(uni.tolist()):
+        try:
+            vals[kk] = dtype(item)
+        except ValueError:
+            try:
+                vals[kk] = dtype(item[:-1])
+            except (ValueError, TypeError):
+                pass
+    relint = vals[inv.ravel()]
+    relint[np.ma.getmaskarray(rel_col)] = 0
+    return relint
+
+
+def load_line_list(line_file, add_path=False, use_ion=False, NIST=False, use_cache=True):
     """
     Parameters
     ----------
@@ -58,6 +208,8 @@ def load_line_list(line_file, add_path=False, use_ion=False, NIST=False):
       Not yet implemented
     NIST : bool, optional
       NIST formatted table?
+    use_cache : bool, optional
+      Reuse the table if this file was already parsed (and is unchanged)
 
     Returns
     -------
@@ -66,6 +218,12 @@ def load_line_list(line_file, add_path=False, use_ion=False, NIST=False):
     """
     if use_ion:
         line_file = line_path+'{:s}_lines.dat'.format(line_file)
+    if use_cache:
+        key = ('line_list', os.path.abspath(line_file), NIST)
+        line_list = _from_cache(key, [line_file])
+        if line_list is not None:
+            return line_list
+        return _to_cache(key, [line_file], load_line_list(line_file, NIST=NIST, use_cache=False))
     line_list = Table.read(line_file, format='ascii.fixed_width', comment='#')
     #  NIST?
     if NIST:
@@ -76,18 +234,7 @@ def load_line_list(line_file, add_path=False, use_ion=False, NIST=False):
                 if badkey in tkey:
                     line_list.remove_column(tkey)
         # Relative intensity -- Strip junk off the end
-        reli = []
-        for imsk, idat in zip(line_list['Rel.'].mask, line_list['Rel.'].data):
-            if imsk:
-                reli.append(0.)
-            else:
-                try:
-                    reli.append(float(idat))
-                except ValueError:
-                    try:
-                        reli.append(float(idat[:-1]))
-                    except ValueError:
-                        reli.append(0.)
+        reli = rel_intensity(line_list['Rel.'], float)
         line_list.remove_column('Rel.')
         line_list['RelInt'] = reli
         #
@@ -106,7 +253,7 @@ def load_line_list(line_file, add_path=False, use_ion=False, NIST=False):
     return line_list
 
 
-def load_line_lists(lines, unknown=False, skip=False, all=False, NIST=False):
+def load_line_lists(lines, unknown=False, skip=False, all=False, NIST=False, use_cache=True):
     """ Loads a series of line list files
 
     Parameters
@@ -117,6 +264,10 @@ def load_line_lists(lines, unknown=False, skip=False, all=False, NIST=False):
       Skip missing line lists (mainly for building)
     NIST : bool, optional
       Load the full NIST linelists
+    use_cache : bool, optional
+      Reuse the stacked table from an earlier call with the same
+      lamps (in the same order, which sets the row order) and flags,
+      unless one of the files has changed since
 
     Returns
     -------
@@ -134,8 +285,8 @@ def load_line_lists(lines, unknown=False, skip=False, all=False, NIST=False):
             i1 = line_file.rfind('_')
             lines.append(line_file[i0+1:i1])
 
-    # Read standard files
-    lists = []
+    # Files
+    line_files = []
     for line in lines:
         if NIST:
             line_file = nist_path+'{:s}_vacuum.ascii'.format(line)
@@ -146,20 +297,42 @@ def load_line_lists(lines, unknown=False, skip=False, all=False, NIST=False):
                 import pdb; pdb.set_trace()
                 raise IOError("Input line {:s} is not included in arclines".format(line))
         else:
-            lists.append(load_line_list(line_file, NIST=NIST))
-    # Stack
-    if len(lists) == 0:
+            line_files.append(line_file)
+    if len(line_files) == 0:
         return None
+    # Cached?
+    if use_cache:
+        key = ('line_lists', tuple(lines), unknown, NIST)
+        stamp_files = line_files + ([line_path+'UNKNWNs.dat'] if unknown else [])
+        line_lists = _from_cache(key, stamp_files)
+        if line_lists is not None:
+            return line_lists
+
+    # Read standard files;  from the compiled database if it is up to date
+    if (not NIST) and line_db_is_current():
+        db, meta = load_line_db()
+        lists = []
+        for line_file in line_files:
+            name = line_file[len(line_path):-len('_lines.dat')]
+            if name in meta['ions']:
+                lists.append(line_list_from_db(name, db=db, meta=meta))
+            else:  # Not compiled in, e.g. added since
+                lists.append(load_line_list(line_file, use_cache=use_cache))
+    else:
+        lists = [load_line_list(line_file, NIST=NIST, use_cache=use_cache) for line_file in line_files]
+    # Stack
     line_lists = vstack(lists, join_type='exact')
 
     # Unknown
     if unknown:
-        unkn_lines = load_unknown_list(lines)
+        unkn_lines = load_unknown_list(lines, use_cache=use_cache)
         unkn_lines.remove_column('line_flag')  # may wish to have this info
         # Stack
         line_lists = vstack([line_lists, unkn_lines])
 
     # Return
+    if use_cache:
+        return _to_cache(key, stamp_files, line_lists)
     return line_lists
 
 
@@ -178,7 +351,7 @@ def load_source_table():
     return sources
 
 
-def load_nist(ion):
+def load_nist(ion, use_cache=True):
     """Parse a NIST ASCII table.  Note that the long ---- should have
     been commented out and also the few lines at the start.
 
@@ -186,6 +359,9 @@ def load_nist(ion):
     ----------
     ion : str
       Name of ion
+    use_cache : bool, optional
+      Reuse the table if this file was already parsed (and is unchanged)
+
     Returns
     -------
     tbl : Table
@@ -199,6 +375,13 @@ def load_nist(ion):
     nist_file = glob.glob(srch_file)
     if len(nist_file) == 0:
         raise IOError("Cannot find NIST file {:s}".format(srch_file))
+    # Cached?
+    if use_cache:
+        key = ('nist', os.path.abspath(nist_file[0]))
+        nist_tbl = _from_cache(key, nist_file)
+        if nist_tbl is not None:
+            return nist_tbl
+        return _to_cache(key, nist_file, load_nist(ion, use_cache=False))
     # Read
     nist_tbl = Table.read(nist_file[0], format='ascii.fixed_width')
     gdrow = nist_tbl['Observed'] > 0.  # Eliminate dummy lines
@@ -207,17 +390,7 @@ def load_nist(ion):
     uniq, indices = np.unique(nist_tbl['Observed'],return_index=True)
     nist_tbl = nist_tbl[indices]
     # Deal with Rel
-    agdrel = []
-    for row in nist_tbl:
-        try:
-            gdrel = int(row['Rel.'])
-        except:
-            try:
-                gdrel = int(row['Rel.'][:-1])
-            except:
-                gdrel = 0
-        agdrel.append(gdrel)
-    agdrel = np.array(agdrel)
+    agdrel = rel_intensity(nist_tbl['Rel.'], int)
     # Remove and add
     nist_tbl.remove_column('Rel.')
     nist_tbl.remove_column('Ritz')
@@ -229,7 +402,7 @@ def load_nist(ion):
     return nist_tbl
 
 
-def load_unknown_list(lines, unknwn_file=None, all=False):
+def load_unknown_list(lines, unknwn_file=None, all=False, use_cache=True):
     """
     Parameters
     ----------
@@ -237,6 +410,8 @@ def load_unknown_list(lines, unknwn_file=None, all=False):
       Restricted lines;  use all=True for all
     unknwn_file : str, optional
     all : bool, optional
+    use_cache : bool, optional
+      Reuse the parsed file if it is unchanged
 
 
     Returns
@@ -249,7 +424,12 @@ def load_unknown_list(lines, unknwn_file=None, all=False):
     line_path = arclines.__path__[0]+'/data/lists/'
     if unknwn_file is None:
         unknwn_file = line_path+'UNKNWNs.dat'
-    line_list = load_line_list(unknwn_file)
+        if line_db_is_current():
+            line_list = line_list_from_db('UNKNWNs')
+        else:
+            line_list = load_line_list(unknwn_file, use_cache=use_cache)
+    else:
+        line_list = load_line_list(unknwn_file, use_cache=use_cache)
     # Cut on input lamps?
     if all:
         return line_list
@@ -312,3 +492,96 @@ def write_line_list(tbl, outfile):
     with open(outfile,'w') as f:
         f.write('# Creation Date: {:s}\n'.format(str(datetime.date.today().strftime('%Y-%b-%d'))))
         tbl.write(f, format='ascii.fixed_width')
+
+
+# final_fit entries kept by write_fit();  scalars as attributes, arrays as datasets
+fit_scalars = ['function', 'fmin', 'fmax', 'xnorm', 'rms', 'nrej', 'shift']
+fit_arrays = ['fitc', 'xfit', 'yfit', 'ions', 'xrej', 'yrej', 'mask', 'tcent']
+
+
+def write_fit(final_fit, outfile, slit, spec=True, overwrite=False):
+    """ Add a wavelength solution to an HDF5 store, one group per slit
+    The file is created if need be and opened only for this write, so
+    solutions can be appended as a pipeline produces them
+
+    Parameters
+    ----------
+    final_fit : dict
+      From iterative_fitting()
+    outfile : str
+    slit : int or str
+      Name of the group
+    spec : bool, optional
+      Include the arc spectrum
+    overwrite : bool, optional
+      Replace a solution already stored for this slit
+    """
+    import h5py
+    with h5py.File(outfile, 'a') as hdf:
+        key = str(slit)
+        if key in hdf:
+            if not overwrite:
+                raise IOError("Slit {:s} is already in {:s};  use overwrite=True".format(key, outfile))
+            del hdf[key]
+        grp = hdf.create_group(key)
+        for item in fit_scalars:
+            if item in final_fit.keys():
+                grp.attrs[item] = final_fit[item]
+        for item in fit_arrays:
+            if item not in final_fit.keys():
+                continue
+            if item == 'ions':
+                grp[item] = np.array(final_fit[item], dtype=str).astype(bytes)
+            else:
+                grp[item] = np.asarray(final_fit[item], dtype=float if item != 'mask' else int)
+        if spec and ('spec' in final_fit.keys()):
+            grp['spec'] = np.asarray(final_fit['spec'])
+
+
+def load_fit(infile, slit):
+    """ One wavelength solution from an HDF5 store of write_fit();
+    the other slits are not read
+
+    Parameters
+    ----------
+    infile : str
+    slit : int or str
+
+    Returns
+    -------
+    final_fit : dict
+    """
+    import h5py
+    with h5py.File(infile, 'r') as hdf:
+        key = str(slit)
+        if key not in hdf:
+            raise IOError("Slit {:s} is not in {:s}".format(key, infile))
+        grp = hdf[key]
+        final_fit = {}
+        for item, value in grp.attrs.items():
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            elif isinstance(value, np.generic):
+                value = value.item()
+            final_fit[item] = value
+        for item in grp.keys():
+            final_fit[item] = grp[item][()]
+    if 'ions' in final_fit.keys():
+        final_fit['ions'] = final_fit['ions'].astype(str)
+    return final_fit
+
+
+def fit_slits(infile):
+    """ Slits in an HDF5 store of write_fit()
+
+    Parameters
+    ----------
+    infile : str
+
+    Returns
+    -------
+    slits : list of str
+    """
+    import h5py
+    with h5py.File(infile, 'r') as hdf:
+        return list(hdf.keys())
@@ -3,7 +3,9 @@
 from __future__ import (print_function, absolute_import, division, unicode_literals)
 
 import numpy as np
+import copy
 import json
+import os
 import pdb
 
 from astropy.table import Table
@@ -13,6 +15,7 @@ src_path = arclines.__path__[0]+'/data/sources/'
 
 from arclines import plots as arcl_plots
 from arclines import utils as arcl_utils
+from arclines import match as arcl_match
 
 # Hard-coded string lengths, and more
 from arclines import defs
@@ -20,16 +23,43 @@ str_len_dict = defs.str_len()
 instr_dict = defs.instruments()
 line_dict = defs.lines()
 
+# Sources already loaded in this process;  see clear_cache()
+_src_cache = {}
 
-def load(source, **kwargs):
+
+def clear_cache():
+    """ Empty the per-process cache of loaded sources
+    """
+    _src_cache.clear()
+
+
+def _src_files(src_file, format, ions):
+    """ Files a loaded source depends on, used to invalidate the cache
+    LowRedux sources are vetted against the line lists
+    """
+    files = [src_path+src_file]
+    if format == 'LRDX1':
+        from arclines.io import line_path
+        for ion in ions:
+            ion_file = line_path+'{:s}_lines.dat'.format(ion)
+            if os.path.isfile(ion_file):
+                files.append(ion_file)
+    return files
+
+
+def load(source, use_cache=True, **kwargs):
     """
     Parameters
     ----------
-    src_file
-    format
+    source : dict or Row
+      Entry in the source table
+    use_cache : bool, optional
+      Return a copy of the src_dict if this source was already loaded
+      (and has not changed since).  Never used when plotting
 
     Returns
     -------
+    src_dict : dict
 
     """
     # Parse
@@ -37,10 +67,25 @@ def load(source, **kwargs):
     format = source['Format']
     ions = source['Lines'].split(',')
     wvmnx=[source['wvmin'], source['wvmax']]
+    # Cached?
+    if kwargs.get('plot', False):
+        use_cache = False
+    if use_cache:
+        files = _src_files(src_file, format, ions)
+        key = (src_path+src_file, format, tuple(ions), tuple(wvmnx),
+               tuple(sorted(kwargs.items())))
+        stamp = tuple([os.path.getmtime(ifile) for ifile in files])
+        if key in _src_cache:
+            cstamp, src_dict = _src_cache[key]
+            if cstamp == stamp:
+                return copy.deepcopy(src_dict)
+        src_dict = load(source, use_cache=False, **kwargs)
+        _src_cache[key] = (stamp, src_dict)
+        return copy.deepcopy(src_dict)
     # Load
     if format == 'PYPIT1':
         src_dict = load_pypit(1, src_file, ions, **kwargs)
-    if format == 'PYPIT2':
+    elif format == 'PYPIT2':
         src_dict = load_pypit(2, src_file, ions, **kwargs)
     elif format == 'LRDX1':
         src_dict = load_low_redux(1, src_file, ions, wvmnx=wvmnx, **kwargs)
@@ -106,8 +151,9 @@ def load_pypit(version, src_file, ions, plot=False, **kwargs):
                             pypit_fit['function'],
                             minv=pypit_fit['fmin'], maxv=pypit_fit['fmax'])
     eamps, extras, epix = [], [], []
+    _, dwv = arcl_match.nearest(ID_lines['wave'].data, wave)
     for kk,iwave in enumerate(wave):
-        if (np.min(np.abs(ID_lines['wave'].data-iwave)) > 0.5) and (
+        if (dwv[kk] > 0.5) and (
                 iwave > mn_ID) and (iwave < mx_ID):  # NO EXTRAPOLATION
             extras.append(iwave)
             pix = int(np.round(pypit_fit['tcent'][kk]))
@@ -175,7 +221,6 @@ def load_low_redux(version, src_file, ions, plot=False, min_hist=10,
 
     import h5py
     from scipy.interpolate import interp1d
-    from arclines.pypit_utils import find_peaks
     from arclines.io import load_line_lists
 
     # Load existing line lists
@@ -190,68 +235,47 @@ def load_low_redux(version, src_file, ions, plot=False, min_hist=10,
     hdf = h5py.File(src_path+src_file,'r')
     mdict = {}
     for key in hdf['meta'].keys():
-        mdict[key] = hdf['meta'][key].value
+        mdict[key] = hdf['meta'][key][()]
+    # All the wavelength solutions at once
+    waves = np.array([hdf['arcs/'+str(ispec)+'/wave'][()]
+                      for ispec in range(mdict['nspec'])])  # vacuum
+
+    # Peaks of all the arcs
+    all_peaks = low_redux_peaks(src_file, hdf=hdf)
 
     # Loop on spec
     extras = []
     eamps = []
     for ispec in range(mdict['nspec']):
-        spec = hdf['arcs/'+str(ispec)+'/spec'].value
-        wave = hdf['arcs/'+str(ispec)+'/wave'].value # vacuum
+        wave = waves[ispec]
         disp = np.median(np.abs(wave-np.roll(wave,1)))
         npix = wave.size
-        # Find peaks for extras
-        tampl, tcent, twid, w, yprep = find_peaks(spec)
-        all_tcent = tcent[w]
+        # Peaks for extras
+        all_tcent, amps = all_peaks[ispec]
 
         # Function for more precise wavelengths
         fwv = interp1d(np.arange(npix), wave)#, kind='cubic')
-        #
-        amps = []
-        for itc in all_tcent:
-            pix = int(np.round(itc))
-            amps.append(np.max(spec[pix-1:pix+2]))
-        amps = np.array(amps)
 
         # Trim tcent on amplitude
         cut_amp = amps > cut_amp_val  # 500.
         tcent = all_tcent[cut_amp]
-        nlin = tcent.size
 
         # init with Truth
-        for ii in range(nlin):
-            wvt = float(fwv(tcent[ii]))
-            mtw = np.where(np.abs(wvdata-wvt) < 4*disp)[0]  # Deals with bad wavelength solutions
-            if len(mtw) == 0:
-                if (wvt > wvmnx[0]) & (wvt < wvmnx[1]): # LRISb only
-                    extras.append(wvt)
-                    eamps.append(amps[ii])
+        wvts = fwv(tcent)
+        _, dwv = arcl_match.nearest(wvdata, wvts)
+        # Not near a known line (deals with bad wavelength solutions)
+        #  and within the wavelength range (LRISb only)
+        keep = (~(dwv < 4*disp)) & (wvts > wvmnx[0]) & (wvts < wvmnx[1])
+        extras.append(wvts[keep])
+        # Amplitudes are (still) indexed as all the peaks, not the trimmed ones
+        eamps.append(amps[:tcent.size][keep])
     # Repackage
-    extras = np.array(extras)
+    extras = np.concatenate(extras)
     isort = np.argsort(extras)
     extras = extras[isort]
-    eamps = np.array(eamps)[isort]
-    # Group -- Super-crude friends of friends
-    final_extras = []
-    final_amps = []
-    cnt = 0
-    while cnt <= extras.size:
-        # First try
-        ingroup = np.abs(extras-extras[cnt]) < 2*disp
-        for ii in range(3):  # For some convergence
-            # Median
-            mngroup = np.median(extras[ingroup])
-            ingroup = np.abs(extras-mngroup) < 2*disp
-        if np.sum(ingroup) > min_hist:
-            final_extras.append(np.median(extras[ingroup]))
-            final_amps.append(np.median(eamps[ingroup]))
-        # Step
-        newe = mngroup + 5*disp
-        gdcnt = np.where(extras > newe)[0]
-        if len(gdcnt) == 0:
-            break
-        else:
-            cnt = gdcnt[0]
+    eamps = np.concatenate(eamps)[isort]
+    # Group
+    final_extras, final_amps = group_extras(extras, eamps, 2*disp, min_hist=min_hist)
 
     # Table
     U_lines = Table()
@@ -261,18 +285,12 @@ def load_low_redux(version, src_file, ions, plot=False, min_hist=10,
     U_lines['amplitude'] = final_amps
 
     # Find the best spectrum
-    max_nex = 0
-    for ispec in range(mdict['nspec']):
-        spec = hdf['arcs/'+str(ispec)+'/spec'].value
-        wave = hdf['arcs/'+str(ispec)+'/wave'].value # vacuum
-        minwv, maxwv = np.min(wave), np.max(wave)
-        nex = np.sum((final_extras>minwv) & (final_extras<maxwv))
-        if nex > max_nex:
-            svi = ispec
-            max_nex = nex
+    nex = np.sum((final_extras[None,:] > np.min(waves, axis=1)[:,None]) &
+                 (final_extras[None,:] < np.max(waves, axis=1)[:,None]), axis=1)
+    svi = np.argmax(nex)  # First of the best
     # Find pixel values
-    spec = hdf['arcs/'+str(svi)+'/spec'].value
-    wave = hdf['arcs/'+str(svi)+'/wave'].value  # vacuum
+    spec = hdf['arcs/'+str(svi)+'/spec'][()]
+    wave = waves[svi]
 
     # Extras
     fpix = interp1d(wave, np.arange(npix))#, kind='cubic')
@@ -299,6 +317,102 @@ def load_low_redux(version, src_file, ions, plot=False, min_hist=10,
     return mk_src_dict(U_lines=U_lines, epix=epix, spec=spec, wave=wave)
 
 
+def group_extras(extras, eamps, link, min_hist=10):
+    """ Group the extra lines found in a set of arcs
+    A crude friends of friends:  starting from the lowest line, the group
+    is the lines within link of it, re-centred 3 times on the median.
+    The next group starts at the first line 2.5*link beyond that median.
+    Groups are found by binary search in the sorted extras.
+
+    Parameters
+    ----------
+    extras : ndarray
+      Sorted wavelengths
+    eamps : ndarray
+      Their amplitudes
+    link : float
+    min_hist : int, optional
+      Keep groups of more than this many lines
+
+    Returns
+    -------
+    final_extras, final_amps : ndarray
+      Median wavelength and amplitude of each group
+    """
+    def members(wv):
+        # Same as np.abs(extras-wv) < link;  a contiguous range of extras
+        i0 = max(np.searchsorted(extras, wv-link, side='left')-1, 0)
+        i1 = min(np.searchsorted(extras, wv+link, side='right')+1, extras.size)
+        ingroup = np.where(np.abs(extras[i0:i1]-wv) < link)[0]
+        if ingroup.size == 0:
+            return slice(0, 0)
+        return slice(i0+ingroup[0], i0+ingroup[-1]+1)
+    final_extras, final_amps = [], []
+    cnt = 0
+    while cnt < extras.size:
+        ingroup = members(extras[cnt])
+        for ii in range(3):  # For some convergence
+            mngroup = np.median(extras[ingroup])
+            ingroup = members(mngroup)
+        if (ingroup.stop-ingroup.start) > min_hist:
+            final_extras.append(np.median(extras[ingroup]))
+            final_amps.append(np.median(eamps[ingroup]))
+        # Step
+        cnt = np.searchsorted(extras, mngroup + 2.5*link, side='right')
+    return np.array(final_extras), np.array(final_amps)
+
+
+def low_redux_peaks(src_file, hdf=None):
+    """ Peaks in each arc of a LowRedux source
+    These are saved next to the source in an .npz file (when the folder
+    is writable), and only found again if the source has changed
+
+    Parameters
+    ----------
+    src_file : str
+    hdf : h5py.File, optional
+      The opened source
+
+    Returns
+    -------
+    peaks : list of tuples
+      (tcent, amps) for each arc
+    """
+    from arclines.pypit_utils import find_peaks_2d
+    peak_file = src_path+src_file.replace('.hdf5', '_peaks.npz')
+    stamp = os.path.getmtime(src_path+src_file)
+    # Saved?
+    if os.path.isfile(peak_file):
+        saved = np.load(peak_file)
+        if float(saved['stamp']) == stamp:
+            offsets = saved['offsets']
+            return [(saved['tcent'][i0:i1], saved['amps'][i0:i1])
+                    for i0, i1 in zip(offsets[:-1], offsets[1:])]
+    # Find
+    if hdf is None:
+        import h5py
+        hdf = h5py.File(src_path+src_file,'r')
+    specs = np.array([hdf['arcs/'+str(ispec)+'/spec'][()]
+                      for ispec in range(int(hdf['meta/nspec'][()]))])
+    offsets, _, tcent, _ = find_peaks_2d(specs, method='curve_fit')
+    # Amplitude is the max of the 3 pixels at the peak
+    islit = np.repeat(np.arange(specs.shape[0]), np.diff(offsets))
+    pix = np.round(tcent).astype(int)
+    amps = np.max(np.stack([specs[islit, np.clip(pix+ii, 0, specs.shape[1]-1)]
+                            for ii in [-1, 0, 1]]), axis=0).astype(float)
+    peaks = [(tcent[i0:i1], amps[i0:i1]) for i0, i1 in zip(offsets[:-1], offsets[1:])]
+    # Save, if we can (e.g. not in a read-only install)
+    offsets = np.cumsum([0]+[len(tcent) for tcent, _ in peaks])
+    try:
+        np.savez(peak_file, stamp=stamp, offsets=offsets,
+                 tcent=np.concatenate([tcent for tcent, _ in peaks]+[np.zeros(0)]),
+                 amps=np.concatenate([amps for _, amps in peaks]+[np.zeros(0)]))
+    except (IOError, OSError) as err:
+        import warnings
+        warnings.warn("Could not save the peaks of {:s}: {}".format(src_file, err))
+    return peaks
+
+
 def mk_src_dict(**kwargs):
     """
     Parameters
@@ -0,0 +1,105 @@
+""" Module for matching wavelengths to line lists
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import numpy as np
+
+
+def sort_lines(waves):
+    """ Sort a line list for repeated matching
+
+    Parameters
+    ----------
+    waves : ndarray
+
+    Returns
+    -------
+    isort : ndarray
+      Stable argsort of waves;  pass to nearest() or within()
+    """
+    return np.argsort(np.asarray(waves, dtype=float), kind='mergesort')
+
+
+def nearest(waves, query, isort=None):
+    """ Nearest line to each query wavelength, by binary search
+
+    Same as np.argmin(np.abs(waves-query)) for each query, except for a query
+    exactly midway between two lines, which goes to the lower wavelength.
+    Of several lines at the same wavelength, the first one in waves is returned.
+
+    Parameters
+    ----------
+    waves : ndarray
+      Line list wavelengths;  need not be sorted
+    query : float or ndarray
+      Wavelengths to match
+    isort : ndarray, optional
+      From sort_lines(waves);  saves the sort when matching repeatedly
+
+    Returns
+    -------
+    idx : ndarray
+      Index into waves of the nearest line
+    dwv : ndarray
+      Absolute distance to that line
+    """
+    waves = np.asarray(waves, dtype=float)
+    query = np.atleast_1d(np.asarray(query, dtype=float))
+    if waves.size == 0:
+        raise ValueError("Cannot match to an empty line list")
+    if isort is None:
+        isort = sort_lines(waves)
+    swave = waves[isort]
+    # Neighbours in the sorted list
+    pos = np.searchsorted(swave, query, side='left')
+    left = np.clip(pos-1, 0, swave.size-1)
+    right = np.clip(pos, 0, swave.size-1)
+    use_right = np.abs(swave[right]-query) < np.abs(swave[left]-query)
+    jj = np.where(use_right, right, left)
+    # First of any run of equal wavelengths
+    jj = np.searchsorted(swave, swave[jj], side='left')
+    idx = isort[jj]
+    return idx, np.abs(waves[idx]-query)
+
+
+def within(waves, query, tol, isort=None):
+    """ All lines within a tolerance of each query wavelength, by binary search
+
+    Same lines as np.where(np.abs(waves-query) < tol)[0] for each query
+
+    Parameters
+    ----------
+    waves : ndarray
+      Line list wavelengths;  need not be sorted
+    query : float or ndarray
+      Wavelengths to match
+    tol : float
+    isort : ndarray, optional
+      From sort_lines(waves)
+
+    Returns
+    -------
+    offsets : ndarray (nquery+1)
+      Matches of query ii are idx[offsets[ii]:offsets[ii+1]]
+    idx : ndarray
+      Indices into waves, increasing for each query
+    """
+    waves = np.asarray(waves, dtype=float)
+    query = np.atleast_1d(np.asarray(query, dtype=float))
+    if isort is None:
+        isort = sort_lines(waves)
+    swave = waves[isort]
+    # Candidate ranges, padded by one line for round-off
+    lo = np.maximum(np.searchsorted(swave, query-tol, side='left')-1, 0)
+    hi = np.minimum(np.searchsorted(swave, query+tol, side='right')+1, swave.size)
+    ncand = np.maximum(hi-lo, 0)
+    iquery = np.repeat(np.arange(query.size), ncand)
+    cstart = np.concatenate([[0], np.cumsum(ncand)[:-1]]).astype(int)
+    jj = lo[iquery] + np.arange(iquery.size) - cstart[iquery]
+    # Exact test
+    keep = np.abs(swave[jj]-query[iquery]) < tol
+    iquery, idx = iquery[keep], isort[jj[keep]]
+    srt = np.lexsort((idx, iquery))
+    offsets = np.zeros(query.size+1, dtype=int)
+    offsets[1:] = np.cumsum(np.bincount(iquery, minlength=query.size))
+    return offsets, idx[srt]
@@ -4,12 +4,13 @@ Avoid double dependency if possible
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
+from scipy.optimize import curve_fit
 import pdb
 
 from arclines import utils as al_utils
 
 
-def find_peaks(censpec):
+def find_peaks(censpec, method='curve_fit'):
     """
     Parameters
     ----------
@@ -17,6 +18,10 @@ def find_peaks(censpec):
     siglev
     bpfit : int, optional
       Order for background continuum
+    method : str, optional
+      Gaussian fitting engine for the line centroids
+        'curve_fit' -- one scipy curve_fit per peak (fit_arcspec)
+        'batch' -- all peaks fitted together (fit_arcspec_batch)
 
     Returns
     -------
@@ -31,16 +36,90 @@ def find_peaks(censpec):
     xrng = np.arange(float(detns.size))
 
     # Find all significant detections
-    pixt = np.where((detns > 0.0) &
-                    (detns > np.roll(detns, 1)) & (detns >= np.roll(detns, -1)) &
-                    (np.roll(detns, 1) > np.roll(detns, 2)) & (np.roll(detns, -1) > np.roll(detns, -2)) &
-                    (np.roll(detns, 2) > np.roll(detns, 3)) & (np.roll(detns, -2) > np.roll(detns, -3)))[0]
-    tampl, tcent, twid = fit_arcspec(xrng, detns, pixt, fitp)
+    pixt = np.where(detect_peaks(detns[None, :])[0])[0]
+    if method == 'curve_fit':
+        tampl, tcent, twid = fit_arcspec(xrng, detns, pixt, fitp)
+    elif method == 'batch':
+        tampl, tcent, twid = fit_arcspec_batch(xrng, detns, pixt, fitp)
+    else:
+        raise IOError("Not ready for fitting method {:s}".format(method))
     w = np.where((np.isnan(twid) == False) & (twid > 0.0) & (twid < 10.0/2.35) & (tcent > 0.0) & (tcent < xrng[-1]))
     # Return
     return tampl, tcent, twid, w, detns
 
 
+def find_peaks_2d(specs, method='batch'):
+    """ find_peaks for a stack of 1D spectra, e.g. all slits of a mask
+
+    Parameters
+    ----------
+    specs : ndarray (nslit, npix)
+    method : str, optional
+      'batch' -- fit all peaks of all spectra in one pass
+      'curve_fit' -- per-peak curve_fit, as in find_peaks
+
+    Returns
+    -------
+    offsets : ndarray (nslit+1)
+      Peaks of spectrum i are in [offsets[i]:offsets[i+1]]
+    tampl, tcent, twid : ndarray
+      Flat arrays of the good peaks of all spectra
+    """
+    fitp = 7
+    specs = np.atleast_2d(specs).astype(float)
+    nslit, npix = specs.shape
+    xrng = np.arange(float(npix))
+
+    # Find all significant detections
+    islit, pixt = np.where(detect_peaks(specs))
+    npk = pixt.size
+    if method == 'curve_fit':
+        tampl, tcent, twid = np.zeros(npk), np.zeros(npk), np.zeros(npk)
+        bounds = np.searchsorted(islit, np.arange(nslit+1))
+        for ss in range(nslit):
+            i0, i1 = bounds[ss], bounds[ss+1]
+            tampl[i0:i1], tcent[i0:i1], twid[i0:i1] = fit_arcspec(
+                xrng, specs[ss], pixt[i0:i1], fitp)
+    elif method == 'batch':
+        tampl, tcent, twid = -1.0*np.ones(npk), -1.0*np.ones(npk), -1.0*np.ones(npk)
+        gdwin, idx, wgt = arcspec_windows(pixt, fitp, npix)
+        if np.any(gdwin):
+            popt = fit_gauss_windows(xrng[idx], specs[islit[gdwin, None], idx], wgt)
+            tampl[gdwin], tcent[gdwin], twid[gdwin] = popt[:, 0], popt[:, 1], popt[:, 2]
+    else:
+        raise IOError("Not ready for fitting method {:s}".format(method))
+    # Good ones
+    gd = (np.isnan(twid) == False) & (twid > 0.0) & (twid < 10.0/2.35) & (tcent > 0.0) & (tcent < xrng[-1])
+    offsets = np.zeros(nslit+1, dtype=int)
+    offsets[1:] = np.cumsum(np.bincount(islit[gd], minlength=nslit))
+    # Return
+    return offsets, tampl[gd], tcent[gd], twid[gd]
+
+
+def detect_peaks(specs):
+    """ Local maxima along the last axis of a set of spectra
+    A peak must rise over the 3 pixels on either side
+    Wraps around at the ends (as np.roll did)
+
+    Parameters
+    ----------
+    specs : ndarray (nspec, npix)
+
+    Returns
+    -------
+    peaks : bool ndarray (nspec, npix)
+    """
+    # One padded copy; everything else is a view
+    pad = np.concatenate([specs[:, -3:], specs, specs[:, :3]], axis=1)
+    npix = specs.shape[1]
+    def shift(off):
+        return pad[:, 3+off:3+off+npix]
+    cen = shift(0)
+    return ((cen > 0.0) & (cen > shift(-1)) & (cen >= shift(1)) &
+            (shift(-1) > shift(-2)) & (shift(1) > shift(2)) &
+            (shift(-2) > shift(-3)) & (shift(2) > shift(3)))
+
+
 def fit_arcspec(xarray, yarray, pixt, fitp):
 
     # Setup the arrays with fit parameters
@@ -70,3 +149,200 @@ def fit_arcspec(xarray, yarray, pixt, fitp):
         except RuntimeError:
             pass
     return ampl, cent, widt
+
+
+def fit_arcspec_batch(xarray, yarray, pixt, fitp, maxiter=20):
+    """ Fit a Gaussian to every peak at once
+    Same windows and outputs as fit_arcspec, but all of the windows are
+    stacked into one 2D array and solved together with a vectorized
+    Levenberg-Marquardt
+
+    Parameters
+    ----------
+    xarray : ndarray
+    yarray : ndarray
+    pixt : ndarray
+      Pixel index of each peak
+    fitp : int
+      Number of pixels to fit about each peak
+    maxiter : int, optional
+      Batched LM iterations;  see fit_gauss_windows
+
+    Returns
+    -------
+    ampl, cent, widt : ndarray
+      -1 for skipped windows (as in fit_arcspec)
+      NaN for failed fits
+    """
+    sz_p = pixt.size
+    sz_a = yarray.size
+    ampl, cent, widt = -1.0*np.ones(sz_p), -1.0*np.ones(sz_p), -1.0*np.ones(sz_p)
+    if sz_p == 0:
+        return ampl, cent, widt
+
+    # Windows
+    gdwin, idx, wgt = arcspec_windows(pixt, fitp, sz_a)
+    if not np.any(gdwin):
+        return ampl, cent, widt
+
+    # Fit
+    popt = fit_gauss_windows(xarray[idx], yarray[idx], wgt, maxiter=maxiter)
+    ampl[gdwin] = popt[:, 0]
+    cent[gdwin] = popt[:, 1]
+    widt[gdwin] = popt[:, 2]
+    return ampl, cent, widt
+
+
+def arcspec_windows(pixt, fitp, npix):
+    """ Fitting windows about a set of peaks
+    Truncated at the edges of the spectrum and skipped
+    when too close to the edge, as in fit_arcspec
+
+    Parameters
+    ----------
+    pixt : ndarray
+      Pixel index of each peak
+    fitp : int
+    npix : int
+
+    Returns
+    -------
+    gdwin : bool ndarray (npeak)
+      Windows to fit
+    idx : int ndarray (ngood, fitp)
+      Pixel indices of the good windows (clipped to the spectrum)
+    wgt : ndarray (ngood, fitp)
+      0 for pixels off the spectrum
+    """
+    pixt = np.asarray(pixt).astype(int)
+    pmin = np.maximum(pixt-(fitp-1)//2, 0)
+    pmax = np.minimum(pixt-(fitp-1)//2 + fitp, npix)
+    gdwin = (pmin != pmax) & (pixt-pmin > 1) & (pmax-pixt > 1)
+    idx = pixt[gdwin, None] - (fitp-1)//2 + np.arange(fitp)[None, :]
+    wgt = ((idx >= 0) & (idx < npix)).astype(float)
+    idx = np.clip(idx, 0, npix-1)
+    return gdwin, idx, wgt
+
+
+def fit_gauss_windows(x, y, wgt, maxiter=20, ftol=1.49012e-8, xtol=1.49012e-8):
+    """ Vectorized 3 parameter Gaussian fit to a stack of windows
+
+    Parameters
+    ----------
+    x : ndarray (npeak, nwin)
+    y : ndarray (npeak, nwin)
+    wgt : ndarray (npeak, nwin)
+      1 for pixels in the fit, 0 for padding
+    maxiter : int, optional
+      Batched LM iterations;  windows not converged by then are
+      fitted one at a time with curve_fit
+    ftol : float, optional
+      Relative reduction in chi^2 for convergence
+    xtol : float, optional
+      Relative step size for convergence
+
+    Returns
+    -------
+    popt : ndarray (npeak, 3)
+      ampl, cent, sigma;  NaN for failed fits
+    """
+    npk = x.shape[0]
+    # Initial guess -- moments, as in utils.guess_gauss
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sumy = np.sum(wgt*y, axis=1)
+        cen = np.sum(wgt*y*x, axis=1)/sumy
+        sig = np.sqrt(np.abs(np.sum(wgt*(x-cen[:, None])**2*y, axis=1)/sumy))
+        incen = (wgt > 0) & (np.abs(x-cen[:, None]) < sig[:, None]/2)
+    ycen = np.where(incen, y, np.nan)
+    mx = np.full(npk, np.nan)
+    gdcen = np.any(incen, axis=1)
+    mx[gdcen] = np.nanmedian(ycen[gdcen], axis=1)
+    popt = np.vstack([mx, cen, sig]).T
+    p0 = popt.copy()
+
+    # Levenberg-Marquardt, one damping term per peak
+    active = np.all(np.isfinite(popt), axis=1)
+    converged = np.zeros(npk, dtype=bool)
+    lam = np.full(npk, 1e-3)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        chi2 = gauss_chisq(x, y, wgt, popt)
+        for _ in range(maxiter):
+            act = np.where(active)[0]
+            if act.size == 0:
+                break
+            p = popt[act]
+            dx = x[act] - p[:, 1, None]
+            ee = np.exp(-1.*dx**2/2/p[:, 2, None]**2)
+            mod = p[:, 0, None]*ee
+            # Jacobian (nact, nwin, 3)
+            jac = np.empty(dx.shape + (3,))
+            jac[:, :, 0] = ee
+            jac[:, :, 1] = mod*dx/p[:, 2, None]**2
+            jac[:, :, 2] = mod*dx**2/p[:, 2, None]**3
+            wjac = jac*wgt[act, :, None]
+            jtj = np.einsum('nki,nkj->nij', wjac, jac)
+            jtr = np.einsum('nki,nk->ni', wjac, y[act]-mod)
+            # Damp
+            diag = np.einsum('nii->ni', jtj)
+            alpha = jtj.copy()
+            alpha[:, np.arange(3), np.arange(3)] += lam[act, None]*diag
+            # Guard against singular systems
+            det = np.linalg.det(alpha)
+            bad = ~np.isfinite(det) | (np.abs(det) < 1e-300)
+            alpha[bad] = np.eye(3)
+            step = np.linalg.solve(alpha, jtr[:, :, None])[:, :, 0]
+            step[bad] = np.nan
+            # Test the step
+            trial = p + step
+            new_chi2 = gauss_chisq(x[act], y[act], wgt[act], trial)
+            better = np.isfinite(new_chi2) & (new_chi2 <= chi2[act])
+            ibetter = act[better]
+            # Convergence
+            small_step = np.all(np.abs(step) <= xtol*(np.abs(p)+xtol), axis=1)
+            small_chi = np.abs(chi2[act]-new_chi2) <= ftol*chi2[act]
+            done = better & (small_step | small_chi)
+            # Update
+            popt[ibetter] = trial[better]
+            chi2[ibetter] = new_chi2[better]
+            lam[ibetter] /= 10.
+            lam[act[~better]] *= 10.
+            # Stalled at the minimum
+            done |= (~better) & (small_step | (lam[act] > 1e10))
+            converged[act[done]] = True
+            active[act[done]] = False
+            # Failures
+            dead = ~np.isfinite(step).all(axis=1) & ~better
+            active[act[dead]] = False
+
+    popt[~converged] = np.nan
+    # Stragglers (e.g. very narrow noise spikes, with a long flat chi^2
+    # valley) would hold the whole stack for maxiter iterations;  they
+    # get a curve_fit of their own from the same start, as in fit_arcspec
+    for kk in np.where(~converged & np.all(np.isfinite(p0), axis=1))[0]:
+        gd = wgt[kk] > 0
+        try:
+            popt[kk] = curve_fit(al_utils.gauss_3deg, x[kk, gd], y[kk, gd], p0=p0[kk])[0]
+        except RuntimeError:
+            pass
+    # No amplitude guess;  curve_fit hands back the moments
+    nomx = ~gdcen & np.isfinite(cen) & np.isfinite(sig)
+    popt[nomx, 0] = np.nan
+    popt[nomx, 1] = cen[nomx]
+    popt[nomx, 2] = sig[nomx]
+    return popt
+
+
+def gauss_chisq(x, y, wgt, p):
+    """ chi^2 for a stack of 3 parameter Gaussians
+
+    Parameters
+    ----------
+    x, y, wgt : ndarray (npeak, nwin)
+    p : ndarray (npeak, 3)
+
+    Returns
+    -------
+    chi2 : ndarray (npeak)
+    """
+    mod = p[:, 0, None]*np.exp(-1.*(x-p[:, 1, None])**2/2/p[:, 2, None]**2)
+    return np.sum(wgt*(y-mod)**2, axis=1)
@@ -103,6 +103,11 @@ def main(args=None):
 
     if unknwns is not None:
         ll.append(unknwns)
+
+    # Compiled line database
+    if pargs.write:
+        build_lists.compile_line_db()
+
     # Loop to my loop
     print("=============================================================")
     print("Working on plot for {:s}".format(source['File']))
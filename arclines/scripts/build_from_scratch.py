@@ -17,7 +17,9 @@ def parser(options=None):
     parser = argparse.ArgumentParser(
         description='Build the arclines line lists from scratch')
     parser.add_argument("-w", "--write", default=False, action='store_true', help="Actually write files?")
-    parser.add_argument("--skip_stop", default=False, action='store_true', help="Skip warning stop?")
+    parser.add_argument("--skip_stop", default=False, action='store_true', help="No longer used;  the build does not stop")
+    parser.add_argument("-j", "--jobs", default=1, type=int, help="Number of processes for reading the sources")
+    parser.add_argument("--no_cache", default=False, action='store_true', help="Re-read all sources, ignoring the build cache")
     parser.add_argument("--unknowns", default=False, action='store_true', help="Create Unknown list?")
     parser.add_argument("--plots", default=False, action='store_true', help="Create plots?")
 
@@ -51,28 +53,18 @@ def main(args=None):
 
     print("=============================================================")
     print("This script is for EXPERTS ONLY")
-    print("Continue only if you know what you are doing")
-    print("Otherwise exit")
-    print("p.s.  You need to remove the files you wish to re-build")
+    print("p.s.  Files are only written with --write")
     print("=============================================================")
-    if not pargs.skip_stop:
-        pdb.set_trace()
 
     # Load sources
     sources = arcl_io.load_source_table()
 
-    # IDs
-    llist_dict = {}
-    if (not pargs.unknowns) and (not pargs.plots):
-        for kk,source in enumerate(sources):
-            print("=============================================================")
-            print("Working on adding IDs from source {:s}".format(source['File']))
-            print("=============================================================")
-            llist_dict = build_lists.source_to_line_lists(source, write=pargs.write,
-                                             llist_dict=llist_dict)
-        # By-hand
-        build_lists.by_hand(llist_dict, write=pargs.write)
-
+    # IDs and Unknowns
+    if not pargs.plots:
+        cache_path = '' if pargs.no_cache else None
+        build_lists.build_all(sources, jobs=pargs.jobs, write=pargs.write,
+                              line_lists=not pargs.unknowns, unknowns=pargs.unknowns,
+                              cache_path=cache_path)
         # Write?
         if not pargs.write:
             print("=============================================================")
@@ -80,15 +72,6 @@ def main(args=None):
             print("=============================================================")
         return
 
-    # Unknowns
-    if pargs.unknowns:
-        # Load all line lists
-        for kk,source in enumerate(sources):
-            print("=============================================================")
-            print("Working on adding Unknowns from source {:s}".format(source['File']))
-            print("=============================================================")
-            build_lists.source_to_unknowns(source, write=pargs.write)
-
     # Plots
     if pargs.plots:
         # Load all line lists
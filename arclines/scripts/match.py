@@ -26,6 +26,9 @@ def parser(options=None):
     parser.add_argument("--fit", default=False, action='store_true', help="Fit the lines?")
     parser.add_argument("--brute", default=False, action='store_true', help="Use semi_brute?")
     parser.add_argument("--show_spec", default=False, action='store_true', help="Show the input spectrum?")
+    parser.add_argument("--hdf5", type=str, help="Append the fit to this HDF5 solution store instead of writing JSON")
+    parser.add_argument("--slit", default='0', type=str, help="Slit name in the HDF5 store [default: 0]")
+    parser.add_argument("--no_spec", default=False, action='store_true', help="Leave the spectrum out of the HDF5 store")
 
     if options is None:
         args = parser.parse_args()
@@ -85,6 +88,9 @@ def main(pargs=None):
         pdb.set_trace()
 
     if pargs.fit:
-        ltu.savejson(pargs.outroot+'_fit.json', ltu.jsonify(final_fit), easy_to_read=True, overwrite=True)
+        if pargs.hdf5 is not None:
+            arcl_io.write_fit(final_fit, pargs.hdf5, pargs.slit, spec=not pargs.no_spec, overwrite=True)
+        else:
+            ltu.savejson(pargs.outroot+'_fit.json', ltu.jsonify(final_fit), easy_to_read=True, overwrite=True)
 
 
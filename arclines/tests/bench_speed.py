@@ -0,0 +1,258 @@
+""" Timing benchmarks for the speed-critical parts of arclines
+Run as a script;  not part of the test suite
+"""
+from __future__ import (print_function, absolute_import, division, unicode_literals)
+
+import numpy as np
+import glob
+import json
+import time
+import warnings
+
+import arclines
+test_arc_path = arclines.__path__[0]+'/data/test_arcs/'
+
+
+def load_test_arcs():
+    """ Load the spectra in data/test_arcs
+
+    Returns
+    -------
+    arcs : dict
+      spec keyed by file name
+    """
+    arcs = {}
+    for jfile in sorted(glob.glob(test_arc_path+'*.json')):
+        with open(jfile, 'r') as f:
+            pypit_fit = json.load(f)
+        if 'spec' not in pypit_fit.keys():  # PYPIT2
+            pypit_fit = pypit_fit['0']
+        arcs[jfile.split('/')[-1]] = np.array(pypit_fit['spec'])
+    return arcs
+
+
+def bench_find_peaks(ntrial=5):
+    """ Per-peak curve_fit vs. the batched Gaussian fitter
+    """
+    from arclines.pypit_utils import find_peaks
+    arcs = load_test_arcs()
+    print("Arc                           npeak  curve_fit(s)  batch(s)  speedup  max|dcen|")
+    for key, spec in arcs.items():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            t0 = time.time()
+            for ii in range(ntrial):
+                tampl, tcent, twid, w, _ = find_peaks(spec)
+            t1 = time.time()
+            for ii in range(ntrial):
+                bampl, bcent, bwid, bw, _ = find_peaks(spec, method='batch')
+            t2 = time.time()
+        both = np.intersect1d(w[0], bw[0])
+        dcen = np.max(np.abs(tcent[both]-bcent[both]))
+        print("{:30s} {:4d}  {:10.4f}  {:9.4f}  {:6.1f}  {:9.2e}".format(
+            key, w[0].size, (t1-t0)/ntrial, (t2-t1)/ntrial, (t1-t0)/(t2-t1), dcen))
+
+
+def bench_find_peaks_2d(nslit=100):
+    """ Looping find_peaks over slits vs. one find_peaks_2d call
+    """
+    from arclines.pypit_utils import find_peaks, find_peaks_2d
+    arcs = load_test_arcs()
+    spec = arcs['lrisr_600_7500_PYPIT.json']
+    # Fake a multi-slit frame by shifting the arc
+    specs = np.array([np.roll(spec, 3*ii) for ii in range(nslit)])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        t0 = time.time()
+        for ii in range(nslit):
+            find_peaks(specs[ii])
+        t1 = time.time()
+        offsets, tampl, tcent, twid = find_peaks_2d(specs)
+        t2 = time.time()
+    print("{:d} slits, {:d} peaks: loop={:.3f}s, 2D={:.3f}s, speedup={:.1f}".format(
+        nslit, offsets[-1], t1-t0, t2-t1, (t1-t0)/(t2-t1)))
+
+
+def bench_line_lists(nspec=100, lines=('ArI','HgI','KrI','NeI','XeI')):
+    """ Loading the line lists once per spectrum, without and with the cache
+    """
+    from arclines import io as arcl_io
+    lines = list(lines)
+    times = []
+    for use_cache in [False, True]:
+        arcl_io.clear_cache()
+        t0 = time.time()
+        for ii in range(nspec):
+            arcl_io.load_line_lists(lines, use_cache=use_cache)
+            arcl_io.load_unknown_list(lines, use_cache=use_cache)
+        times.append(time.time()-t0)
+    print("{:d} spectra, lines={}: per-call no cache={:.4f}s, cache={:.4f}s, speedup={:.1f}".format(
+        nspec, lines, times[0]/nspec, times[1]/nspec, times[0]/times[1]))
+
+
+def bench_nearest(nline=300, niter=4):
+    """ Re-identification step of iterative_fitting on the OH_R24000 list:
+    argmin per detected line vs. binary search for all of them
+    """
+    from arclines import io as arcl_io
+    from arclines import match as arcl_match
+    llist = arcl_io.load_line_lists(['OH_R24000'])
+    waves = np.array(llist['wave'])
+    rstate = np.random.RandomState(1234)
+    twave = np.sort(rstate.uniform(waves.min(), waves.max(), nline))
+    t0 = time.time()
+    for ii in range(niter):
+        imn = [np.argmin(np.abs(iwave-waves)) for iwave in twave]
+    t1 = time.time()
+    isort = arcl_match.sort_lines(waves)
+    for ii in range(niter):
+        idx, dwv = arcl_match.nearest(waves, twave, isort=isort)
+    t2 = time.time()
+    assert np.all(idx == np.array(imn))
+    print("{:d} lines vs {:d} OH lines, {:d} iterations: argmin={:.4f}s, nearest={:.4f}s, speedup={:.1f}".format(
+        nline, waves.size, niter, t1-t0, t2-t1, (t1-t0)/(t2-t1)))
+
+
+def bench_robust_polyfit(noutlier=10, niter=20):
+    """ robust_polyfit on the test-arc IDs with injected outliers:
+    one rejection per refit vs. up to 5
+    Iterations are the least-squares solves per call;  one solve fits
+    every guess of an iteration with maxrej=5
+    """
+    from arclines import utils as arcl_utils
+    rstate = np.random.RandomState(1234)
+    # Count the solves
+    nsolve = [0]
+    def counted(func):
+        def wrapper(*args, **kwargs):
+            nsolve[0] += 1
+            return func(*args, **kwargs)
+        return wrapper
+    lstsq_fit, stacked_lstsq = arcl_utils.lstsq_fit, arcl_utils._stacked_lstsq
+    arcl_utils.lstsq_fit = counted(lstsq_fit)
+    arcl_utils._stacked_lstsq = counted(stacked_lstsq)
+    for jfile in sorted(glob.glob(test_arc_path+'*.json')):
+        with open(jfile, 'r') as f:
+            pypit_fit = json.load(f)
+        if 'xfit' not in pypit_fit.keys():  # PYPIT2
+            pypit_fit = pypit_fit['0']
+        xfit = np.array(pypit_fit['xfit'])
+        yfit = np.array(pypit_fit['yfit'])
+        xmin, xmax = xfit.min(), xfit.max()
+        bad = rstate.choice(xfit.size, min(noutlier, xfit.size//3), replace=False)
+        yfit[bad] += rstate.uniform(20., 50., bad.size)*rstate.choice([-1,1], bad.size)
+        times, masks = [], []
+        for maxrej in [1, 5]:
+            nsolve[0] = 0
+            t0 = time.time()
+            for ii in range(niter):
+                mask, fit = arcl_utils.robust_polyfit(xfit, yfit, 3, function='legendre',
+                                                      sigma=2., minv=xmin, maxv=xmax, maxrej=maxrej)
+            times.append((time.time()-t0)/niter)
+            masks.append(mask)
+            rms = arcl_utils.calc_fit_rms(xfit[mask == 0], yfit[mask == 0], fit, 'legendre',
+                                          minv=xmin, maxv=xmax)
+            print("{:s}: maxrej={:d}, nrej={:d}, iterations={:d}, rms={:g}".format(
+                jfile.split('/')[-1], maxrej, int(np.sum(mask)), nsolve[0]//niter, rms))
+        assert np.all(masks[0] == masks[1])
+        print("  {:d} IDs: maxrej=1 {:.5f}s, maxrej=5 {:.5f}s, speedup={:.1f}".format(
+            xfit.size, times[0], times[1], times[0]/times[1]))
+    arcl_utils.lstsq_fit, arcl_utils._stacked_lstsq = lstsq_fit, stacked_lstsq
+
+
+def bench_func_batch(nsol=500, npix=4096, nline=50, deg=4):
+    """ Evaluate and fit many solutions: func_val/func_fit in a loop vs. batched
+    """
+    from arclines import utils as arcl_utils
+    rstate = np.random.RandomState(1234)
+    coeffs = rstate.normal(size=(nsol, deg+1))
+    for npt, label in [(npix, 'full spectra'), (nline, 'line lists')]:
+        x = rstate.uniform(0., 1., (nsol, npt))
+        t0 = time.time()
+        values = np.array([arcl_utils.func_val(coeffs[ii], x[ii], 'legendre', minv=0., maxv=1.)
+                           for ii in range(nsol)])
+        t1 = time.time()
+        bvalues = arcl_utils.func_val_batch(coeffs, x, 'legendre', minv=0., maxv=1.)
+        t2 = time.time()
+        assert np.all(values == bvalues)
+        fits = np.array([arcl_utils.func_fit(x[ii], values[ii], 'legendre', deg, minv=0., maxv=1.)
+                         for ii in range(nsol)])
+        t3 = time.time()
+        bfits = arcl_utils.func_fit_batch(x, values, 'legendre', deg, minv=0., maxv=1.)
+        t4 = time.time()
+        print("{:d} solutions, {:d} points each ({:s}): func_val={:.4f}s, batch={:.4f}s;  func_fit={:.4f}s, batch={:.4f}s, max dcoeff={:g}".format(
+            nsol, npt, label, t1-t0, t2-t1, t3-t2, t4-t3, np.max(np.abs(fits-bfits))))
+
+
+def bench_wavelength_image(nslit=100, shape=(4096, 4096)):
+    """ Wavelength image of a full frame:  one func_val and mask per slit
+    vs. wavelength_image
+    """
+    from arclines.utils import func_val
+    from arclines.holy import fitting as arch_fit
+    from arclines.holy import templates as arch_tmpl
+    nspec, ncol = shape
+    tfits = [tmpl['fit'] for tmpl in arch_tmpl.load_templates()]
+    fits = [dict(tfits[kk % len(tfits)], xnorm=float(nspec)) for kk in range(nslit)]
+    width = ncol // nslit
+    rows = np.arange(nspec)
+    traces = [(width*kk+2.+0.001*rows, width*(kk+1)-3.+0.001*rows) for kk in range(nslit)]
+    slitmask = arch_fit.slitmask_from_traces(traces, shape)
+    t0 = time.time()
+    waveimg = np.zeros(shape, dtype=np.float32) + np.nan
+    for kk, fit in enumerate(fits):
+        wave = func_val(fit['fitc'], rows/(fit['xnorm']-1.), fit['function'],
+                        minv=fit['fmin'], maxv=fit['fmax'])
+        r, c = np.where(slitmask == kk)
+        waveimg[r, c] = wave[r]
+    t1 = time.time()
+    bwaveimg = arch_fit.wavelength_image(fits, shape, slitmask=slitmask)
+    t2 = time.time()
+    np.testing.assert_array_equal(waveimg, bwaveimg)
+    print("{:d} slits on a {:d}x{:d} frame: per slit={:.3f}s, wavelength_image={:.3f}s, speedup={:.1f}".format(
+        nslit, nspec, ncol, t1-t0, t2-t1, (t1-t0)/(t2-t1)))
+
+
+def main(flg_tst):
+
+    # Gaussian centroiding
+    if (flg_tst % 2**1) >= 2**0:
+        bench_find_peaks()
+
+    # Multi-slit peak finding
+    if (flg_tst % 2**2) >= 2**1:
+        bench_find_peaks_2d()
+
+    # Line list loading
+    if (flg_tst % 2**3) >= 2**2:
+        bench_line_lists()
+
+    # Nearest-line matching
+    if (flg_tst % 2**4) >= 2**3:
+        bench_nearest()
+
+    # Robust fitting
+    if (flg_tst % 2**5) >= 2**4:
+        bench_robust_polyfit()
+
+    # Batched evaluation and fitting
+    if (flg_tst % 2**6) >= 2**5:
+        bench_func_batch()
+
+    # Wavelength images
+    if (flg_tst % 2**7) >= 2**6:
+        bench_wavelength_image()
+
+
+# Test
+if __name__ == '__main__':
+    flg_tst = 0
+    flg_tst += 2**0   # find_peaks
+    flg_tst += 2**1   # find_peaks_2d
+    flg_tst += 2**2   # Line list cache
+    flg_tst += 2**3   # Nearest-line matching
+    flg_tst += 2**4   # robust_polyfit
+    flg_tst += 2**5   # func_val_batch, func_fit_batch
+    flg_tst += 2**6   # wavelength_image
+
+    main(flg_tst)
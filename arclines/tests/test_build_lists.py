@@ -0,0 +1,101 @@
+# Module to run tests on arclines.build_lists
+
+
+import os
+import numpy as np
+import pytest
+
+from astropy.table import Table, vstack
+
+from arclines import build_lists
+from arclines import io as arcl_io
+
+
+def update_reference(line_list, new_lines, tol_wave, NIST_tol):
+    """ Line by line update, as in the original update_line_list
+    """
+    for line in new_lines:
+        mtch_wave = np.where(np.abs(line_list['wave']-line['wave']) < tol_wave)[0]
+        if len(mtch_wave) == 0:
+            line_list = vstack([line_list, line])
+        elif len(mtch_wave) == 1:
+            idx = mtch_wave[0]
+            if np.abs(line_list['wave'][idx]-line['wave']) > NIST_tol:
+                pass
+            elif (line_list['Instr'][idx] % (2*line['Instr'])) < line['Instr']:
+                line_list['Instr'][idx] += line['Instr']
+    line_list.sort('wave')
+    return line_list
+
+
+def test_update_line_list():
+    line_list = arcl_io.load_line_list('ArI', use_ion=True)
+    rstate = np.random.RandomState(1234)
+    # Existing lines, near misses, new lines and close pairs of new lines
+    waves = np.concatenate([line_list['wave'][::3], line_list['wave'][1::5]+0.05,
+                            rstate.uniform(3000., 10000., 20), [5000., 5000.05, 5000.3]])
+    new_lines = Table()
+    new_lines['ion'] = ['ArI']*waves.size
+    new_lines['wave'] = waves
+    new_lines['NIST'] = 1
+    new_lines['amplitude'] = 100
+    build_lists.add_instr_source(new_lines, 'NIRSPEC', 'test.json')
+    ref = update_reference(line_list.copy(), new_lines, 0.1, 0.0001)
+    new_list, updated, report = build_lists.update_line_list(line_list.copy(), new_lines,
+                                                             None, None)
+    assert updated
+    assert len(new_list) == len(ref)
+    assert np.all(new_list['wave'] == ref['wave'])
+    assert np.all(new_list['Instr'] == ref['Instr'])
+    assert len(report['added']) == len(new_list)-len(line_list)
+    assert np.all(report['conflicts']['conflict'] == 'Bad match for a NIST line')
+    assert len(report['conflicts']) > 0
+
+
+def test_build_all(tmpdir, monkeypatch):
+    # Serial, source by source, into an empty line list folder
+    monkeypatch.setattr(build_lists, 'llist_path', str(tmpdir.mkdir('lists'))+'/')
+    sources = arcl_io.load_source_table()
+    sources = sources[[os.path.isfile(build_lists.src_path+sfile) for sfile in sources['File']]]
+    llist_dict = {}
+    for source in sources:
+        llist_dict = build_lists.source_to_line_lists(source, llist_dict=llist_dict)
+    build_lists.by_hand(llist_dict)
+    # In parallel, then again from the cache
+    cache_path = str(tmpdir.mkdir('cache'))
+    open(os.path.join(cache_path, 'stale.pkl'), 'w').close()  # Pruned
+    for jobs in [2, 2]:
+        ldict, _, manifest = build_lists.build_all(sources, jobs=jobs, unknowns=False,
+                                                   cache_path=cache_path)
+        assert list(manifest.keys()) == list(sources['File'])
+        assert sorted(ldict.keys()) == sorted(llist_dict.keys())
+        for ion in llist_dict.keys():
+            assert ldict[ion].colnames == llist_dict[ion].colnames
+            for key in llist_dict[ion].colnames:
+                assert np.all(ldict[ion][key] == llist_dict[ion][key])
+    assert os.path.isfile(os.path.join(cache_path, 'manifest.json'))
+    pkls = sorted([ifile[:-4] for ifile in os.listdir(cache_path) if ifile.endswith('.pkl')])
+    assert pkls == sorted(manifest.values())
+
+
+def test_build_key(tmpdir, monkeypatch):
+    # LowRedux sources depend on the line lists on disk
+    monkeypatch.setattr(arcl_io, 'line_path', str(tmpdir)+'/')
+    lrdx = dict(File='kastb_600_PYPIT.json', Instr='KASTb', Lines='CdI,HgI', wvmin=0., wvmax=1e9,
+                Format='LRDX1')
+    pypit = dict(lrdx, Format='PYPIT1')
+    keys = [build_lists.build_key(lrdx)]
+    pkey = build_lists.build_key(pypit)
+    # New line list
+    with open(str(tmpdir.join('CdI_lines.dat')), 'w') as f:
+        f.write('# CdI\n')
+    keys.append(build_lists.build_key(lrdx))
+    # Updated line list
+    with open(str(tmpdir.join('CdI_lines.dat')), 'a') as f:
+        f.write('  wave\n')
+    keys.append(build_lists.build_key(lrdx))
+    # Unknowns
+    keys.append(build_lists.build_key(lrdx, unknowns=False))
+    assert len(set(keys)) == len(keys)
+    assert build_lists.build_key(lrdx) == keys[2]
+    assert build_lists.build_key(pypit) == pkey
@@ -2,6 +2,7 @@
 
 
 import numpy as np
+import json
 import os
 import pytest
 
@@ -48,3 +49,147 @@ def test_load_nist():
     for key in ['wave','Aki','RelInt','Ion','NIST']:
         assert key in line_lists.keys()
 
+
+
+def test_line_list_cache(tmpdir):
+    import shutil
+    arcl_io.clear_cache()
+    lines = ['HgI','ZnI']
+    ref = arcl_io.load_line_lists(lines, unknown=True, use_cache=False)
+    line_lists = arcl_io.load_line_lists(lines, unknown=True)
+    assert np.all(line_lists['wave'] == ref['wave'])
+    # Copies
+    line_lists['wave'][0] = -1.
+    line_lists = arcl_io.load_line_lists(lines, unknown=True)
+    assert np.all(line_lists['wave'] == ref['wave'])
+    # Modified file
+    line_file = str(tmpdir.join('HgI_lines.dat'))
+    shutil.copy(arclines.__path__[0]+'/data/lists/HgI_lines.dat', line_file)
+    llst = arcl_io.load_line_list(line_file)
+    llst['wave'][0] = 1234.
+    llst.write(line_file, format='ascii.fixed_width', overwrite=True)
+    os.utime(line_file, (1., 1.))
+    llst2 = arcl_io.load_line_list(line_file)
+    assert llst2['wave'][0] == 1234.
+    # Clear
+    arcl_io.clear_cache()
+    assert len(arcl_io._table_cache) == 0
+
+
+def test_line_db(tmpdir, monkeypatch):
+    from arclines import build_lists
+    db_file = str(tmpdir.join('line_db.npy'))
+    build_lists.compile_line_db(outfile=db_file)
+    assert arcl_io.line_db_is_current(db_file)
+    db, meta = arcl_io.load_line_db(db_file)
+    assert isinstance(db, np.memmap)
+    assert np.all(np.diff(db['ion_code']) >= 0)
+    # Same tables as the ASCII files
+    arcl_io.clear_cache()
+    ref = {}
+    for unknown in [False, True]:
+        ref[unknown] = arcl_io.load_line_lists(['ArI','HgI','OH_R24000'], unknown=unknown,
+                                               use_cache=False)
+    ref_unk = arcl_io.load_unknown_list(['ArI','HgI'], use_cache=False)
+    monkeypatch.setattr(arcl_io, 'line_db_file', db_file)
+    for unknown in [False, True]:
+        line_lists = arcl_io.load_line_lists(['ArI','HgI','OH_R24000'], unknown=unknown,
+                                             use_cache=False)
+        assert line_lists.keys() == ref[unknown].keys()
+        for key in line_lists.keys():
+            assert line_lists[key].dtype == ref[unknown][key].dtype
+            assert np.all(line_lists[key] == ref[unknown][key])
+    unk = arcl_io.load_unknown_list(['ArI','HgI'], use_cache=False)
+    assert np.all(unk['wave'] == ref_unk['wave'])
+    assert np.all(unk['line_flag'] == ref_unk['line_flag'])
+    # A line list that is not in the database is read from its file
+    meta_file = arcl_io.line_db_meta_file(db_file)
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    meta['ions'].remove('HgI')
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    assert arcl_io.line_db_is_current(db_file)
+    line_lists = arcl_io.load_line_lists(['ArI','HgI','OH_R24000'], use_cache=False)
+    for key in line_lists.keys():
+        assert np.all(line_lists[key] == ref[False][key])
+
+
+def nist_relint_reference(nist_file):
+    """ Row-by-row Rel. parsing of load_line_list(NIST=True) and load_nist
+    """
+    tbl = Table.read(nist_file, format='ascii.fixed_width')
+    reli = []
+    for imsk, idat in zip(tbl['Rel.'].mask, tbl['Rel.'].data):
+        if imsk:
+            reli.append(0.)
+        else:
+            try:
+                reli.append(float(idat))
+            except ValueError:
+                try:
+                    reli.append(float(idat[:-1]))
+                except ValueError:
+                    reli.append(0.)
+    reli = np.array(reli)[tbl['Observed'] > 0.]
+    # load_nist
+    nist_tbl = tbl[tbl['Observed'] > 0.]
+    uniq, indices = np.unique(nist_tbl['Observed'], return_index=True)
+    nist_tbl = nist_tbl[indices]
+    agdrel = []
+    for row in nist_tbl:
+        try:
+            gdrel = int(row['Rel.'])
+        except:
+            try:
+                gdrel = int(row['Rel.'][:-1])
+            except:
+                gdrel = 0
+        agdrel.append(gdrel)
+    return reli, np.array(agdrel)
+
+
+def test_nist_relint():
+    import glob
+    nist_files = glob.glob(arclines.__path__[0]+'/data/NIST/*_vacuum.ascii')
+    assert len(nist_files) > 0
+    for nist_file in nist_files:
+        reli, agdrel = nist_relint_reference(nist_file)
+        tbl = arcl_io.load_line_list(nist_file, NIST=True, use_cache=False)
+        assert tbl['RelInt'].dtype == reli.dtype
+        assert np.all(tbl['RelInt'] == reli)
+        ion = os.path.basename(nist_file).split('_')[0]
+        nist_tbl = arcl_io.load_nist(ion, use_cache=False)
+        assert nist_tbl['RelInt'].dtype == agdrel.dtype
+        assert np.all(nist_tbl['RelInt'] == agdrel)
+        # Cached
+        assert np.all(arcl_io.load_nist(ion)['RelInt'] == agdrel)
+
+
+def test_fit_store(tmpdir):
+    rstate = np.random.RandomState(1234)
+    final_fit = dict(fitc=rstate.normal(size=5), function='legendre', xfit=rstate.uniform(size=20),
+                     yfit=rstate.uniform(4000., 6000., 20), ions=np.array(['HgI']*10+['ArI']*10),
+                     fmin=0., fmax=1., xnorm=2048., xrej=[], yrej=[], mask=np.zeros(21, dtype=int),
+                     spec=rstate.uniform(size=2048), nrej=3., shift=0., tcent=rstate.uniform(0., 2048., 30),
+                     rms=np.float64(0.05))
+    outfile = str(tmpdir.join('fits.hdf5'))
+    # Append, one slit at a time
+    arcl_io.write_fit(final_fit, outfile, 0)
+    arcl_io.write_fit(final_fit, outfile, 'slit1', spec=False)
+    assert arcl_io.fit_slits(outfile) == ['0', 'slit1']
+    with pytest.raises(IOError):
+        arcl_io.write_fit(final_fit, outfile, 0)
+    # Read back
+    fit0 = arcl_io.load_fit(outfile, 0)
+    for key, value in final_fit.items():
+        assert np.all(np.asarray(fit0[key]) == np.asarray(value)), key
+    assert fit0['function'] == 'legendre'
+    assert isinstance(fit0['rms'], float)
+    fit1 = arcl_io.load_fit(outfile, 'slit1')
+    assert 'spec' not in fit1.keys()
+    # Replace
+    arcl_io.write_fit(dict(final_fit, rms=0.1), outfile, 0, overwrite=True)
+    assert arcl_io.load_fit(outfile, 0)['rms'] == 0.1
+    with pytest.raises(IOError):
+        arcl_io.load_fit(outfile, 2)
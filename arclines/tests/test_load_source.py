@@ -0,0 +1,118 @@
+# Module to run tests on loading sources
+
+
+import numpy as np
+import os
+import pytest
+
+from arclines import io as arcl_io
+from arclines import load_source
+
+
+def data_path(filename):
+    data_dir = os.path.join(os.path.dirname(__file__), 'files')
+    return os.path.join(data_dir, filename)
+
+
+def test_load_cache():
+    sources = arcl_io.load_source_table()
+    source = sources[sources['File'] == 'kastb_600_PYPIT.json'][0]
+    load_source.clear_cache()
+    src_dict = load_source.load(source, use_cache=False)
+    cdict = load_source.load(source)
+    # Modify the copy we got back
+    cdict['ID_lines']['wave'][0] = -1.
+    cdict['spec'][:] = 0.
+    cdict = load_source.load(source)
+    for key in ['ID_lines', 'U_lines']:
+        for col in src_dict[key].colnames:
+            assert np.all(cdict[key][col] == src_dict[key][col])
+    for key in ['spec', 'wave', 'xIDs']:
+        assert np.all(cdict[key] == src_dict[key])
+
+
+def test_low_redux_peaks(tmpdir, monkeypatch):
+    h5py = pytest.importorskip('h5py')
+    monkeypatch.setattr(load_source, 'src_path', str(tmpdir)+'/')
+    # Mock LowRedux source
+    specs = [arcl_io.load_spectrum(data_path(sfile)) for sfile in
+             ['LRISb_600_spec.ascii', 'LRISr_600_7500_spec.ascii']]
+    with h5py.File(str(tmpdir.join('mock_LRX.hdf5')), 'w') as hdf:
+        hdf['meta/nspec'] = len(specs)
+        for ispec, spec in enumerate(specs):
+            hdf['arcs/{:d}/spec'.format(ispec)] = spec
+    # Find, then read back
+    peaks = load_source.low_redux_peaks('mock_LRX.hdf5')
+    assert os.path.isfile(str(tmpdir.join('mock_LRX_peaks.npz')))
+    speaks = load_source.low_redux_peaks('mock_LRX.hdf5')
+    assert len(speaks) == len(specs)
+    for (tcent, amps), (stcent, samps) in zip(peaks, speaks):
+        assert tcent.size > 10
+        assert np.all(tcent == stcent)
+        assert np.all(amps == samps)
+    # Read-only install;  found again but not saved
+    def read_only(*args, **kwargs):
+        raise IOError(13, "Permission denied")
+    os.remove(str(tmpdir.join('mock_LRX_peaks.npz')))
+    monkeypatch.setattr(load_source.np, 'savez', read_only)
+    with pytest.warns(UserWarning):
+        rpeaks = load_source.low_redux_peaks('mock_LRX.hdf5')
+    assert not os.path.isfile(str(tmpdir.join('mock_LRX_peaks.npz')))
+    for (tcent, amps), (rtcent, ramps) in zip(peaks, rpeaks):
+        assert np.all(tcent == rtcent)
+        assert np.all(amps == ramps)
+
+
+def group_reference(extras, eamps, disp, min_hist):
+    """ The original friends of friends in load_low_redux
+    """
+    final_extras, final_amps = [], []
+    cnt = 0
+    while cnt <= extras.size:
+        ingroup = np.abs(extras-extras[cnt]) < 2*disp
+        for ii in range(3):
+            mngroup = np.median(extras[ingroup])
+            ingroup = np.abs(extras-mngroup) < 2*disp
+        if np.sum(ingroup) > min_hist:
+            final_extras.append(np.median(extras[ingroup]))
+            final_amps.append(np.median(eamps[ingroup]))
+        newe = mngroup + 5*disp
+        gdcnt = np.where(extras > newe)[0]
+        if len(gdcnt) == 0:
+            break
+        else:
+            cnt = gdcnt[0]
+    return np.array(final_extras), np.array(final_amps)
+
+
+def test_group_extras():
+    rstate = np.random.RandomState(1234)
+    disp = 1.26
+    # Clusters of many sizes and widths, plus noise
+    centers = np.sort(rstate.uniform(3000., 5500., 150))
+    extras = np.concatenate([cen + rstate.normal(0., rstate.uniform(0.1, 2.), rstate.randint(1, 40))
+                             for cen in centers] + [rstate.uniform(3000., 5500., 300)])
+    extras = np.sort(np.round(extras, 2))  # Some exact duplicates
+    eamps = rstate.uniform(400., 5000., extras.size)
+    for min_hist in [0, 10]:
+        fext, famp = load_source.group_extras(extras, eamps, 2*disp, min_hist=min_hist)
+        rext, ramp = group_reference(extras, eamps, disp, min_hist)
+        assert fext.size > 10
+        assert np.array_equal(fext, rext)
+        assert np.array_equal(famp, ramp)
+
+
+def test_load_low_redux(tmpdir, monkeypatch):
+    h5py = pytest.importorskip('h5py')
+    monkeypatch.setattr(load_source, 'src_path', str(tmpdir)+'/')
+    spec = arcl_io.load_spectrum(data_path('LRISb_600_spec.ascii'))
+    with h5py.File(str(tmpdir.join('mock_LRX.hdf5')), 'w') as hdf:
+        hdf['meta/nspec'] = 3
+        for ispec in range(3):
+            hdf['arcs/{:d}/spec'.format(ispec)] = spec
+            hdf['arcs/{:d}/wave'.format(ispec)] = 3000. + (1.26+0.001*ispec)*np.arange(spec.size)
+    src_dict = load_source.load_low_redux(1, 'mock_LRX.hdf5', ['CdI', 'HgI', 'ZnI'], min_hist=1)
+    U_lines = src_dict['U_lines']
+    assert len(U_lines) > 0
+    assert np.all(np.diff(U_lines['wave']) > 0.)
+    assert src_dict['spec'].size == spec.size
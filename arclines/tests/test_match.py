@@ -0,0 +1,36 @@
+# Module to run tests on arclines.match
+
+
+import numpy as np
+import pytest
+
+from arclines import io as arcl_io
+from arclines import match as arcl_match
+
+
+def test_nearest():
+    llist = arcl_io.load_line_lists(['ArI','NeI','OH_R24000'], unknown=True)
+    waves = np.array(llist['wave'])  # Not sorted
+    rstate = np.random.RandomState(1234)
+    query = np.concatenate([rstate.uniform(waves.min()-100., waves.max()+100., 1000),
+                            waves[::7]])
+    idx, dwv = arcl_match.nearest(waves, query)
+    for kk, iwave in enumerate(query):
+        assert idx[kk] == np.argmin(np.abs(waves-iwave))
+        assert dwv[kk] == np.min(np.abs(waves-iwave))
+    # Duplicates and a tie
+    waves = np.array([5., 3., 3., 1.])
+    idx, dwv = arcl_match.nearest(waves, [3., 2., 0., 6.])
+    assert idx.tolist() == [1, 3, 3, 0]
+
+
+def test_within():
+    llist = arcl_io.load_line_lists(['ArI','NeI','OH_R24000'])
+    waves = np.array(llist['wave'])
+    rstate = np.random.RandomState(1234)
+    query = rstate.uniform(waves.min(), waves.max(), 500)
+    offsets, idx = arcl_match.within(waves, query, 5.)
+    assert offsets.size == query.size+1
+    for kk, iwave in enumerate(query):
+        mtch = np.where(np.abs(waves-iwave) < 5.)[0]
+        assert np.all(idx[offsets[kk]:offsets[kk+1]] == mtch)
@@ -0,0 +1,43 @@
+# Module to run tests on the PYPIT utilities
+
+
+import numpy as np
+import os
+import pytest
+
+from arclines import io as arcl_io
+from arclines import pypit_utils
+
+
+def data_path(filename):
+    data_dir = os.path.join(os.path.dirname(__file__), 'files')
+    return os.path.join(data_dir, filename)
+
+
+def test_find_peaks_batch():
+    for sfile in ['LRISr_600_7500_spec.ascii', 'LRISb_600_spec.ascii', 'Kastr_600_7500_spec.ascii']:
+        spec = arcl_io.load_spectrum(data_path(sfile))
+        tampl, tcent, twid, w, _ = pypit_utils.find_peaks(spec)
+        bampl, bcent, bwid, bw, _ = pypit_utils.find_peaks(spec, method='batch')
+        # Same detections
+        assert np.array_equal(w[0], bw[0])
+        # Same centroids
+        assert np.max(np.abs(tcent[w]-bcent[w])) < 1e-4
+        gdamp = np.isfinite(tampl[w])
+        assert np.allclose(tampl[w][gdamp], bampl[w][gdamp], rtol=1e-4)
+        assert np.allclose(twid[w], bwid[w], rtol=1e-4)
+
+
+def test_find_peaks_2d():
+    specs = []
+    for sfile in ['LRISr_600_7500_spec.ascii', 'LRISb_600_spec.ascii']:
+        specs.append(arcl_io.load_spectrum(data_path(sfile)))
+    specs = np.array(specs)
+    for method in ['curve_fit', 'batch']:
+        offsets, tampl, tcent, twid = pypit_utils.find_peaks_2d(specs, method=method)
+        assert offsets.size == specs.shape[0]+1
+        assert offsets[-1] == tcent.size
+        # Same as one at a time
+        for ss, spec in enumerate(specs):
+            sampl, scent, swid, w, _ = pypit_utils.find_peaks(spec, method=method)
+            assert np.allclose(tcent[offsets[ss]:offsets[ss+1]], scent[w])
@@ -0,0 +1,156 @@
+# Module to run tests on arclines.utils
+
+
+import numpy as np
+import json
+import pytest
+
+from astropy.table import Table
+
+import arclines
+
+from arclines import io as arcl_io
+from arclines import utils as arcl_utils
+
+test_arc_path = arclines.__path__[0]+'/data/test_arcs/'
+
+
+def vette_reference(U_lines, uions, tol_NIST=0.2):
+    """ Ion by ion, row by row NIST vetting
+    """
+    mask = np.ones(len(U_lines)).astype(int)
+    wv_match = np.array(['XXI   12233.2312']*len(U_lines))
+    for ion in uions:
+        nist = arcl_io.load_nist(ion)
+        for ss,row in enumerate(U_lines):
+            dwv = np.abs(nist['wave']-row['wave'])
+            imin = np.argmin(np.abs(dwv))
+            if dwv[imin] < tol_NIST:
+                wv_match[ss] = '{:s} {:.4f}'.format(ion,nist['wave'][imin])
+                mask[ss] = 2
+    return mask, wv_match
+
+
+def test_vette_nist():
+    uions = ['ArI', 'NeI', 'HgI', 'KrI', 'XeI']
+    rstate = np.random.RandomState(1234)
+    # Candidates near (and far from) NIST lines of all the ions
+    waves = []
+    for ion in uions:
+        nist = arcl_io.load_nist(ion)
+        waves.append(rstate.choice(nist['wave'], 50) + rstate.uniform(-0.3, 0.3, 50))
+    waves.append(rstate.uniform(3000., 10000., 200))
+    U_lines = Table()
+    U_lines['wave'] = np.concatenate(waves)
+    ref_mask, ref_match = vette_reference(U_lines, uions)
+    assert np.sum(ref_mask == 2) > 100
+    mask, wv_match = arcl_utils.vette_unkwn_against_lists(U_lines, uions, NIST_only=True)
+    assert np.all(mask == ref_mask)
+    assert np.all(wv_match == ref_match)
+
+
+def robust_polyfit_reference(xarray, yarray, order, function, minv, maxv, sigma=3.):
+    """ One rejection per iteration with a refit from scratch each time
+    """
+    mask = np.zeros(xarray.size, dtype=int)
+    while True:
+        w = np.where(mask == 0)[0]
+        ct = arcl_utils.func_fit(xarray[w], yarray[w], function, order, minv=minv, maxv=maxv)
+        yrng = arcl_utils.func_val(ct, xarray, function, minv=minv, maxv=maxv)
+        sigmed = 1.4826*np.median(np.abs(yarray[w]-yrng[w]))
+        tst = np.abs(yarray[w]-yrng[w])
+        m = np.argmax(tst)
+        if tst[m] <= sigma*sigmed:
+            break
+        mask[w[m]] = 1
+    return mask, ct
+
+
+@pytest.mark.parametrize('function', ['polynomial', 'legendre', 'chebyshev'])
+def test_robust_polyfit(function):
+    rstate = np.random.RandomState(1234)
+    xarray = np.sort(rstate.uniform(0., 2048., 60))
+    ytrue = 4000. + 2.*xarray + 1e-4*xarray**2
+    yarray = ytrue + rstate.normal(0., 0.1, xarray.size)
+    bad = rstate.choice(xarray.size, 6, replace=False)
+    yarray[bad] += rstate.uniform(5., 20., bad.size)
+    minv, maxv = 0., 2047.
+    # Identical to refitting
+    mask, ct = arcl_utils.robust_polyfit(xarray, yarray, 3, function=function, minv=minv, maxv=maxv)
+    rmask, rct = robust_polyfit_reference(xarray, yarray, 3, function, minv, maxv)
+    assert np.all(mask == rmask)
+    assert np.all(ct == rct)
+    assert np.all(mask[bad] == 1)
+    # Several rejections per iteration;  the same result
+    mask5, ct5 = arcl_utils.robust_polyfit(xarray, yarray, 3, function=function,
+                                           minv=minv, maxv=maxv, maxrej=5)
+    assert np.all(mask5 == mask)
+    assert np.all(ct5 == ct)
+
+
+@pytest.mark.parametrize('arc_file', ['kastr_600_7500_PYPIT.json', 'deimos_830G_b_PYPIT.json',
+                                      'lrisr_600_7500_PYPIT.json'])
+def test_robust_polyfit_maxrej(arc_file):
+    # The IDs of a test arc, with outliers
+    with open(test_arc_path+arc_file, 'r') as f:
+        pypit_fit = json.load(f)
+    pypit_fit = pypit_fit.get('0', pypit_fit)
+    xfit = np.array(pypit_fit['xfit'])
+    yfit = np.array(pypit_fit['yfit'])
+    rstate = np.random.RandomState(1234)
+    bad = rstate.choice(xfit.size, 5, replace=False)
+    yfit[bad] += rstate.uniform(20., 50., bad.size)*rstate.choice([-1,1], bad.size)
+    weights = rstate.uniform(0.5, 2., xfit.size)
+    for sigma in [2., 3.]:
+        for wts in [None, weights]:
+            mask, ct = arcl_utils.robust_polyfit(xfit, yfit, 3, function='legendre', sigma=sigma,
+                                                 minv=xfit.min(), maxv=xfit.max(), weights=wts)
+            assert np.sum(mask) > 2
+            for maxrej in [2, 5, 20]:
+                rmask, rct = arcl_utils.robust_polyfit(xfit, yfit, 3, function='legendre',
+                                                       sigma=sigma, minv=xfit.min(),
+                                                       maxv=xfit.max(), weights=wts,
+                                                       maxrej=maxrej)
+                assert np.all(rmask == mask)
+                assert np.all(rct == ct)
+
+
+@pytest.mark.parametrize('function', ['polynomial', 'legendre', 'chebyshev'])
+def test_func_batch(function):
+    rstate = np.random.RandomState(1234)
+    nsol = 20
+    coeffs = rstate.normal(size=(nsol, 5))
+    minv, maxv = rstate.uniform(-0.1, 0., nsol), rstate.uniform(1., 1.1, nsol)
+    # Shared x, per-solution range
+    x = np.linspace(0., 1., 200)
+    values = arcl_utils.func_val_batch(coeffs, x, function, minv=minv, maxv=maxv)
+    for ii in range(nsol):
+        assert np.all(values[ii] == arcl_utils.func_val(coeffs[ii], x, function,
+                                                        minv=minv[ii], maxv=maxv[ii]))
+    # One x per solution, range from x
+    xs = rstate.uniform(0., 1., (nsol, 50))
+    svalues = arcl_utils.func_val_batch(coeffs, xs, function)
+    for ii in range(nsol):
+        assert np.all(svalues[ii] == arcl_utils.func_val(coeffs[ii], xs[ii], function))
+    # Fits
+    fits = arcl_utils.func_fit_batch(x, values, function, 4, minv=minv, maxv=maxv)
+    np.testing.assert_allclose(fits, coeffs, atol=1e-10)
+    sfits = arcl_utils.func_fit_batch(xs, svalues, function, 4)
+    for ii in range(nsol):
+        np.testing.assert_allclose(sfits[ii], arcl_utils.func_fit(xs[ii], svalues[ii], function, 4),
+                                   atol=1e-10)
+    # Zero weights drop points
+    w = np.ones_like(svalues)
+    w[:,40:] = 0.
+    wfits = arcl_utils.func_fit_batch(xs, svalues+w-1., function, 4, minv=0., maxv=1., w=w)
+    for ii in range(nsol):
+        np.testing.assert_allclose(wfits[ii], arcl_utils.func_fit(xs[ii,:40], svalues[ii,:40],
+                                                                  function, 4, minv=0., maxv=1.),
+                                   atol=1e-10)
+    # Fewer points than coefficients;  the minimum-norm solution, as func_fit
+    with pytest.warns(np.RankWarning):
+        ufits = arcl_utils.func_fit_batch(xs[:3,:4], svalues[:3,:4], function, 5, minv=0., maxv=1.)
+    for ii in range(3):
+        np.testing.assert_allclose(ufits[ii], arcl_utils.func_fit(xs[ii,:4], svalues[ii,:4],
+                                                                  function, 5, minv=0., maxv=1.),
+                                   rtol=1e-8, atol=1e-10)
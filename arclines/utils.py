@@ -40,6 +40,62 @@ def unique_ions(source, src_dict=None):
         return src_lines
 
 
+def nist_matches(waves, uions, tol_NIST=0.2):
+    """ Match wavelengths against the NIST lists of several ions at once
+
+    A wavelength is matched to the *last* ion in uions with a NIST line
+    closer than tol_NIST, and to the nearest line of that ion (the lower
+    wavelength if two are equally near).  This is the result of looping
+    over the ions and keeping the last match.
+
+    Parameters
+    ----------
+    waves : ndarray
+    uions : list or ndarray
+    tol_NIST : float, optional
+
+    Returns
+    -------
+    iion : ndarray (int)
+      Index into uions of the matched ion;  -1 for no match
+    nist_wave : ndarray
+      Wavelength of the matched NIST line;  0. for no match
+    """
+    from arclines import io as arcl_io
+    from arclines import match as arcl_match
+
+    waves = np.atleast_1d(np.asarray(waves, dtype=float))
+    iion = -1*np.ones(waves.size, dtype=int)
+    nist_wave = np.zeros(waves.size)
+    if (len(uions) == 0) or (waves.size == 0):
+        return iion, nist_wave
+    # All ions in one list
+    nist_waves, ion_code = [], []
+    for kk, ion in enumerate(uions):
+        nist = arcl_io.load_nist(ion)
+        nist_waves.append(np.array(nist['wave']))
+        ion_code.append(kk*np.ones(len(nist), dtype=int))
+    nist_waves = np.concatenate(nist_waves)
+    ion_code = np.concatenate(ion_code)
+    # All lines within tolerance
+    offsets, idx = arcl_match.within(nist_waves, waves, tol_NIST)
+    nmtch = np.diff(offsets)
+    if idx.size == 0:
+        return iion, nist_wave
+    iwave = np.repeat(np.arange(waves.size), nmtch)
+    # Last ion
+    has = nmtch > 0
+    iion[has] = np.maximum.reduceat(ion_code[idx], offsets[:-1][has])
+    # Nearest line of that ion
+    keep = ion_code[idx] == iion[iwave]
+    iwave, idx = iwave[keep], idx[keep]
+    dwv = np.abs(nist_waves[idx]-waves[iwave])
+    order = np.lexsort((nist_waves[idx], dwv, iwave))
+    first = np.concatenate([[True], iwave[order][1:] != iwave[order][:-1]])
+    nist_wave[iwave[order][first]] = nist_waves[idx[order][first]]
+    return iion, nist_wave
+
+
 def vette_unkwn_against_lists(U_lines, uions, tol_NIST=0.2, NIST_only=False,
                               tol_llist=2., verbose=False):
     """ Query unknown lines against NIST database
@@ -65,28 +121,20 @@ def vette_unkwn_against_lists(U_lines, uions, tol_NIST=0.2, NIST_only=False,
 
     """
     from arclines import io as arcl_io
+    from arclines import match as arcl_match
 
     mask = np.ones(len(U_lines)).astype(int)
     wv_match = np.array(['XXI   12233.2312']*len(U_lines))
-    # Loop on NIST
-    for ion in uions:
-        # Load
-        nist = arcl_io.load_nist(ion)
-        # Try to match
-        for ss,row in enumerate(U_lines):
-            dwv = np.abs(nist['wave']-row['wave'])
-            imin = np.argmin(np.abs(dwv))
-            #if verbose:
-            #    print("Closest match to ion={:s} for {:g} is".format(ion,row['wave']))
-            #    print(nist[['Ion','wave','RelInt']][imin])
-            # Match?
-            if dwv[imin] < tol_NIST:
-                wv_match[ss] = '{:s} {:.4f}'.format(ion,nist['wave'][imin])
-                mask[ss] = 2
-                if verbose:
-                    print("UNKNWN Matched to NIST: ion={:s} {:g} with {:g}".format(
-                        ion,nist['wave'][imin], row['wave']))
-                #print(nist[['Ion','wave','RelInt','Aki']][imin])
+    U_wave = np.array(U_lines['wave'])
+    # NIST;  all ions at once (see nist_matches for the rules)
+    iion, nist_wave = nist_matches(U_wave, uions, tol_NIST=tol_NIST)
+    for ss in np.where(iion >= 0)[0]:
+        ion = uions[iion[ss]]
+        wv_match[ss] = '{:s} {:.4f}'.format(ion, nist_wave[ss])
+        mask[ss] = 2
+        if verbose:
+            print("UNKNWN Matched to NIST: ion={:s} {:g} with {:g}".format(
+                ion, nist_wave[ss], U_wave[ss]))
     if NIST_only:
         return mask, wv_match
 
@@ -94,22 +142,19 @@ def vette_unkwn_against_lists(U_lines, uions, tol_NIST=0.2, NIST_only=False,
     line_list = arcl_io.load_line_lists(uions, skip=True)
     if line_list is None:
         return mask, wv_match
-    for ss,row in enumerate(U_lines):
-        dwv = np.abs(line_list['wave']-row['wave'])
-        imin = np.argmin(np.abs(dwv))
-        # Match?
-        if dwv[imin] < tol_llist:
-            mask[ss] = 0
-            if verbose:
-                print("UNKNWN Matched to arclines: ion={:s} {:g} with {:g}".format(
-                        line_list['ion'][imin], line_list['wave'][imin], row['wave']))
-                print("  ---- Will not add it")
+    imin, dwv = arcl_match.nearest(line_list['wave'], U_wave)
+    for ss in np.where(dwv < tol_llist)[0]:
+        mask[ss] = 0
+        if verbose:
+            print("UNKNWN Matched to arclines: ion={:s} {:g} with {:g}".format(
+                    line_list['ion'][imin[ss]], line_list['wave'][imin[ss]], U_wave[ss]))
+            print("  ---- Will not add it")
     return mask, wv_match
 
 
 def robust_polyfit(xarray, yarray, order, weights=None, maxone=True, sigma=3.0,
                    function="polynomial", initialmask=None, forceimask=False,
-                   minv=None, maxv=None, guesses=None, **kwargs):
+                   minv=None, maxv=None, guesses=None, maxrej=None, **kwargs):
     """ Taken from PYPIT
     A robust (equally weighted) polynomial fit is performed to the xarray, yarray pairs
     mask[i] = 1 are masked values
@@ -125,8 +170,12 @@ def robust_polyfit(xarray, yarray, order, weights=None, maxone=True, sigma=3.0,
     :param forceimask: if True, the initialmask will be forced for all iterations
     :param minv: minimum value in the array (or the left limit for a legendre/chebyshev polynomial)
     :param maxv: maximum value in the array (or the right limit for a legendre/chebyshev polynomial)
+    :param maxrej: maximum number of (the most deviant) points removed in an iteration;  overrides maxone (maxone=True is maxrej=1).
+        The result is the same as for maxrej=1;  see _batch_rejection().  Only linear fits with a fixed range (see design_matrix()) are faster.
     :return: mask, ct -- mask is an array of the masked values, ct is the coefficients of the robust polyfit.
     """
+    if maxrej is None and maxone:
+        maxrej = 1
     # Setup the initial mask
     if initialmask is None:
         mask = np.zeros(xarray.size, dtype=np.int)
@@ -136,6 +185,15 @@ def robust_polyfit(xarray, yarray, order, weights=None, maxone=True, sigma=3.0,
     else:
         mask = initialmask.copy()
     mskcnt = np.sum(mask)
+    # Linear fits with a fixed range build the design matrix once
+    linear = (function in _vander_funcs.keys()) and (len(kwargs) == 0) and (
+        (function == 'polynomial') or ((minv is not None) and (maxv is not None)))
+    if linear:
+        van = design_matrix(xarray, function, order, minv=minv, maxv=maxv)
+        if (maxrej is not None) and (maxrej > 1):
+            return _batch_rejection(van, yarray, mask, order, sigma, maxrej, weights=weights)
+    elif maxrej is not None:
+        maxrej = 1
     # Iterate, and mask out new values on each iteration
     ct = guesses
     while True:
@@ -146,14 +204,17 @@ def robust_polyfit(xarray, yarray, order, weights=None, maxone=True, sigma=3.0,
             wfit = weights[w]
         else:
             wfit = None
-        ct = func_fit(xfit, yfit, function, order, w=wfit,
-                      guesses=ct, minv=minv, maxv=maxv, **kwargs)
+        if linear:
+            ct = lstsq_fit(van[w], yfit, w=wfit)
+        else:
+            ct = func_fit(xfit, yfit, function, order, w=wfit,
+                          guesses=ct, minv=minv, maxv=maxv, **kwargs)
         yrng = func_val(ct, xarray, function, minv=minv, maxv=maxv)
         sigmed = 1.4826*np.median(np.abs(yfit-yrng[w]))
         if xarray.size-np.sum(mask) <= order+2:
             warnings.warn("More parameters than data points - fit might be undesirable")
             break  # More data was masked than allowed by order
-        if maxone:  # Only remove the most deviant point
+        if maxrej is not None:  # Only remove the most deviant point(s)
             tst = np.abs(yarray[w]-yrng[w])
             m = np.argmax(tst)
             if tst[m] > sigma*sigmed:
@@ -167,6 +228,8 @@ def robust_polyfit(xarray, yarray, order, weights=None, maxone=True, sigma=3.0,
         if mskcnt == np.sum(mask): break  # No new values have been included in the mask
         mskcnt = np.sum(mask)
     # Final fit
+    if linear:  # Same mask as the last fit
+        return mask, ct
     w = np.where(mask == 0)
     xfit = xarray[w]
     yfit = yarray[w]
@@ -178,6 +241,155 @@ def robust_polyfit(xarray, yarray, order, weights=None, maxone=True, sigma=3.0,
     return mask, ct
 
 
+def _batch_rejection(van, yarray, mask, order, sigma, maxrej, weights=None):
+    """ robust_polyfit() of a linear fit, removing up to maxrej points per iteration
+
+    The points are removed one at a time, as for maxrej=1, but the fits are
+    made maxrej at a time.  Each iteration guesses that the next rejections
+    are the most deviant points of the current fit, in order, and fits all
+    of those masks at once.  The guesses are kept up to the first one that
+    a fit from scratch would not have made, so the mask and coefficients
+    are the same as for maxrej=1.
+
+    Parameters
+    ----------
+    van : ndarray (npt, ncoeff)
+      Design matrix
+    yarray : ndarray
+    mask : ndarray
+      Initial mask;  1 = masked
+    order : int
+    sigma : float
+    maxrej : int
+    weights : ndarray, optional
+
+    Returns
+    -------
+    mask, ct
+    """
+    if weights is None:
+        weights = np.ones(yarray.size)
+    # From scratch, as the first iteration of maxrej=1
+    w = np.where(mask == 0)[0]
+    ct = lstsq_fit(van[w], yarray[w], w=weights[w])
+    yrng = van.dot(ct)
+    refit = False
+    while True:
+        w = np.where(mask == 0)[0]
+        if w.size <= order+2:
+            warnings.warn("More parameters than data points - fit might be undesirable")
+            break
+        tst = np.abs(yarray[w]-yrng[w])
+        bad = np.where(tst > sigma*1.4826*np.median(tst))[0]
+        if bad.size == 0:
+            break
+        # The most deviant first, as np.argmax()
+        rej = w[bad[np.argsort(-tst[bad], kind='mergesort')[:maxrej]]]
+        if rej.size == 1:  # As maxrej=1
+            mask[rej[0]] = 1
+            w = np.where(mask == 0)[0]
+            ct = lstsq_fit(van[w], yarray[w], w=weights[w])
+            yrng = van.dot(ct)
+            refit = False
+            continue
+        # Mask of each guess;  the points in rej are removed in turn
+        keep = np.tile(weights*(mask == 0), (rej.size, 1))
+        for ii in range(rej.size):
+            keep[ii:, rej[ii]] = 0.
+        cts = _stacked_lstsq(van[None,:,:]*keep[:,:,None], yarray[None,:]*keep)
+        yrngs = cts.dot(van.T)
+        refit = True
+        # Keep the guesses up to the first wrong one
+        for ii in range(rej.size):
+            mask[rej[ii]] = 1
+            yrng = yrngs[ii]
+            if ii == rej.size-1:
+                break
+            w = np.where(mask == 0)[0]
+            if w.size <= order+2:
+                break
+            tst = np.abs(yarray[w]-yrng[w])
+            m = np.argmax(tst)
+            if (w[m] != rej[ii+1]) or (tst[m] <= sigma*1.4826*np.median(tst)):
+                break
+    # The coefficients of maxrej=1 come from lstsq_fit()
+    if refit:
+        w = np.where(mask == 0)[0]
+        ct = lstsq_fit(van[w], yarray[w], w=weights[w])
+    return mask, ct
+
+
+# Vandermonde-like matrices of the linear fitting functions
+_vander_funcs = dict(polynomial=np.polynomial.polynomial.polyvander,
+                     legendre=np.polynomial.legendre.legvander,
+                     chebyshev=np.polynomial.chebyshev.chebvander)
+
+
+def design_matrix(x, func, deg, minv=None, maxv=None):
+    """ Design matrix of func_fit() for polynomial, legendre and chebyshev
+
+    Parameters
+    ----------
+    x : ndarray
+    func : str
+    deg : int
+    minv : float, optional
+    maxv : float, optional
+      As in func_fit()
+
+    Returns
+    -------
+    van : ndarray (x.size, deg+1)
+    """
+    if func == "polynomial":
+        xv = x
+    elif func in ["legendre", "chebyshev"]:
+        if minv is None or maxv is None:
+            if np.size(x) == 1:
+                xmin, xmax = -1.0, 1.0
+            else:
+                xmin, xmax = np.min(x), np.max(x)
+        else:
+            xmin, xmax = minv, maxv
+        xv = 2.0 * (x-xmin)/(xmax-xmin) - 1.0
+    else:
+        raise IOError("No design matrix for fitting function '{0:s}'".format(func))
+    return _vander_funcs[func](np.asarray(xv) + 0.0, deg)
+
+
+def lstsq_fit(van, y, w=None):
+    """ Least-squares coefficients for a design matrix
+    Same as np.polynomial.*fit(), which build van themselves
+
+    Parameters
+    ----------
+    van : ndarray (npt, ncoeff)
+    y : ndarray (npt) or (npt, nset)
+    w : ndarray, optional
+
+    Returns
+    -------
+    coeff : ndarray
+    """
+    if van.shape[0] == 0:
+        raise TypeError("expected non-empty vector for x")
+    lhs = np.ascontiguousarray(van.T)  # As laid out by np.polynomial
+    rhs = (np.asarray(y) + 0.0).T
+    if w is not None:
+        w = np.asarray(w) + 0.0
+        lhs = lhs * w
+        rhs = rhs * w
+    rcond = van.shape[0]*np.finfo(float).eps
+    # Scale the columns
+    scl = np.sqrt(np.square(lhs).sum(1))
+    scl[scl == 0] = 1
+    c, resids, rank, s = np.linalg.lstsq(lhs.T/scl, rhs.T, rcond)
+    c = (c.T/scl).T
+    if rank != van.shape[1]:
+        warnings.warn("The fit may be poorly conditioned", np.RankWarning)
+    return c
+
+
 def calc_fit_rms(xfit, yfit, fit, func, minv=None, maxv=None):
     """ Simple RMS calculation
 
@@ -326,6 +538,145 @@ def func_val(c, x, func, minv=None, maxv=None):
     else:
         raise ValueError("Fitting function '{0:s}' is not implemented yet\n"+"Please choose from 'polynomial', 'legendre', 'chebyshev', 'bspline'")
 
+
+def _batch_xv(x, func, nset, minv=None, maxv=None):
+    """ x of func_val_batch() or func_fit_batch(), as (nset or 1, npt)
+    and normalised for legendre and chebyshev
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    if func == "polynomial":
+        return x
+    elif func not in ["legendre", "chebyshev"]:
+        raise ValueError("Batched fits are only for 'polynomial', 'legendre', 'chebyshev'")
+    if minv is None or maxv is None:
+        if x.shape[1] == 1:
+            xmin, xmax = -1.0, 1.0
+        else:
+            xmin, xmax = np.min(x, axis=1)[:,None], np.max(x, axis=1)[:,None]
+    else:
+        xmin = np.asarray(minv, dtype=float).reshape(-1,1)
+        xmax = np.asarray(maxv, dtype=float).reshape(-1,1)
+    return 2.0 * (x-xmin)/(xmax-xmin) - 1.0
+
+
+def func_val_batch(c, x, func, minv=None, maxv=None, chunk_size=2**14):
+    """ func_val() for many solutions of the same function and order at once
+    One Horner (polynomial) or Clenshaw (legendre, chebyshev) recurrence
+    over all of them
+
+    Parameters
+    ----------
+    c : ndarray (nsol, ncoeff)
+      coefficients, one solution per row
+    x : ndarray (npt) or (nsol, npt)
+      the same x for all solutions or one row each
+    func : str
+      polynomial, legendre, chebyshev
+    minv : float or ndarray (nsol), optional
+    maxv : float or ndarray (nsol), optional
+      as in func_val();  if not given, the range of each row of x
+    chunk_size : int, optional
+      values computed together
+
+    Returns
+    -------
+    values : ndarray (nsol, npt)
+      row ii is func_val(c[ii], x or x[ii], func, minv[ii], maxv[ii])
+    """
+    c = np.atleast_2d(np.asarray(c, dtype=float))
+    nsol = c.shape[0]
+    xv = _batch_xv(x, func, nsol, minv=minv, maxv=maxv)
+    val = dict(polynomial=np.polynomial.polynomial.polyval,
+               legendre=np.polynomial.legendre.legval,
+               chebyshev=np.polynomial.chebyshev.chebval)[func]
+    # In chunks that stay in cache;  coefficient sets along the
+    # trailing axes broadcast against xv
+    values = np.zeros((nsol, xv.shape[1]))
+    nchunk = max(1, chunk_size // xv.shape[1])
+    for i0 in range(0, nsol, nchunk):
+        i1 = min(i0+nchunk, nsol)
+        cxv = xv if xv.shape[0] == 1 else xv[i0:i1]
+        values[i0:i1] = val(cxv, c[i0:i1].T[:,:,None], tensor=False)
+    return values
+
+
+def func_fit_batch(x, y, func, deg, minv=None, maxv=None, w=None, chunk_size=2**18):
+    """ func_fit() for many independent sets of points, same function and order
+    Shared x is a single least-squares solve with many right-hand sides;
+    otherwise the design matrices are stacked and solved together by QR
+
+    Parameters
+    ----------
+    x : ndarray (npt) or (nset, npt)
+      the same x for all sets or one row each
+    y : ndarray (nset, npt)
+    func : str
+      polynomial, legendre, chebyshev
+    deg : int
+    minv : float or ndarray (nset), optional
+    maxv : float or ndarray (nset), optional
+      as in func_fit();  if not given, the range of each row of x
+    w : ndarray (nset, npt), optional
+      weights;  0 drops a point, for sets of different sizes
+    chunk_size : int, optional
+      design matrix elements solved together
+
+    Returns
+    -------
+    coeff : ndarray (nset, deg+1)
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    nset = y.shape[0]
+    xv = _batch_xv(x, func, nset, minv=minv, maxv=maxv)
+    # One design matrix
+    if (xv.shape[0] == 1) and (w is None):
+        return lstsq_fit(_vander_funcs[func](xv[0], deg), y.T).T
+    # Stacked, in chunks of a few MB
+    if w is not None:
+        w = np.atleast_2d(np.asarray(w, dtype=float))
+    if xv.shape[0] == 1:
+        van = _vander_funcs[func](xv[0], deg)
+    nchunk = max(1, chunk_size // (xv.shape[1]*(deg+1)))
+    coeff = np.zeros((nset, deg+1))
+    for i0 in range(0, nset, nchunk):
+        i1 = min(i0+nchunk, nset)
+        if xv.shape[0] == 1:
+            cvan = np.broadcast_to(van, (i1-i0,)+van.shape)
+        else:
+            cvan = _vander_funcs[func](xv[i0:i1], deg)
+        cy = y[i0:i1]
+        if w is not None:
+            cvan = cvan * w[i0:i1,:,None]
+            cy = cy * w[i0:i1]
+        coeff[i0:i1] = _stacked_lstsq(cvan, cy)
+    return coeff
+
+
+def _stacked_lstsq(van, y):
+    """ Least-squares coefficients for a stack of design matrices
+    Scaled columns and QR;  rank-deficient sets by pseudo-inverse, as lstsq
+    """
+    scl = np.sqrt(np.sum(van**2, axis=1))
+    scl[scl == 0] = 1
+    van = van/scl[:,None,:]
+    rcond = van.shape[1]*np.finfo(float).eps
+    if van.shape[1] < van.shape[2]:  # Fewer points than coefficients;  all rank-deficient
+        good = np.zeros(van.shape[0], dtype=bool)
+    else:
+        q, r = np.linalg.qr(van)
+        rdiag = np.abs(np.diagonal(r, axis1=1, axis2=2))
+        good = np.all(rdiag > rcond*np.max(rdiag, axis=1)[:,None], axis=1)
+    coeff = np.zeros(scl.shape)
+    if np.any(good):
+        qty = np.einsum('ijk,ij->ik', q[good], y[good])
+        coeff[good] = np.linalg.solve(r[good], qty[:,:,None])[:,:,0]
+    if not np.all(good):
+        warnings.warn("The fit may be poorly conditioned", np.RankWarning)
+        pinv = np.linalg.pinv(van[~good], rcond=rcond)
+        coeff[~good] = np.einsum('ijk,ik->ij', pinv, y[~good])
+    return coeff/scl
+
+
 def gauss_2deg(x,ampl,sigm):
     """  Simple 2 parameter Gaussian (amplitude, sigma)
     Parameters